@@ -51,3 +51,17 @@ async def generate_audio(request: AudioRequest):
     # Return local URL
     # Assuming running on localhost:8000
     return {"audio_url": f"http://localhost:8000/static/{filename}"}
+
+@router.get("/stats")
+async def get_ai_stats():
+    """Gemini call counters, response cache hit/miss metrics per call site and
+    how many Gemini/GitHub calls were coalesced into one already in flight"""
+    from . import gemini_utils
+    from .resilience_utils import single_flight_stats
+    return {**gemini_utils.stats(), "single_flight": single_flight_stats()}
+
+@router.get("/breakers")
+async def get_circuit_breakers():
+    """State of the circuit breaker guarding each Gemini and GitHub endpoint"""
+    from .resilience_utils import breaker_stats
+    return breaker_stats()
@@ -1,23 +1,15 @@
-import os
 import random
 import asyncio
-from google import genai
 from sqlalchemy.future import select
 from models import User, Message
 from database import AsyncSessionLocal
 from .socket_instance import sio
 from .ai_utils import process_pr_link
+from . import gemini_utils
+from .gemini_utils import GEMINI_API_KEY
+from .scheduler_utils import RequestDropped
 from datetime import datetime
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
-
-client = None
-if GEMINI_API_KEY:
-    client = genai.Client(api_key=GEMINI_API_KEY, http_options={'api_version': 'v1beta'})
-
-
 AI_TEAMMATES = [
     {"name": "Sarah", "role": "HR Manager", "style": "Friendly, welcoming, helpful, emojis", "github_id": "ai_sarah", "avatar_url": "https://api.dicebear.com/7.x/avataaars/svg?seed=Sarah"},
     {"name": "Mike", "role": "Senior Dev", "style": "Concise, technical, slightly cynical, helpful", "github_id": "ai_mike", "avatar_url": "https://api.dicebear.com/7.x/avataaars/svg?seed=Mike"},
@@ -121,8 +113,7 @@ async def trigger_ai_response_task(channel: str, user_message: str):
                 """
                 
                 # In a real environment, this might take time, so we already sent the "thanks" for PRs
-                response = client.models.generate_content(model=MODEL, contents=prompt)
-                content = response.text
+                content = await gemini_utils.generate_text(prompt)
             
             msg = Message(
                 channel=channel,
@@ -174,8 +165,7 @@ async def trigger_proactive_message(channel: str, prompt_context: str, user_name
             Write a short message (1 sentence) to the channel or the user.
             """
             
-            response = client.models.generate_content(model=MODEL, contents=prompt)
-            content = response.text
+            content = await gemini_utils.generate_text(prompt, priority="background", max_wait=gemini_utils.BACKGROUND_MAX_WAIT_SECONDS)
             
             msg = Message(
                 channel=channel,
@@ -200,5 +190,7 @@ async def trigger_proactive_message(channel: str, prompt_context: str, user_name
             
             await sio.emit("new_message", data)
             
+    except RequestDropped:
+        print("Skipped proactive AI message: Gemini queue too long")
     except Exception as e:
         print(f"Error in proactive AI response: {e}")
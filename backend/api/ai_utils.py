@@ -1,19 +1,31 @@
-from google import genai
 from fastapi import HTTPException
-import os
 import json
 import asyncio
 from gtts import gTTS
 import io
 import httpx
+from . import gemini_utils
+from .gemini_utils import GEMINI_API_KEY
+from .resilience_utils import CircuitOpen, call_with_retries, single_flight
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+def parse_json_reply(content: str):
+    """Parse a JSON reply, tolerating a markdown code fence around it"""
+    # Clean up potential markdown formatting
+    if content.strip().startswith("```json"):
+        content = content.strip()[7:]
+    if content.strip().startswith("```"):
+        content = content.strip()[3:]
+    if content.strip().endswith("```"):
+        content = content.strip()[:-3]
+    return json.loads(content)
 
-MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
-
-client = None
-if GEMINI_API_KEY:
-    client = genai.Client(api_key=GEMINI_API_KEY, http_options={'api_version': 'v1beta'})
+def is_json_reply(content: str) -> bool:
+    """Only replies that parse are worth caching"""
+    try:
+        parse_json_reply(content)
+        return True
+    except ValueError:
+        return False
 
 async def analyze_diff(diff: str, pr_title: str) -> dict:
     if not GEMINI_API_KEY:
@@ -52,21 +64,8 @@ async def analyze_diff(diff: str, pr_title: str) -> dict:
         {diff}
         """
         
-        response = client.models.generate_content(
-            model=MODEL,
-            contents=prompt
-        )
-        
-        content = response.text
-        # Clean up potential markdown formatting
-        if content.strip().startswith("```json"):
-            content = content.strip()[7:]
-        if content.strip().startswith("```"):
-            content = content.strip()[3:]
-        if content.strip().endswith("```"):
-            content = content.strip()[:-3]
-            
-        return json.loads(content)
+        content = await gemini_utils.generate_text(prompt, cache_site="pr_review", cache_check=is_json_reply, priority="interactive")
+        return parse_json_reply(content)
         
     except Exception as e:
         print(f"Gemini Error: {e}")
@@ -82,20 +81,26 @@ async def fetch_pr_diff(pr_url: str) -> str:
     diff_url = pr_url
     if not diff_url.endswith(".diff"):
         diff_url = f"{diff_url}.diff"
-        
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(diff_url, follow_redirects=True)
-            
-            if response.status_code == 404:
-                return "Error: Repo not found or private. I can only review public repositories."
-            
-            if response.status_code == 200:
-                return response.text
-            else:
-                return f"Error fetching diff: HTTP {response.status_code}"
-    except Exception as e:
-        return f"Error fetching diff: {str(e)}"
+    
+    async def fetch() -> str:
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await call_with_retries("github.web", lambda: client.get(diff_url, follow_redirects=True))
+                
+                if response.status_code == 404:
+                    return "Error: Repo not found or private. I can only review public repositories."
+                
+                if response.status_code == 200:
+                    return response.text
+                else:
+                    return f"Error fetching diff: HTTP {response.status_code}"
+        except CircuitOpen:
+            return "Error fetching diff: GitHub isn't answering right now, try again in a minute."
+        except Exception as e:
+            return f"Error fetching diff: {str(e)}"
+    
+    # Several hires pasting the same PR at once share one download
+    return await single_flight("github").do(diff_url, fetch)
 
 async def process_pr_link(pr_url: str) -> str:
     """
@@ -167,8 +172,7 @@ async def generate_coworker_update(name: str, role: str, context: str) -> str:
         Tone: Casual, slightly tired but professional.
         """
         
-        response = client.models.generate_content(model=MODEL, contents=prompt)
-        return response.text
+        return await gemini_utils.generate_text(prompt, cache_site="coworker_update")
     except Exception as e:
         print(f"Gemini generation error: {e}")
         return f"I am working on {context}. No blockers."
@@ -214,12 +218,12 @@ async def transcribe_audio(file_path: str) -> str:
             
         print(f"Transcribing {file_path} with mime_type {mime_type}...")
         
-        myfile = client.files.upload(file=file_path, config={'mime_type': mime_type})
+        myfile = await gemini_utils.upload_file(file_path, mime_type)
         
         # Wait for file to be active (required for audio/video)
         import time
         for i in range(10): # Max 20 seconds
-            myfile = client.files.get(name=myfile.name)
+            myfile = await gemini_utils.get_file(myfile.name)
             if myfile.state.name == "ACTIVE":
                 break
             if myfile.state.name == "FAILED":
@@ -229,8 +233,7 @@ async def transcribe_audio(file_path: str) -> str:
         else:
             raise Exception("Timeout waiting for file to be ACTIVE")
 
-        result = client.models.generate_content(model=MODEL, contents=[myfile, "Transcribe this audio file accurately. Return ONLY the transcription text, nothing else."])
-        return result.text
+        return await gemini_utils.generate_text([myfile, "Transcribe this audio file accurately. Return ONLY the transcription text, nothing else."])
     except Exception as e:
         import traceback
         print(f"Transcription failed: {str(e)}")
@@ -311,21 +314,8 @@ async def generate_project_with_bugs(project_description: str, backend_stack: st
     """
 
     try:
-        response = client.models.generate_content(
-            model=MODEL,
-            contents=prompt
-        )
-        
-        content = response.text
-        # Clean up potential markdown formatting
-        if content.strip().startswith("```json"):
-            content = content.strip()[7:]
-        if content.strip().startswith("```"):
-            content = content.strip()[3:]
-        if content.strip().endswith("```"):
-            content = content.strip()[:-3]
-            
-        project_data = json.loads(content)
+        content = await gemini_utils.generate_text(prompt)
+        project_data = parse_json_reply(content)
         project_data["is_fallback"] = False
         return project_data
     except Exception as e:
@@ -376,17 +366,8 @@ async def verify_standup_truthfulness(transcript: str, ticket_summary: str) -> d
     """
 
     try:
-        response = client.models.generate_content(model=MODEL, contents=prompt)
-        content = response.text
-        # Clean up potential markdown formatting
-        if content.strip().startswith("```json"):
-            content = content.strip()[7:]
-        if content.strip().startswith("```"):
-            content = content.strip()[3:]
-        if content.strip().endswith("```"):
-            content = content.strip()[:-3]
-            
-        return json.loads(content)
+        content = await gemini_utils.generate_text(prompt, cache_site="standup_truthfulness", cache_check=is_json_reply)
+        return parse_json_reply(content)
     except Exception as e:
         print(f"Truthfulness Verification Error: {e}")
         return {"score": 0, "reason": "Snag in verification."}
@@ -404,11 +385,11 @@ async def analyze_video(file_path: str, duration: str = None) -> str:
             mime_type = "video/webm"
             
         print(f"Uploading video {file_path} (mime: {mime_type}) to Gemini...")
-        myfile = client.files.upload(file=file_path, config={'mime_type': mime_type})
+        myfile = await gemini_utils.upload_file(file_path, mime_type)
         
         # Wait for file to be active
         for i in range(20): # Max 40 seconds for video
-            myfile = client.files.get(name=myfile.name)
+            myfile = await gemini_utils.get_file(myfile.name)
             if myfile.state.name == "ACTIVE":
                 break
             if myfile.state.name == "FAILED":
@@ -434,15 +415,15 @@ async def analyze_video(file_path: str, duration: str = None) -> str:
         Note: {duration_instruction}
         """
         
-        result = client.models.generate_content(model=MODEL, contents=[myfile, prompt])
+        text = await gemini_utils.generate_text([myfile, prompt])
         
         # Clean up the file from Gemini after analysis
         try:
-            client.files.delete(name=myfile.name)
+            await gemini_utils.delete_file(myfile.name)
         except:
             pass
             
-        return result.text.strip()
+        return text.strip()
     except Exception as e:
         print(f"Video analysis failed: {str(e)}")
         return f"user uploaded sprint review, error: {str(e)}"
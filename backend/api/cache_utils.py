@@ -0,0 +1,267 @@
+from typing import Callable, Dict, List, Optional
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Hits only bump last_used in memory; the bumps are written in one transaction
+# every TOUCH_FLUSH_SECONDS, once TOUCH_FLUSH_ENTRIES pile up, or before a put
+TOUCH_FLUSH_SECONDS = float(os.getenv("CACHE_TOUCH_FLUSH_SECONDS", "30"))
+TOUCH_FLUSH_ENTRIES = int(os.getenv("CACHE_TOUCH_FLUSH_ENTRIES", "1000"))
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # WAL with synchronous=NORMAL: commits don't fsync, readers never wait on the writer
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class _LastUsedBuffer:
+    """last_used timestamps of cache hits, waiting to be written in one batch"""
+
+    def __init__(self, table: str):
+        self.table = table
+        self.pending: Dict[str, float] = {}
+        self.flushed_at = time.monotonic()
+
+    def touch(self, conn: sqlite3.Connection, keys, now: float):
+        self.pending.update((key, now) for key in keys)
+        if len(self.pending) >= TOUCH_FLUSH_ENTRIES or time.monotonic() - self.flushed_at >= TOUCH_FLUSH_SECONDS:
+            self.flush(conn)
+            conn.commit()
+
+    def flush(self, conn: sqlite3.Connection):
+        """Write pending timestamps; the caller commits"""
+        if self.pending:
+            conn.executemany(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", [(now, key) for key, now in self.pending.items()])
+            self.pending.clear()
+        self.flushed_at = time.monotonic()
+
+
+class EmbeddingCache:
+    """Persistent embedding cache keyed by (model, task_type, sha256(text)).
+
+    Identical chunks (READMEs, lockfiles, CI yaml...) are shared across users and
+    repos, so they only ever hit the embedding API once. Backed by SQLite and kept
+    under `max_entries` by evicting the least recently used vectors.
+    """
+
+    def __init__(self, path: str, max_entries: int = 50000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._touches = _LastUsedBuffer("embeddings")
+        self._conn = _connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, task_type: str, text: str) -> str:
+        return f"{model}:{task_type}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        unique_keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for i in range(0, len(unique_keys), 500):
+                batch = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+            if found:
+                self._touches.touch(self._conn, found, time.time())
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def get(self, key: str) -> Optional[List[float]]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: Dict[str, List[float]]):
+        if not items:
+            return
+        now = time.time()
+        with self._lock:
+            self._touches.flush(self._conn) # eviction below needs current last_used
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items.items()]
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                logger.info(f"Evicted {count - self.max_entries} embeddings from cache")
+            self._conn.commit()
+
+    def put(self, key: str, vector: List[float]):
+        self.put_many({key: vector})
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "max_entries": self.max_entries
+        }
+
+
+def normalize_query(text: str) -> str:
+    """Case, whitespace and trailing punctuation don't change what is being asked"""
+    return " ".join(text.casefold().split()).rstrip("?!. ")
+
+
+class TTLCache:
+    """In-memory LRU cache whose entries also expire `ttl_seconds` after being
+    stored (None keeps them until they are evicted)"""
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[object], bool]) -> int:
+        """Drop every entry whose key matches; returns how many were dropped"""
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds
+        }
+
+
+class ResponseCache:
+    """Persistent cache of model responses keyed by (model, sha256(prompt), generation config).
+
+    Entries expire after the TTL given when they were stored and the table is
+    kept under `max_entries` by evicting the least recently used responses.
+    Hits and misses are counted per call site.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.sites: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._touches = _LastUsedBuffer("responses")
+        self._conn = _connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, site TEXT NOT NULL, text TEXT NOT NULL, "
+            "expires_at REAL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, prompt: str, config=None) -> str:
+        config_json = json.dumps(config, sort_keys=True, default=str)
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return f"{model}:{prompt_hash}:{hashlib.sha256(config_json.encode('utf-8')).hexdigest()[:16]}"
+
+    def _count(self, site: str, outcome: str):
+        counts = self.sites.setdefault(site, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+
+    def get(self, key: str, site: str = "default") -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT text, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now): # expired rows are removed by put
+                self._count(site, "misses")
+                return None
+            self._touches.touch(self._conn, [key], now)
+            self._count(site, "hits")
+            return row[0]
+
+    def put(self, key: str, text: str, ttl_seconds: Optional[float] = None, site: str = "default"):
+        now = time.time()
+        expires_at = now + ttl_seconds if ttl_seconds is not None else None
+        with self._lock:
+            self._touches.flush(self._conn) # eviction below needs current last_used
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, site, text, expires_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, site, text, expires_at, now)
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_entries:
+                # Expired entries go first, then the least recently used
+                self._conn.execute("DELETE FROM responses WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+                (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used, rowid LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                logger.info(f"Evicted {count - self.max_entries} responses from cache")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+        hits = sum(counts["hits"] for counts in self.sites.values())
+        misses = sum(counts["misses"] for counts in self.sites.values())
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "sites": {site: dict(counts) for site, counts in self.sites.items()}
+        }
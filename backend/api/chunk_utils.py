@@ -0,0 +1,221 @@
+from typing import Callable, Dict, List, NamedTuple, Tuple
+from functools import partial
+import ast
+import os
+import random
+import re
+
+DEFAULT_MAX_CHARS = int(os.getenv("RAG_CHUNK_CHARS", "1500"))
+
+
+class Chunk(NamedTuple):
+    text: str
+    start_line: int # 1-based, inclusive
+    end_line: int
+
+
+def _size(lines: List[str], start: int, end: int) -> int:
+    return sum(len(line) for line in lines[start - 1:end])
+
+
+def _split_range(lines: List[str], start: int, end: int, max_chars: int) -> List[Chunk]:
+    """Split an oversized line range, preferring to cut at blank lines.
+    A single line longer than max_chars is cut into character windows."""
+    chunks = []
+    chunk_start, size, last_blank = start, 0, None
+    line_no = start
+    while line_no <= end:
+        line = lines[line_no - 1]
+        if len(line) > max_chars:
+            if line_no > chunk_start:
+                chunks.append(Chunk("".join(lines[chunk_start - 1:line_no - 1]), chunk_start, line_no - 1))
+            chunks.extend(Chunk(line[i:i + max_chars], line_no, line_no) for i in range(0, len(line), max_chars))
+            line_no += 1
+            chunk_start, size, last_blank = line_no, 0, None
+            continue
+        if size + len(line) > max_chars and line_no > chunk_start:
+            cut = last_blank if last_blank is not None else line_no - 1
+            chunks.append(Chunk("".join(lines[chunk_start - 1:cut]), chunk_start, cut))
+            chunk_start, size, last_blank = cut + 1, _size(lines, cut + 1, line_no - 1), None
+            continue
+        size += len(line)
+        if not line.strip() and line_no > chunk_start:
+            last_blank = line_no
+        line_no += 1
+    if chunk_start <= end:
+        chunks.append(Chunk("".join(lines[chunk_start - 1:end]), chunk_start, end))
+    return chunks
+
+
+def _pack(lines: List[str], segments: List[Tuple[int, int]], max_chars: int) -> List[Chunk]:
+    """Greedily merge consecutive segments into chunks of at most max_chars,
+    splitting segments that are too big on their own"""
+    chunks = []
+    current, current_size = None, 0
+
+    def flush():
+        if current is not None:
+            chunks.append(Chunk("".join(lines[current[0] - 1:current[1]]), current[0], current[1]))
+
+    for start, end in segments:
+        if end < start:
+            continue
+        size = _size(lines, start, end)
+        if size > max_chars:
+            flush()
+            current, current_size = None, 0
+            chunks.extend(_split_range(lines, start, end, max_chars))
+            continue
+        if current is not None and current_size + size > max_chars:
+            flush()
+            current, current_size = None, 0
+        current = (current[0] if current else start, end)
+        current_size += size
+    flush()
+    return [chunk for chunk in chunks if chunk.text.strip()]
+
+
+def _blank_line_segments(lines: List[str], start: int = 1, end: int = None) -> List[Tuple[int, int]]:
+    end = len(lines) if end is None else end
+    segments, segment_start = [], start
+    for line_no in range(start, end + 1):
+        if not lines[line_no - 1].strip():
+            segments.append((segment_start, line_no))
+            segment_start = line_no + 1
+    segments.append((segment_start, end))
+    return segments
+
+
+def chunk_lines(text: str, max_chars: int = DEFAULT_MAX_CHARS) -> List[Chunk]:
+    """Generic fallback: paragraphs separated by blank lines"""
+    lines = text.splitlines(keepends=True)
+    return _pack(lines, _blank_line_segments(lines), max_chars)
+
+
+_PY_DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+
+def _python_segments(lines: List[str], body: list, start: int, end: int, max_chars: int) -> List[Tuple[int, int]]:
+    segments, cursor = [], start
+    for node in body:
+        if not isinstance(node, _PY_DEFINITIONS):
+            continue
+        node_start = min([node.lineno] + [decorator.lineno for decorator in node.decorator_list])
+        # Comments directly above a definition belong to it
+        while node_start - 1 >= cursor and lines[node_start - 2].lstrip().startswith("#"):
+            node_start -= 1
+        if node_start > cursor:
+            segments.append((cursor, node_start - 1))
+        if isinstance(node, ast.ClassDef) and _size(lines, node_start, node.end_lineno) > max_chars:
+            # Big classes are split at their methods; the class header stays with the first one
+            members = _python_segments(lines, node.body, node_start, node.end_lineno, max_chars)
+            if len(members) > 1:
+                members = [(members[0][0], members[1][1])] + members[2:]
+            segments.extend(members)
+        else:
+            segments.append((node_start, node.end_lineno))
+        cursor = node.end_lineno + 1
+    if cursor <= end:
+        segments.append((cursor, end))
+    return segments
+
+
+def chunk_python(text: str, max_chars: int = DEFAULT_MAX_CHARS) -> List[Chunk]:
+    """Function/class boundaries from the ast; files that don't parse fall back to chunk_lines"""
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return chunk_lines(text, max_chars)
+    lines = text.splitlines(keepends=True)
+    return _pack(lines, _python_segments(lines, tree.body, 1, len(lines), max_chars), max_chars)
+
+
+def chunk_braces(text: str, max_chars: int = DEFAULT_MAX_CHARS, base_depth: int = 0) -> List[Chunk]:
+    """JS/TS/Java/C#/CSS: cut where a block closes back to `base_depth` (0 for
+    top-level functions, 1 for members of a Java/C# class) or at blank lines there"""
+    lines = text.splitlines(keepends=True)
+    segments, segment_start, depth = [], 1, 0
+    for line_no, line in enumerate(lines, start=1):
+        previous_depth = depth
+        depth = max(0, depth + line.count("{") - line.count("}"))
+        closes_block = previous_depth > base_depth and depth <= base_depth and "}" in line
+        if closes_block or (not line.strip() and depth <= base_depth):
+            segments.append((segment_start, line_no))
+            segment_start = line_no + 1
+    segments.append((segment_start, len(lines)))
+    return _pack(lines, segments, max_chars)
+
+
+_MD_HEADING = re.compile(r"^#{1,6}\s")
+
+
+def chunk_markdown(text: str, max_chars: int = DEFAULT_MAX_CHARS) -> List[Chunk]:
+    """One section per heading (headings inside fenced code blocks don't count)"""
+    lines = text.splitlines(keepends=True)
+    segments, segment_start, in_fence = [], 1, False
+    for line_no, line in enumerate(lines, start=1):
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+        elif not in_fence and _MD_HEADING.match(line) and line_no > segment_start:
+            segments.append((segment_start, line_no - 1))
+            segment_start = line_no
+    segments.append((segment_start, len(lines)))
+    # Small sections are merged with their neighbours; oversized ones split at paragraphs
+    return _pack(lines, segments, max_chars)
+
+
+# Gear table for the content-defined chunker: one fixed pseudo-random word per byte value
+_GEAR = [random.Random(0x5EED + i).getrandbits(32) for i in range(256)]
+CDC_MIN_CHARS = int(os.getenv("RAG_CDC_MIN_CHARS", "300"))
+CDC_MASK_BITS = int(os.getenv("RAG_CDC_MASK_BITS", "4"))
+
+
+def chunk_content_defined(text: str, max_chars: int = DEFAULT_MAX_CHARS, min_chars: int = CDC_MIN_CHARS, mask_bits: int = CDC_MASK_BITS) -> List[Chunk]:
+    """Content-defined chunking: a Gear rolling hash runs over the text and a chunk
+    may end at a line break where `mask_bits` bits of the hash are all zero.
+    The hash only depends on the last ~32 characters, so an edit moves at most the
+    boundaries right around it and every other chunk keeps its exact content."""
+    lines = text.splitlines(keepends=True)
+    mask = (1 << mask_bits) - 1
+    chunks, chunk_start, size, rolling = [], 1, 0, 0
+    for line_no, line in enumerate(lines, start=1):
+        for char in line:
+            rolling = ((rolling << 1) + _GEAR[ord(char) & 0xFF]) & 0xFFFFFFFF
+        size += len(line)
+        is_boundary = size >= min_chars and (rolling >> 8) & mask == 0
+        if is_boundary or size >= max_chars:
+            chunks.append((chunk_start, line_no))
+            chunk_start, size = line_no + 1, 0
+    if chunk_start <= len(lines):
+        chunks.append((chunk_start, len(lines)))
+
+    result = []
+    for start, end in chunks:
+        if _size(lines, start, end) > max_chars:
+            result.extend(_split_range(lines, start, end, max_chars)) # a single very long line
+        else:
+            result.append(Chunk("".join(lines[start - 1:end]), start, end))
+    return [chunk for chunk in result if chunk.text.strip()]
+
+
+# Extension -> chunker. Anything else uses chunk_lines; register_chunker plugs in more.
+CHUNKERS: Dict[str, Callable[[str, int], List[Chunk]]] = {
+    ".py": chunk_python,
+    ".js": chunk_braces,
+    ".jsx": chunk_braces,
+    ".ts": chunk_braces,
+    ".tsx": chunk_braces,
+    ".css": chunk_braces,
+    ".java": partial(chunk_braces, base_depth=1),
+    ".cs": partial(chunk_braces, base_depth=1),
+    ".md": chunk_markdown,
+}
+
+
+def register_chunker(extension: str, chunker: Callable[[str, int], List[Chunk]]):
+    CHUNKERS[extension.lower()] = chunker
+
+
+def chunk_file(path: str, text: str, max_chars: int = DEFAULT_MAX_CHARS) -> List[Chunk]:
+    chunker = CHUNKERS.get(os.path.splitext(path)[1].lower(), chunk_lines)
+    return chunker(text, max_chars)
@@ -0,0 +1,123 @@
+from typing import List, NamedTuple, Optional
+import os
+import re
+
+DEFAULT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "2000"))
+CHARS_PER_TOKEN = 4 # close enough for code and English with Gemini's tokenizer
+NEAR_DUPLICATE_SIMILARITY = 0.9
+MIN_STITCH_CHARS = 20 # shorter common prefixes/suffixes are coincidences, not chunk overlap
+MAX_STITCH_CHARS = 2000
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class Block(NamedTuple):
+    path: str
+    start_line: Optional[int]
+    end_line: Optional[int]
+    last_chunk_index: Optional[int]
+    text: str
+    rank: int # best retrieval rank among the chunks merged into it
+
+
+def _stitch(first: str, second: str) -> Optional[str]:
+    """Join two texts on the longest suffix of `first` that starts `second`
+    (the overlap of fixed-size windows), or None if they don't overlap"""
+    for size in range(min(len(first), len(second), MAX_STITCH_CHARS), MIN_STITCH_CHARS - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return None
+
+
+def _merge(block: Block, nxt: Block) -> Optional[Block]:
+    """Merge two blocks of the same file that touch or overlap, else None"""
+    by_index = block.last_chunk_index is not None and nxt.last_chunk_index is not None and \
+        nxt.last_chunk_index == block.last_chunk_index + 1
+    by_lines = None not in (block.end_line, nxt.start_line) and nxt.start_line <= block.end_line + 1
+    if not (by_index or by_lines):
+        return None
+
+    overlapping = by_lines and nxt.start_line <= block.end_line
+    text = _stitch(block.text, nxt.text) if overlapping or not by_lines else None
+    if text is None and overlapping:
+        # Whole-line chunks: skip the lines already in `block`
+        text = block.text + "".join(nxt.text.splitlines(keepends=True)[block.end_line - nxt.start_line + 1:])
+    elif text is None:
+        text = (block.text if block.text.endswith("\n") else block.text + "\n") + nxt.text
+    end_line = max(filter(None, (block.end_line, nxt.end_line)), default=None)
+    return Block(block.path, block.start_line, end_line, nxt.last_chunk_index, text, min(block.rank, nxt.rank))
+
+
+def _line_set(text: str) -> set:
+    return {re.sub(r"\s+", " ", line).strip() for line in text.splitlines() if line.strip()}
+
+
+def _is_near_duplicate(lines: set, kept: List[set]) -> bool:
+    for other in kept:
+        union = len(lines | other)
+        if union and len(lines & other) / union >= NEAR_DUPLICATE_SIMILARITY:
+            return True
+    return False
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    """Cut at the last line break that fits"""
+    cut = text.rfind("\n", 0, max_chars)
+    return text[:cut + 1] if cut > 0 else text[:max_chars]
+
+
+def pack_context(documents: List[str], metadatas: List[dict], token_budget: int = DEFAULT_TOKEN_BUDGET) -> str:
+    """Turn ranked search hits into prompt context.
+
+    Chunks of the same file that are adjacent (consecutive chunk_index) or
+    overlapping (line ranges) are merged into one block, blocks whose lines
+    mostly repeat a better-ranked block are dropped, and blocks are added best
+    rank first until `token_budget` is spent. The result lists blocks by file
+    and line, each under a "# path (lines a-b)" header, separated by "---".
+    """
+    hits = [
+        Block(
+            (metadata or {}).get("path", ""),
+            (metadata or {}).get("start_line"),
+            (metadata or {}).get("end_line"),
+            (metadata or {}).get("chunk_index"),
+            document,
+            rank
+        )
+        for rank, (document, metadata) in enumerate(zip(documents, metadatas))
+    ]
+
+    blocks = []
+    ordered = sorted(hits, key=lambda hit: (hit.path, hit.start_line or 0, hit.last_chunk_index or 0))
+    for hit in ordered:
+        merged = _merge(blocks[-1], hit) if blocks and blocks[-1].path == hit.path else None
+        if merged is not None:
+            blocks[-1] = merged
+        else:
+            blocks.append(hit)
+
+    kept, kept_lines = [], []
+    remaining = token_budget * CHARS_PER_TOKEN
+    for block in sorted(blocks, key=lambda block: block.rank):
+        lines = _line_set(block.text)
+        if _is_near_duplicate(lines, kept_lines):
+            continue
+        if len(block.text) > remaining:
+            if remaining < 200: # not worth a fragment
+                break
+            block = block._replace(text=_truncate(block.text, remaining))
+            if block.start_line is not None:
+                block = block._replace(end_line=block.start_line + len(block.text.splitlines()) - 1)
+        kept.append(block)
+        kept_lines.append(lines)
+        remaining -= len(block.text)
+
+    sections = []
+    for block in sorted(kept, key=lambda block: (block.path, block.start_line or 0)):
+        header = f"# {block.path}"
+        if block.start_line is not None and block.end_line is not None:
+            header += f" (lines {block.start_line}-{block.end_line})"
+        sections.append(f"{header}\n{block.text.rstrip()}")
+    return "\n---\n".join(sections)
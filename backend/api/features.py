@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from database import get_db
@@ -10,6 +11,7 @@ from typing import List, Optional
 from pydantic import BaseModel
 import random
 import os
+import json
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -316,13 +318,47 @@ async def chat_with_senior_colleague(user_id: int, request: SeniorColleagueChatR
     if not user or not user.repo_full_name:
         return {"response": "I don't see a repository linked to your account. Have you completed onboarding yet?"}
         
-    response = await rag_engine.query(user_id, user.repo_full_name, request.message)
+    response = await rag_engine.query(user_id, user.repo_full_name, request.message, index_version=user.last_indexed_commit)
     return {"response": response}
 
+@router.post("/senior-colleague/chat/stream")
+async def stream_chat_with_senior_colleague(user_id: int, request: SeniorColleagueChatRequest, db: AsyncSession = Depends(get_db)):
+    """Server-sent events: {"delta": text} as the answer is generated, then a
+    final "done" event with the complete {"response": text}"""
+    from models import User
+    from .rag_utils import rag_engine
+    
+    stmt = select(User).where(User.id == user_id)
+    result = await db.execute(stmt)
+    user = result.scalar_one_or_none()
+    
+    async def events():
+        if not user or not user.repo_full_name:
+            pieces = ["I don't see a repository linked to your account. Have you completed onboarding yet?"]
+            yield f"data: {json.dumps({'delta': pieces[0]})}\n\n"
+        else:
+            pieces = []
+            async for piece in rag_engine.query_stream(user_id, user.repo_full_name, request.message, index_version=user.last_indexed_commit):
+                pieces.append(piece)
+                yield f"data: {json.dumps({'delta': piece})}\n\n"
+        yield f"event: done\ndata: {json.dumps({'response': ''.join(pieces)})}\n\n"
+    
+    # No proxy buffering, or the first tokens would only show up with the last ones
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/senior-colleague/cache-stats")
+async def senior_colleague_cache_stats():
+    from .rag_utils import rag_engine
+    return rag_engine.cache_stats()
+
 @router.post("/senior-colleague/sync")
 async def sync_senior_colleague(user_id: int, db: AsyncSession = Depends(get_db)):
+    """Start a GitHub sync in the background and return its job id right away.
+    Progress arrives as "indexing_progress" socket events and from /senior-colleague/jobs/{job_id}."""
     from models import User
+    from database import AsyncSessionLocal
     from .rag_utils import rag_engine
+    from .job_utils import indexing_jobs
     
     stmt = select(User).where(User.id == user_id)
     result = await db.execute(stmt)
@@ -330,9 +366,35 @@ async def sync_senior_colleague(user_id: int, db: AsyncSession = Depends(get_db)
     
     if not user or not user.repo_full_name or not user.access_token:
          return {"success": False, "message": "Missing repository or access token"}
-         
-    success = await rag_engine.sync_with_github(user_id, user.repo_full_name, user.access_token, db)
-    return {"success": success}
+    
+    repo_full_name, access_token = user.repo_full_name, user.access_token
+    
+    async def sync(job):
+        # The request's session is closed by the time the job runs
+        async with AsyncSessionLocal() as session:
+            return await rag_engine.sync_with_github(
+                user_id, repo_full_name, access_token, session,
+                progress=lambda **counters: indexing_jobs.report(job, **counters)
+            )
+    
+    job = indexing_jobs.submit(user_id, repo_full_name, "sync", sync)
+    return {"success": True, "job_id": job.id, "status": job.status}
+
+@router.get("/senior-colleague/jobs/{job_id}")
+async def get_indexing_job(job_id: str):
+    from .job_utils import indexing_jobs
+    job = indexing_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Indexing job not found")
+    return job.to_dict()
+
+@router.post("/senior-colleague/jobs/{job_id}/cancel")
+async def cancel_indexing_job(job_id: str):
+    from .job_utils import indexing_jobs
+    job = indexing_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Indexing job not found")
+    return {"success": indexing_jobs.cancel(job_id), "job_id": job_id}
 
 import time
 
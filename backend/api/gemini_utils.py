@@ -0,0 +1,226 @@
+from typing import AsyncIterator, Callable, Optional
+import asyncio
+import logging
+import os
+from dotenv import load_dotenv
+from google import genai
+from .cache_utils import ResponseCache
+from .context_utils import estimate_tokens
+from .resilience_utils import RETRY_MAX_ATTEMPTS, CircuitOpen, call_with_retries, circuit_breaker, error_status, is_retryable, single_flight
+from .scheduler_utils import RequestScheduler
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+MAX_CONCURRENT_CALLS = int(os.getenv("GEMINI_MAX_CONCURRENT_CALLS", "8"))
+TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "60"))
+UPLOAD_TIMEOUT_SECONDS = float(os.getenv("GEMINI_UPLOAD_TIMEOUT_SECONDS", "300"))
+
+# Quota the scheduler keeps us under (0 disables a limit). Requests are admitted by
+# priority: "interactive" (Senior Colleague chat, PR review), "normal", "background"
+REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "60"))
+TOKENS_PER_MINUTE = float(os.getenv("GEMINI_TOKENS_PER_MINUTE", "1000000"))
+BACKGROUND_MAX_WAIT_SECONDS = float(os.getenv("GEMINI_BACKGROUND_MAX_WAIT_SECONDS", "30")) # proactive chatter older than this is pointless
+OUTPUT_TOKEN_ESTIMATE = 500 # charged up front, corrected from usage_metadata afterwards
+FILE_TOKEN_ESTIMATE = 2000 # per uploaded audio/video part
+
+RESPONSE_CACHE_ENABLED = os.getenv("GEMINI_RESPONSE_CACHE", "1") != "0"
+RESPONSE_CACHE_PATH = os.getenv(
+    "GEMINI_RESPONSE_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm_cache", "responses.sqlite3")
+)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+# Call sites whose prompt fully determines a good answer, and how long (seconds) that answer is reused
+RESPONSE_CACHE_TTLS = {
+    "pr_review": 7 * 24 * 3600, # the diff is part of the prompt
+    "standup_truthfulness": 7 * 24 * 3600,
+    "coworker_update": 6 * 3600, # the same four updates all morning, fresh ones the next day
+}
+# Comma-separated call sites that should always reach the model, e.g. "coworker_update"
+RESPONSE_CACHE_DISABLED_SITES = {site.strip() for site in os.getenv("GEMINI_RESPONSE_CACHE_DISABLED_SITES", "").split(",") if site.strip()}
+
+# One client for the whole process; every call goes through its async surface (client.aio)
+# so a slow generation never blocks the event loop
+client = None
+if GEMINI_API_KEY:
+    client = genai.Client(api_key=GEMINI_API_KEY, http_options={'api_version': 'v1beta'})
+
+_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CALLS)
+_stats = {"calls": 0, "in_flight": 0, "timeouts": 0, "errors": 0}
+scheduler = RequestScheduler(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+_response_cache: Optional[ResponseCache] = None
+
+
+class GeminiUnavailable(RuntimeError):
+    """No API key is configured"""
+
+
+def response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES)
+    return _response_cache
+
+
+def _client():
+    if client is None:
+        raise GeminiUnavailable("Gemini API key not configured")
+    return client
+
+
+def _request_tokens(contents, output_tokens: int = OUTPUT_TOKEN_ESTIMATE) -> int:
+    """Tokens charged to the scheduler up front for a request's contents and reply"""
+    parts = contents if isinstance(contents, list) else [contents]
+    return output_tokens + sum(estimate_tokens(part) if isinstance(part, str) else FILE_TOKEN_ESTIMATE for part in parts)
+
+
+def _used_tokens(response) -> Optional[int]:
+    total = getattr(getattr(response, "usage_metadata", None), "total_token_count", None)
+    return total if isinstance(total, int) else None
+
+
+async def _scheduled(endpoint: str, make_call, timeout: float, priority: str, tokens: int, max_wait: Optional[float],
+                     attempts: int = RETRY_MAX_ATTEMPTS):
+    """Make the request through the endpoint's circuit breaker and retries; every
+    attempt waits for the scheduler to admit it"""
+    async def attempt():
+        await scheduler.acquire(priority, tokens, max_wait)
+        return await _call(make_call, timeout)
+
+    response = await call_with_retries(endpoint, attempt, attempts)
+    scheduler.settle(tokens, _used_tokens(response))
+    return response
+
+
+async def _call(make_call, timeout: float):
+    """Await one client.aio call under the global concurrency cap and a timeout"""
+    async with _semaphore:
+        _stats["calls"] += 1
+        _stats["in_flight"] += 1
+        try:
+            return await asyncio.wait_for(make_call(), timeout)
+        except asyncio.TimeoutError:
+            _stats["timeouts"] += 1
+            logger.warning(f"Gemini call timed out after {timeout:.0f}s")
+            raise
+        except Exception:
+            _stats["errors"] += 1
+            raise
+        finally:
+            _stats["in_flight"] -= 1
+
+
+async def generate_content(contents, model: Optional[str] = None, config=None, timeout: float = TIMEOUT_SECONDS,
+                           priority: str = "normal", max_wait: Optional[float] = None):
+    """`priority` and `max_wait` (seconds the request may queue before it is dropped
+    with RequestDropped) go to the rate-limiting scheduler"""
+    gemini = _client()
+    return await _scheduled(
+        "gemini.generate",
+        lambda: gemini.aio.models.generate_content(model=model or MODEL, contents=contents, config=config),
+        timeout, priority, _request_tokens(contents), max_wait
+    )
+
+
+async def generate_text(contents, model: Optional[str] = None, config=None, timeout: float = TIMEOUT_SECONDS,
+                        cache_site: Optional[str] = None, cache_check: Optional[Callable[[str], bool]] = None,
+                        priority: str = "normal", max_wait: Optional[float] = None) -> str:
+    """Generate and return the reply text. With `cache_site` (a key of RESPONSE_CACHE_TTLS)
+    a text prompt is answered from the response cache when possible, and a fresh reply is
+    stored for that site's TTL if `cache_check` (when given) accepts it. Concurrent
+    calls with the same text prompt and priority are coalesced into one request."""
+    if not isinstance(contents, str): # uploaded files: neither cached nor coalesced
+        return (await generate_content(contents, model, config, timeout, priority, max_wait)).text
+
+    key = ResponseCache.key(model or MODEL, contents, config)
+    cached_site = cache_site and RESPONSE_CACHE_ENABLED and cache_site not in RESPONSE_CACHE_DISABLED_SITES
+    if cached_site:
+        ttl_seconds = RESPONSE_CACHE_TTLS[cache_site]
+        cached = response_cache().get(key, cache_site)
+        if cached is not None:
+            return cached
+
+    async def generate() -> str:
+        text = (await generate_content(contents, model, config, timeout, priority, max_wait)).text
+        if cached_site and text and (cache_check is None or cache_check(text)):
+            response_cache().put(key, text, ttl_seconds, cache_site)
+        return text
+
+    # Identical prompts already in flight share that call's reply
+    return await single_flight("gemini").do((key, priority), generate)
+
+
+async def generate_content_stream(contents, model: Optional[str] = None, config=None, timeout: float = TIMEOUT_SECONDS,
+                                  priority: str = "normal", max_wait: Optional[float] = None) -> AsyncIterator:
+    """Yield response chunks; `timeout` applies to the wait for each chunk, and the
+    concurrency slot is held until the stream ends. Streams share the generate
+    endpoint's circuit breaker but are not retried, as chunks may already be out."""
+    gemini = _client()
+    breaker = circuit_breaker("gemini.generate")
+    if not breaker.allow():
+        raise CircuitOpen(breaker.name, breaker.retry_after())
+    await scheduler.acquire(priority, _request_tokens(contents), max_wait)
+    async with _semaphore:
+        _stats["calls"] += 1
+        _stats["in_flight"] += 1
+        try:
+            stream = await asyncio.wait_for(gemini.aio.models.generate_content_stream(model=model or MODEL, contents=contents, config=config), timeout)
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout)
+                except StopAsyncIteration:
+                    breaker.record_success()
+                    return
+                yield chunk
+        except asyncio.TimeoutError:
+            _stats["timeouts"] += 1
+            breaker.record_failure()
+            logger.warning(f"Gemini stream stalled for {timeout:.0f}s")
+            raise
+        except Exception as e:
+            _stats["errors"] += 1
+            if is_retryable(e):
+                breaker.record_failure()
+            elif error_status(e) is not None:
+                breaker.record_success()
+            raise
+        finally:
+            breaker.record_neutral()
+            _stats["in_flight"] -= 1
+
+
+async def embed_content(contents, model: str, config=None, timeout: float = TIMEOUT_SECONDS,
+                        priority: str = "normal", max_wait: Optional[float] = None, attempts: int = RETRY_MAX_ATTEMPTS):
+    gemini = _client()
+    return await _scheduled(
+        "gemini.embed",
+        lambda: gemini.aio.models.embed_content(model=model, contents=contents, config=config),
+        timeout, priority, _request_tokens(contents, output_tokens=0), max_wait, attempts
+    )
+
+
+async def upload_file(path: str, mime_type: str):
+    gemini = _client()
+    return await call_with_retries("gemini.files", lambda: _call(lambda: gemini.aio.files.upload(file=path, config={'mime_type': mime_type}), UPLOAD_TIMEOUT_SECONDS))
+
+
+async def get_file(name: str):
+    gemini = _client()
+    return await call_with_retries("gemini.files", lambda: _call(lambda: gemini.aio.files.get(name=name), TIMEOUT_SECONDS))
+
+
+async def delete_file(name: str):
+    gemini = _client()
+    return await call_with_retries("gemini.files", lambda: _call(lambda: gemini.aio.files.delete(name=name), TIMEOUT_SECONDS))
+
+
+def stats() -> dict:
+    return {
+        **_stats,
+        "max_concurrent": MAX_CONCURRENT_CALLS,
+        "scheduler": scheduler.stats(),
+        "response_cache": _response_cache.stats() if _response_cache is not None else None
+    }
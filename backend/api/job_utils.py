@@ -0,0 +1,141 @@
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+from .socket_instance import sio
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_JOBS = int(os.getenv("RAG_INDEX_MAX_CONCURRENT_JOBS", "2"))
+JOB_HISTORY = int(os.getenv("RAG_INDEX_JOB_HISTORY", "200")) # finished jobs kept for status lookups
+PROGRESS_INTERVAL_SECONDS = 0.5 # progress events are throttled; state changes always go out
+
+ACTIVE_STATES = ("queued", "running")
+
+
+class IndexingJob:
+    def __init__(self, user_id: int, repo_full_name: str, kind: str):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.repo_full_name = repo_full_name
+        self.kind = kind
+        self.status = "queued"
+        self.progress = {"files_total": 0, "files_fetched": 0, "chunks_total": 0, "chunks_embedded": 0}
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self._last_emit = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE_STATES
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "user_id": self.user_id,
+            "repo_full_name": self.repo_full_name,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IndexingJobManager:
+    """Runs indexing work (full index, GitHub sync) as in-process asyncio tasks.
+
+    At most one job per user and repository is active at a time: submitting
+    while one is queued or running returns that job. A global semaphore caps how
+    many jobs run at once. Every state change and (throttled) progress update is
+    broadcast as an "indexing_progress" Socket.IO event carrying the job dict.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_JOBS, history: int = JOB_HISTORY):
+        self.max_concurrent = max_concurrent
+        self.history = history
+        self.jobs: "OrderedDict[str, IndexingJob]" = OrderedDict()
+        self._active: Dict[Tuple[int, str], str] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def submit(self, user_id: int, repo_full_name: str, kind: str, work: Callable[[IndexingJob], Awaitable]) -> IndexingJob:
+        """Start `work(job)` in the background, or return the job already active for this user/repo.
+        `work` reports progress through `job_manager.report(job, ...)` and may return False to mark the job failed."""
+        key = (user_id, repo_full_name)
+        active_id = self._active.get(key)
+        if active_id is not None and self.jobs[active_id].active:
+            logger.info(f"Indexing job {active_id} already active for user {user_id}, not starting another {kind}")
+            return self.jobs[active_id]
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        job = IndexingJob(user_id, repo_full_name, kind)
+        self.jobs[job.id] = job
+        self._active[key] = job.id
+        self._prune()
+        job.task = asyncio.create_task(self._run(job, work))
+        return job
+
+    def get(self, job_id: str) -> Optional[IndexingJob]:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; False if it is unknown or already finished"""
+        job = self.jobs.get(job_id)
+        if job is None or not job.active or job.task is None:
+            return False
+        job.task.cancel()
+        return True
+
+    async def report(self, job: IndexingJob, **counters: int):
+        """Update progress counters (files_total, files_fetched, chunks_total, chunks_embedded)"""
+        job.progress.update(counters)
+        now = time.monotonic()
+        if now - job._last_emit >= PROGRESS_INTERVAL_SECONDS:
+            await self._emit(job)
+
+    async def _emit(self, job: IndexingJob):
+        job._last_emit = time.monotonic()
+        try:
+            await sio.emit("indexing_progress", job.to_dict())
+        except Exception as e:
+            logger.warning(f"Could not emit progress for indexing job {job.id}: {e}")
+
+    async def _run(self, job: IndexingJob, work: Callable[[IndexingJob], Awaitable]):
+        try:
+            await self._emit(job)
+            async with self._semaphore:
+                job.status = "running"
+                job.started_at = time.time()
+                await self._emit(job)
+                result = await work(job)
+            job.status = "failed" if result is False else "completed"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+            logger.info(f"Indexing job {job.id} for user {job.user_id} cancelled")
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            logger.error(f"Indexing job {job.id} for user {job.user_id} failed: {e}")
+        finally:
+            job.finished_at = time.time()
+            if self._active.get((job.user_id, job.repo_full_name)) == job.id:
+                del self._active[(job.user_id, job.repo_full_name)]
+            await self._emit(job)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if not job.active]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+
+indexing_jobs = IndexingJobManager()
@@ -42,21 +42,25 @@ async def generate_repository(request: RepoRequest, user_id: int, background_tas
     repo_name = request.repo_name or project.get("repo_name", "my-simulation-project")
     
     import httpx
+    from .resilience_utils import CircuitOpen, call_with_retries
     async with httpx.AsyncClient() as client:
-        # Create Repo
-        response = await client.post(
-            "https://api.github.com/user/repos",
-            headers={
-                "Authorization": f"token {user.access_token}",
-                "Accept": "application/vnd.github.v3+json"
-            },
-            json={
-                "name": repo_name,
-                "private": False,
-                "description": f"{project.get('project_name', 'Simulation')} - Generated for The New Hire",
-                "auto_init": True
-            }
-        )
+        # Create Repo (not retried: a retry after a lost response would report "already exists")
+        try:
+            response = await call_with_retries("github.api", lambda: client.post(
+                "https://api.github.com/user/repos",
+                headers={
+                    "Authorization": f"token {user.access_token}",
+                    "Accept": "application/vnd.github.v3+json"
+                },
+                json={
+                    "name": repo_name,
+                    "private": False,
+                    "description": f"{project.get('project_name', 'Simulation')} - Generated for The New Hire",
+                    "auto_init": True
+                }
+            ), attempts=1)
+        except CircuitOpen:
+            raise HTTPException(status_code=503, detail="GitHub is unavailable right now, please try again shortly")
         
         if response.status_code not in [200, 201]:
             if response.status_code == 422:
@@ -75,18 +79,21 @@ async def generate_repository(request: RepoRequest, user_id: int, background_tas
         # Helper function to push file to GitHub
         async def push_file(path: str, content: str, message: str):
             encoded = base64.b64encode(content.encode()).decode()
-            result = await client.put(
-                f"https://api.github.com/repos/{user.username}/{repo_name}/contents/{path}",
-                headers={
-                    "Authorization": f"token {user.access_token}",
-                    "Accept": "application/vnd.github.v3+json"
-                },
-                json={
-                    "message": message,
-                    "content": encoded
-                }
-            )
-            return result
+            try:
+                return await call_with_retries("github.api", lambda: client.put(
+                    f"https://api.github.com/repos/{user.username}/{repo_name}/contents/{path}",
+                    headers={
+                        "Authorization": f"token {user.access_token}",
+                        "Accept": "application/vnd.github.v3+json"
+                    },
+                    json={
+                        "message": message,
+                        "content": encoded
+                    }
+                ), attempts=1) # creating a file is not idempotent: a retry after a lost response gets 422
+            except (CircuitOpen, httpx.HTTPError) as e:
+                print(f"Failed to push {path}: {e}")
+                return None
         
         # Push all generated files
         files = project.get("files", {})
@@ -146,11 +153,16 @@ jobs:
 
         # Trigger RAG indexing in background
         from .rag_utils import rag_engine
-        background_tasks.add_task(
-            rag_engine.index_files,
-            user.id,
+        from .job_utils import indexing_jobs
+        user_id = user.id
+        indexing_job = indexing_jobs.submit(
+            user_id,
             repo_full_name,
-            files
+            "index",
+            lambda job: rag_engine.index_files(
+                user_id, repo_full_name, files,
+                progress=lambda **counters: indexing_jobs.report(job, **counters)
+            )
         )
 
         from .activity import log_activity
@@ -173,7 +185,8 @@ jobs:
             "repo_url": repo_url,
             "project_name": project.get("project_name"),
             "tickets_created": len(created_tickets),
-            "is_fallback": project.get("is_fallback", False)
+            "is_fallback": project.get("is_fallback", False),
+            "indexing_job_id": indexing_job.id
         }
 
 @router.get("/checklist")
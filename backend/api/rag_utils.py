@@ -1,63 +1,839 @@
 import os
 from dotenv import load_dotenv
 load_dotenv()
-from google import genai
 import asyncio
 import httpx
 import base64
-from typing import List, Dict
+import hashlib
+import io
+import tarfile
+import time
+import atexit
+import threading
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Iterable, Optional
 import json
 import logging
+import re
+from contextlib import contextmanager
 import numpy as np
+try:
+    import fcntl
+except ImportError: # Windows: no cross-process catalog lock, run a single worker
+    fcntl = None
+from .vector_utils import IVFIndex, DecodedRows, ProductQuantizer, ScalarQuantizer, load_quantizer, quantization_recall, save_quantizer
+from . import gemini_utils
+from .cache_utils import EmbeddingCache, TTLCache, normalize_query
+from .chunk_utils import chunk_file, chunk_content_defined
+from .context_utils import estimate_tokens, pack_context
+from .resilience_utils import call_with_retries
+from .search_utils import BM25Index, PathFilterIndex, find_identifier, infer_where, reciprocal_rank_fusion
 
 logger = logging.getLogger(__name__)
 
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Awaited with counters such as files_total, files_fetched, chunks_total, chunks_embedded
+ProgressCallback = Callable[..., Awaitable[None]]
+
 EMBEDDING_MODEL = "text-embedding-004"
 
-client = None
-if GEMINI_API_KEY:
-    client = genai.Client(api_key=GEMINI_API_KEY, http_options={'api_version': 'v1beta'})
+# persistent storage for SimpleVectorDB: one directory of immutable segments, each a float32
+# matrix (.npy), its L2-normalized copy (.norm.npy), a JSON sidecar (ids, documents, metadatas)
+# and, for large collections, the IVF index built for it (.ivf.npz).
+# Every persist writes a new segment "<collection>@<n>" and then points the catalog at it, so
+# all uvicorn workers can memory-map the same read-only files.
+DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "simple_vector_db")
+MATRIX_SUFFIX = ".npy"
+NORMALIZED_SUFFIX = ".norm.npy"
+SIDECAR_SUFFIX = ".meta.json"
+ANN_SUFFIX = ".ivf.npz"
+QUANTIZER_SUFFIX = ".quant.npz"
+CATALOG_FILE = "catalog.json" # {collection_name: {"rows", "dim", "segment"}}, read at startup instead of every collection
+# How often a worker stats the catalog to pick up segments published by other workers
+REFRESH_INTERVAL_SECONDS = float(os.getenv("RAG_REFRESH_INTERVAL_SECONDS", "1"))
+
+# Loaded collections are kept under this budget; the least recently used clean ones are dropped
+MEMORY_BUDGET_BYTES = int(float(os.getenv("RAG_MEMORY_BUDGET_MB", "512")) * 1024 * 1024)
+
+# Collections with at least this many chunks are searched through an IVF index;
+# smaller ones use the exact scan. RAG_ANN_N_PROBE trades recall for latency.
+ANN_MIN_ROWS = int(os.getenv("RAG_ANN_MIN_ROWS", "2048"))
+ANN_N_PROBE = int(os.getenv("RAG_ANN_N_PROBE", "8"))
+
+# Default in-memory representation of collection vectors (SimpleVectorDB.set_quantization
+# overrides it per collection): "none" keeps a float32 normalized copy, "int8" scalar-quantizes
+# it (4x smaller), "pq" product-quantizes it (RAG_PQ_SUB_DIM dims per byte, 16x smaller at 4).
+# Quantized searches re-rank the best n_results * RAG_RERANK_FACTOR (RAG_PQ_RERANK_FACTOR for pq)
+# candidates exactly. On isotropic 768-dim vectors pq at sub_dim 4 / factor 8 keeps recall@10 near
+# 0.98; sub_dim 8 / factor 4 drops it to about 0.7. Codebooks and codes are trained off the event
+# loop and saved with the segment (.quant.npz).
+QUANTIZATION_MODES = ("none", "int8", "pq")
+QUANTIZATION = os.getenv("RAG_QUANTIZATION", "none")
+PQ_SUB_DIM = int(os.getenv("RAG_PQ_SUB_DIM", "4"))
+RERANK_FACTOR = int(os.getenv("RAG_RERANK_FACTOR", "4"))
+PQ_RERANK_FACTOR = int(os.getenv("RAG_PQ_RERANK_FACTOR", "8"))
+RERANK_MIN_CANDIDATES = 32 # exact re-scoring of a few dozen rows costs next to nothing
+
+# Embedding requests: chunks per request, batches in flight, attempts per batch
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "100"))
+EMBED_CONCURRENCY = int(os.getenv("RAG_EMBED_CONCURRENCY", "4"))
+EMBED_MAX_ATTEMPTS = int(os.getenv("RAG_EMBED_MAX_ATTEMPTS", "3"))
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("RAG_EMBED_CACHE_MAX_ENTRIES", "50000"))
+
+# Senior Colleague query caches: embeddings of normalized questions, and final answers per
+# (collection version, normalized question). Answers also expire after the TTL.
+QUERY_EMBED_CACHE_MAX_ENTRIES = int(os.getenv("RAG_QUERY_EMBED_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("RAG_ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("RAG_ANSWER_CACHE_TTL_SECONDS", "3600"))
+FOGGY_ANSWER = "I'm sorry, my AI brain is a bit foggy right now. Try again in a second?"
+
+# GitHub sync: which files are worth indexing and how they are fetched
+INDEXED_EXTENSIONS = (".py", ".js", ".ts", ".tsx", ".html", ".css", ".md", ".json", ".java", ".cs")
+VENDORED_DIRS = {"node_modules", "vendor", "dist", "build", ".git", "__pycache__", "venv", ".venv", "bower_components", "coverage"}
+LOCKFILES = {"package-lock.json", "yarn.lock", "pnpm-lock.yaml", "poetry.lock", "Pipfile.lock", "composer.lock", "Cargo.lock"}
+MAX_FILE_BYTES = int(os.getenv("RAG_MAX_FILE_KB", "256")) * 1024
+MAX_ARCHIVE_BYTES = int(os.getenv("RAG_MAX_ARCHIVE_MB", "64")) * 1024 * 1024
+# Syncs that need more changed files than this download the tarball instead of single blobs
+ARCHIVE_MIN_FILES = int(os.getenv("RAG_ARCHIVE_MIN_FILES", "20"))
+BLOB_FETCH_CONCURRENCY = int(os.getenv("RAG_BLOB_FETCH_CONCURRENCY", "8"))
+
+# "syntax" splits at function/class/heading boundaries (api/chunk_utils.py), "fixed" uses chunk_text
+# windows, "cdc" uses content-defined boundaries and content-hash chunk ids so edits re-embed only nearby chunks
+CHUNKING_MODE = os.getenv("RAG_CHUNKING", "syntax")
+
+# Hybrid retrieval: vector and BM25 rankings are fused over this many candidates per result
+HYBRID_SEARCH = os.getenv("RAG_HYBRID_SEARCH", "1") != "0"
+HYBRID_CANDIDATES = int(os.getenv("RAG_HYBRID_CANDIDATES", "4"))
+
+
+class RowMatrix:
+    """Append-only matrix (float32 unless told otherwise) with amortised O(1) row appends.
+    `array` is a contiguous (N, d) view; the backing buffer grows by doubling."""
+
+    def __init__(self, initial: np.ndarray = None, dtype=np.float32):
+        self.dtype = dtype
+        self._buffer = initial if initial is not None else np.zeros((0, 0), dtype=dtype)
+        self._rows = len(self._buffer)
+
+    def __len__(self):
+        return self._rows
+
+    @property
+    def nbytes(self) -> int:
+        """Resident size; pages of a memmap belong to the OS page cache, not to us"""
+        return 0 if isinstance(self._buffer, np.memmap) else self._buffer.nbytes
+
+    @property
+    def array(self) -> np.ndarray:
+        return self._buffer[:self._rows]
+
+    def append(self, rows: np.ndarray):
+        rows = np.asarray(rows, dtype=self.dtype)
+        if self._rows and self._buffer.shape[1] != rows.shape[1]:
+            raise ValueError(f"Embedding dimension {rows.shape[1]} does not match collection dimension {self._buffer.shape[1]}")
+        needed = self._rows + len(rows)
+        if needed > len(self._buffer) or self._buffer.shape[1] != rows.shape[1] or not self._buffer.flags.writeable:
+            # Also taken on the first append to a read-only memmap: copy it into RAM
+            capacity = max(needed, 2 * len(self._buffer), 16)
+            buffer = np.empty((capacity, rows.shape[1]), dtype=self.dtype)
+            if self._rows:
+                buffer[:self._rows] = self._buffer[:self._rows]
+            self._buffer = buffer
+        self._buffer[self._rows:needed] = rows
+        self._rows = needed
+
+
+def l2_normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1e-9 # Avoid division by zero
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores in each row of a (Q, N) matrix, best first.
+    np.argpartition selects in O(N) before sorting only the k winners."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.zeros((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def _empty_collection(quantized: bool = False) -> dict:
+    return {
+        "ids": [],
+        "documents": [],
+        "metadatas": [],
+        "embeddings": RowMatrix(),
+        # L2-normalized copy of "embeddings" kept in step by add(); None means
+        # it has to be rebuilt (e.g. right after loading from disk). Quantized collections never build it.
+        "normalized": None if quantized else RowMatrix(),
+        "ann": None, # IVFIndex once the collection reaches ANN_MIN_ROWS; built off the event loop, saved with the segment
+        "bm25": None, # BM25Index over "documents", rebuilt after any change
+        "filters": None, # PathFilterIndex over the chunk paths for where= filters, same lifecycle
+        # Quantized collections hold these instead of "normalized"; rebuilt lazily after loading
+        "quantizer": None, # ScalarQuantizer / ProductQuantizer trained on the normalized rows
+        "codes": None, # RowMatrix of uint8 codes, one row per chunk
+        "files": {}, # {path: git blob sha} of every indexed file
+        "segment": None, # segment this data was loaded from or last published as
+    }
+
+
+def _atomic_write(path: str, write) -> None:
+    """Write through a temp file and os.replace so readers (and live memmaps
+    of the previous file) never see a half-written file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def segment_paths(store_dir: str, name: str, segment: Optional[int] = None):
+    """(matrix, normalized, sidecar) paths of a segment; segment None is the
+    unversioned layout written before segments existed"""
+    stem = os.path.join(store_dir, name if segment is None else f"{name}@{segment}")
+    return stem + MATRIX_SUFFIX, stem + NORMALIZED_SUFFIX, stem + SIDECAR_SUFFIX
+
+
+def segment_file(store_dir: str, name: str, segment: Optional[int], suffix: str) -> str:
+    """Path of one of a segment's optional files, e.g. its ANN_SUFFIX index"""
+    return os.path.join(store_dir, (name if segment is None else f"{name}@{segment}") + suffix)
+
+
+def write_collection(store_dir: str, name: str, embeddings: np.ndarray, ids: list, documents: list, metadatas: list, files: dict = None,
+                     ann: Optional[dict] = None, quantizer: Optional[dict] = None) -> int:
+    """Write a new immutable segment and return its number. Nothing reads it until it is published.
+    `ann` is IVFIndex.to_arrays() of an index over exactly these rows, `quantizer`
+    save_quantizer() of a quantizer and the codes of these rows."""
+    os.makedirs(store_dir, exist_ok=True)
+    segment = time.time_ns()
+    matrix_path, normalized_path, sidecar_path = segment_paths(store_dir, name, segment)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if embeddings.size:
+        _atomic_write(matrix_path, lambda f: np.save(f, embeddings))
+        _atomic_write(normalized_path, lambda f: np.save(f, l2_normalize(embeddings)))
+    if ann is not None:
+        _atomic_write(segment_file(store_dir, name, segment, ANN_SUFFIX), lambda f: np.savez(f, **ann))
+    if quantizer is not None:
+        _atomic_write(segment_file(store_dir, name, segment, QUANTIZER_SUFFIX), lambda f: np.savez(f, **quantizer))
+
+    sidecar = {"ids": ids, "documents": documents, "metadatas": metadatas, "files": files or {}}
+    _atomic_write(sidecar_path, lambda f: f.write(json.dumps(sidecar, separators=(",", ":")).encode("utf-8")))
+    return segment
+
+
+def read_collection(store_dir: str, name: str, segment: Optional[int] = None) -> dict:
+    matrix_path, normalized_path, sidecar_path = segment_paths(store_dir, name, segment)
+    with open(sidecar_path, "r") as f:
+        sidecar = json.load(f)
+
+    collection = _empty_collection()
+    collection.update(sidecar)
+    collection["segment"] = segment
+    if os.path.exists(matrix_path):
+        # Memory-mapped: only the pages a query touches are read from disk, and
+        # every worker process shares them through the page cache
+        collection["embeddings"] = RowMatrix(np.load(matrix_path, mmap_mode="r"))
+        collection["normalized"] = RowMatrix(np.load(normalized_path, mmap_mode="r")) if os.path.exists(normalized_path) else None
+    if len(collection["embeddings"]) != len(collection["ids"]):
+        # Unversioned stores replaced matrix and sidecar one after the other; a crash in between leaves them out of step
+        raise ValueError(f"Collection {name} has {len(collection['embeddings'])} vectors but {len(collection['ids'])} ids")
+    ann_path = segment_file(store_dir, name, segment, ANN_SUFFIX)
+    if os.path.exists(ann_path):
+        with np.load(ann_path) as arrays:
+            ann = IVFIndex.from_arrays(arrays)
+        if ann.size == len(collection["ids"]):
+            collection["ann"] = ann
+    quantizer_path = segment_file(store_dir, name, segment, QUANTIZER_SUFFIX)
+    if os.path.exists(quantizer_path):
+        with np.load(quantizer_path) as arrays:
+            quantizer, codes = load_quantizer(arrays)
+        if len(codes) == len(collection["ids"]):
+            collection["quantizer"], collection["codes"] = quantizer, RowMatrix(codes, dtype=np.uint8)
+    return collection
+
+
+def read_catalog(store_dir: str) -> dict:
+    catalog_path = os.path.join(store_dir, CATALOG_FILE)
+    if os.path.exists(catalog_path):
+        with open(catalog_path, "r") as f:
+            return json.load(f)
+
+    # Stores written before the catalog existed: collection names come from the sidecar files
+    catalog = {
+        filename[:-len(SIDECAR_SUFFIX)]: {}
+        for filename in os.listdir(store_dir) if filename.endswith(SIDECAR_SUFFIX) and "@" not in filename
+    }
+    write_catalog(store_dir, catalog)
+    return catalog
+
+
+def write_catalog(store_dir: str, catalog: dict) -> None:
+    os.makedirs(store_dir, exist_ok=True)
+    _atomic_write(
+        os.path.join(store_dir, CATALOG_FILE),
+        lambda f: f.write(json.dumps(catalog, separators=(",", ":")).encode("utf-8"))
+    )
+
+
+@contextmanager
+def _catalog_lock(store_dir: str):
+    """Serialises catalog updates across worker processes"""
+    os.makedirs(store_dir, exist_ok=True)
+    with open(os.path.join(store_dir, CATALOG_FILE + ".lock"), "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def publish_segment(store_dir: str, name: str, segment: int, entry: dict) -> dict:
+    """Point the catalog at a freshly written segment and return the updated catalog.
+    The catalog is re-read under the lock so entries published by other workers survive.
+    The previous segment is kept for readers that have not picked up the new one yet;
+    older ones are deleted (live memmaps of them stay valid)."""
+    with _catalog_lock(store_dir):
+        catalog = read_catalog(store_dir)
+        previous = catalog.get(name, {}).get("segment")
+        catalog[name] = dict(entry, segment=segment)
+        write_catalog(store_dir, catalog)
+
+    keep = {segment, previous}
+    suffixes = (NORMALIZED_SUFFIX, MATRIX_SUFFIX, SIDECAR_SUFFIX, ANN_SUFFIX, QUANTIZER_SUFFIX)
+    pattern = re.compile(rf"{re.escape(name)}(?:@(\d+))?({'|'.join(re.escape(suffix) for suffix in suffixes)})")
+    for filename in os.listdir(store_dir):
+        match = pattern.fullmatch(filename)
+        if match and (int(match.group(1)) if match.group(1) else None) not in keep:
+            try:
+                os.remove(os.path.join(store_dir, filename))
+            except OSError as e:
+                logger.warning(f"Could not remove old segment file {filename}: {e}")
+    return catalog
+
+
+def resident_bytes(collection: dict) -> int:
+    """Rough in-memory footprint of a loaded collection"""
+    total = collection["embeddings"].nbytes + sum(len(document) for document in collection["documents"])
+    if collection["normalized"] is not None:
+        total += collection["normalized"].nbytes
+    if collection["ann"] is not None:
+        total += collection["ann"].centroids.nbytes + sum(ids.nbytes for ids in collection["ann"].lists)
+    if collection["bm25"] is not None:
+        total += sum(doc_ids.nbytes + freqs.nbytes for doc_ids, freqs in collection["bm25"].postings.values())
+    if collection["filters"] is not None:
+        total += sum(mask.nbytes for mask in collection["filters"].extension_masks.values())
+    if collection["quantizer"] is not None:
+        total += collection["quantizer"].nbytes + collection["codes"].nbytes
+    return total
+
+
+def migrate_json_store(json_path: str, store_dir: str) -> int:
+    """One-shot conversion of the legacy simple_vector_db.json into the binary store.
+    Returns the number of migrated collections."""
+    with open(json_path, "r") as f:
+        legacy = json.load(f)
+
+    for name, collection in legacy.items():
+        embeddings = np.asarray(collection.get("embeddings") or [], dtype=np.float32)
+        if embeddings.ndim != 2:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        segment = write_collection(
+            store_dir,
+            name,
+            embeddings,
+            collection.get("ids", []),
+            collection.get("documents", []),
+            collection.get("metadatas", [])
+        )
+        publish_segment(store_dir, name, segment, {"rows": len(embeddings), "dim": int(embeddings.shape[1])})
+    logger.info(f"Migrated {len(legacy)} collections from {json_path} to {store_dir}")
+    return len(legacy)
+
+
+class PersistWorker:
+    """Writes collection snapshots to disk on a background thread.
+
+    Snapshots of the same collection queued before the thread gets to them are
+    coalesced, so back-to-back indexes only write the latest state once and
+    never block the event loop on disk I/O.
+    """
+
+    def __init__(self, store_dir: str, on_published=None):
+        self.store_dir = store_dir
+        self.on_published = on_published # called as (name, segment, catalog, tag) from the writer thread
+        self._pending = {} # {collection_name: (snapshot, catalog entry, tag)}
+        self._writing = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, name: str, snapshot: dict, entry: dict = None, tag=None):
+        """`tag` is handed back to on_published with the segment written from this snapshot"""
+        with self._cond:
+            self._pending[name] = (snapshot, entry or {}, tag)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="vector-db-persist", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def is_pending(self, name: str) -> bool:
+        with self._cond:
+            return name in self._pending or self._writing == name
+
+    def flush(self, timeout: float = None) -> bool:
+        """Block until everything submitted so far is on disk"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and self._writing is None, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending)
+                name = next(iter(self._pending))
+                snapshot, entry, tag = self._pending.pop(name)
+                self._writing = name
+            try:
+                segment = write_collection(self.store_dir, name, **snapshot)
+                catalog = publish_segment(self.store_dir, name, segment, entry)
+                if self.on_published is not None:
+                    self.on_published(name, segment, catalog, tag)
+                logger.info(f"Persisted collection {name} as segment {segment}")
+            except Exception as e:
+                logger.error(f"Failed to persist collection {name}: {e}")
+            finally:
+                with self._cond:
+                    self._writing = None
+                    self._cond.notify_all()
+
+
+class CollectionCache:
+    """Mapping of collection name -> collection data that loads collections from
+    disk on first access and keeps them in LRU order under a memory budget.
+    Membership and iteration come from the catalog, so nothing is read up front."""
+
+    def __init__(self, db: "SimpleVectorDB", budget_bytes: int):
+        self.db = db
+        self.budget_bytes = budget_bytes
+        self._loaded = OrderedDict()
+
+    def __contains__(self, name) -> bool:
+        return name in self._loaded or name in self.db.catalog
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def keys(self) -> List[str]:
+        return list(dict.fromkeys(list(self.db.catalog) + list(self._loaded)))
+
+    def loaded(self) -> List[str]:
+        return list(self._loaded)
+
+    def peek(self, name: str) -> Optional[dict]:
+        """The collection if it is in memory, without loading it or touching the LRU order"""
+        return self._loaded.get(name)
+
+    def drop(self, name: str):
+        self._loaded.pop(name, None)
+
+    def _read(self, name: str) -> dict:
+        collection = read_collection(self.db.persist_path, name, self.db.catalog[name].get("segment"))
+        if self.db.is_quantized(name):
+            collection["normalized"] = None
+        if collection["quantizer"] is not None and collection["quantizer"].mode != self.db.quantization(name):
+            collection["quantizer"] = collection["codes"] = None # saved under another mode
+        return collection
+
+    def __getitem__(self, name: str) -> dict:
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            return self._loaded[name]
+        if name not in self.db.catalog:
+            raise KeyError(name)
+
+        if self.db.persist_worker.is_pending(name):
+            self.db.persist_worker.flush() # don't read a file that is about to be replaced
+        try:
+            collection = self._read(name)
+        except Exception:
+            # Another worker may have published a newer segment and removed the one we knew about
+            self.db.refresh(force=True)
+            try:
+                collection = self._read(name)
+            except Exception as e:
+                # Dropped from the catalog; the next sync rebuilds it
+                logger.error(f"Failed to load collection {name}: {e}")
+                self.db.catalog.pop(name, None)
+                raise KeyError(name)
+        self[name] = collection
+        return collection
+
+    def __setitem__(self, name: str, collection: dict):
+        self._loaded[name] = collection
+        self._loaded.move_to_end(name)
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used collections until under budget. Dirty collections
+        and the most recently used one always stay."""
+        sizes = {name: resident_bytes(collection) for name, collection in self._loaded.items()}
+        total = sum(sizes.values())
+        for name in list(self._loaded)[:-1]:
+            if total <= self.budget_bytes:
+                break
+            if name in self.db.dirty or self.db.persist_worker.is_pending(name):
+                continue
+            del self._loaded[name]
+            total -= sizes[name]
+            logger.info(f"Evicted collection {name} from memory")
 
-# persistent storage for SimpleVectorDB
-DB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "simple_vector_db.json")
 
 class SimpleVectorDB:
-    def __init__(self, persist_path: str):
+    def __init__(self, persist_path: str, memory_budget_bytes: int = MEMORY_BUDGET_BYTES):
         self.persist_path = persist_path
-        self.data = {} # {collection_name: {"embeddings": [], "documents": [], "metadatas": [], "ids": []}}
+        self.legacy_path = f"{persist_path}.json"
+        self.catalog = {} # {collection_name: {"rows": int, "dim": int}} of everything on disk
+        self.data = CollectionCache(self, memory_budget_bytes) # {collection_name: {"embeddings": RowMatrix, "normalized": RowMatrix, "documents": [], "metadatas": [], "ids": []}}
+        self.dirty = set() # collections changed since they were last handed to the persist worker
+        self.versions = {} # {collection_name: int}, bumped on every change so caches keyed on it go stale
+        self.quantization_modes = {} # {collection_name: mode} set through set_quantization, else QUANTIZATION
+        self.persist_worker = PersistWorker(persist_path, on_published=self._published)
+        self._adoptable = {} # {collection_name: (segment, version)} published, not yet swapped in by _adopt_published
+        self._indexing = {} # {collection_name: asyncio.Task} building search indexes off the event loop
+        self._catalog_stamp = None # (mtime_ns, size) of the catalog file when it was last read
+        self._last_refresh = 0.0
         self.load()
 
     def load(self):
-        if os.path.exists(self.persist_path):
+        if not os.path.isdir(self.persist_path) and os.path.exists(self.legacy_path):
             try:
-                with open(self.persist_path, "r") as f:
-                    self.data = json.load(f)
-                logger.info(f"Loaded SimpleVectorDB with {len(self.data)} collections")
+                migrate_json_store(self.legacy_path, self.persist_path)
             except Exception as e:
-                logger.error(f"Failed to load vector DB: {e}")
-                self.data = {}
+                logger.error(f"Failed to migrate legacy vector DB: {e}")
+
+        if not os.path.isdir(self.persist_path):
+            return
 
-    def persist(self):
         try:
-            with open(self.persist_path, "w") as f:
-                json.dump(self.data, f)
-            logger.info("SimpleVectorDB persisted to disk")
+            self._catalog_stamp = self._stat_catalog()
+            self.catalog = read_catalog(self.persist_path)
         except Exception as e:
-            logger.error(f"Failed to persist vector DB: {e}")
+            logger.error(f"Failed to load vector DB catalog: {e}")
+            self.catalog = {}
+        self.quantization_modes = {name: entry["quantization"] for name, entry in self.catalog.items() if "quantization" in entry}
+        logger.info(f"Loaded SimpleVectorDB catalog with {len(self.catalog)} collections")
+
+    def _stat_catalog(self):
+        try:
+            stat = os.stat(os.path.join(self.persist_path, CATALOG_FILE))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self, force: bool = False):
+        """Pick up segments other workers published: at most once per
+        REFRESH_INTERVAL_SECONDS, a stat of the catalog, and a re-read only if it changed.
+        Collections with local unsaved changes keep their in-memory state."""
+        self._adopt_published()
+        now = time.monotonic()
+        if not force and now - self._last_refresh < REFRESH_INTERVAL_SECONDS:
+            return
+        self._last_refresh = now
+        stamp = self._stat_catalog()
+        if stamp is None or stamp == self._catalog_stamp:
+            return
+        try:
+            catalog = read_catalog(self.persist_path)
+        except Exception as e:
+            logger.error(f"Failed to refresh vector DB catalog: {e}")
+            return
+        self._catalog_stamp = stamp
+        for name, entry in catalog.items():
+            if name in self.dirty or self.persist_worker.is_pending(name):
+                continue
+            loaded = self.data.peek(name)
+            if loaded is not None and loaded["segment"] != entry.get("segment"):
+                self.data.drop(name) # reloaded from the new segment on next access
+                self.versions[name] = self.version(name) + 1
+                logger.info(f"Collection {name} was republished as segment {entry.get('segment')}")
+            if "quantization" in entry:
+                self.quantization_modes[name] = entry["quantization"]
+            self.catalog[name] = entry
+
+    def _published(self, name: str, segment: int, catalog: dict, version: int):
+        """Writer thread callback: `segment` holds the collection as of `version`"""
+        if name in self.catalog:
+            self.catalog[name]["segment"] = segment
+        collection = self.data.peek(name)
+        if collection is not None:
+            collection["segment"] = segment
+        self._adoptable[name] = (segment, version)
+
+    def _adopt_published(self):
+        """Swap the in-RAM matrices of collections that were just published for read-only
+        memmaps of their segment, as if they had been loaded from it. Runs on the event
+        loop, and only for collections unchanged since their snapshot was taken."""
+        while self._adoptable:
+            name, (segment, version) = self._adoptable.popitem()
+            collection = self.data.peek(name)
+            if collection is None or collection["segment"] != segment or self.version(name) != version or name in self.dirty:
+                continue
+            matrix_path, normalized_path, _ = segment_paths(self.persist_path, name, segment)
+            try:
+                embeddings = np.load(matrix_path, mmap_mode="r")
+                normalized = np.load(normalized_path, mmap_mode="r") if collection["normalized"] is not None else None
+            except (OSError, ValueError): # empty collection, or already replaced by a newer segment
+                continue
+            if len(embeddings) != len(collection["ids"]):
+                continue
+            collection["embeddings"] = RowMatrix(embeddings)
+            if normalized is not None:
+                collection["normalized"] = RowMatrix(normalized)
+
+    def mark_dirty(self, name: str):
+        self.dirty.add(name)
+        self.versions[name] = self.versions.get(name, 0) + 1
+
+    def version(self, name: str) -> int:
+        return self.versions.get(name, 0)
+
+    def persist(self):
+        """Queue every dirty collection for writing to its own files in the background"""
+        for name in list(self.dirty):
+            collection = self.data[name]
+            embeddings = self.embeddings(name)
+            rows = len(collection["ids"])
+            entry = {"rows": rows, "dim": int(embeddings.shape[1])}
+            ann = collection["ann"]
+            quantizer, codes = collection["quantizer"], collection["codes"]
+            if name in self.quantization_modes:
+                entry["quantization"] = self.quantization_modes[name]
+            self.catalog[name] = dict(entry, segment=self.catalog.get(name, {}).get("segment"))
+            # Lists are copied and the matrix view covers only the current rows,
+            # so later adds on the event loop cannot race the writer thread
+            self.persist_worker.submit(name, {
+                "embeddings": embeddings,
+                "ids": list(collection["ids"]),
+                "documents": list(collection["documents"]),
+                "metadatas": list(collection["metadatas"]),
+                "files": dict(collection["files"]),
+                "ann": ann.to_arrays() if ann is not None and ann.size == rows else None,
+                "quantizer": save_quantizer(quantizer, codes.array) if quantizer is not None and len(codes) == rows else None
+            }, entry, self.version(name))
+        self.dirty.clear()
+        self.data.evict()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Persist dirty collections and wait for the writes to finish"""
+        self.persist()
+        flushed = self.persist_worker.flush(timeout)
+        self._adopt_published()
+        return flushed
+
+    def embeddings(self, name: str) -> np.ndarray:
+        """Return the raw (N, d) float32 matrix of a collection"""
+        return self.data[name]["embeddings"].array
+
+    def normalized(self, name: str) -> np.ndarray:
+        """Return the L2-normalized (N, d) float32 matrix used for cosine search"""
+        collection = self.data[name]
+        if collection["normalized"] is None:
+            collection["normalized"] = RowMatrix(l2_normalize(collection["embeddings"].array))
+            self.data.evict()
+        return collection["normalized"].array
+
+    def quantization(self, name: str) -> str:
+        return self.quantization_modes.get(name, QUANTIZATION)
+
+    def is_quantized(self, name: str) -> bool:
+        return self.quantization(name) != "none"
+
+    def set_quantization(self, name: str, mode: str):
+        """Switch a collection between float32 ("none"), "int8" and "pq" search vectors"""
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode: {mode}")
+        collection = self.data[name]
+        self.quantization_modes[name] = mode
+        collection["normalized"] = collection["quantizer"] = collection["codes"] = None
+        self.mark_dirty(name) # the catalog records the mode
+
+    def rerank_factor(self, name: str) -> int:
+        return PQ_RERANK_FACTOR if self.quantization(name) == "pq" else RERANK_FACTOR
+
+    def quantized(self, name: str):
+        """Return (quantizer, codes) of a quantized collection, or None while its
+        quantizer is being trained off the event loop (see schedule_indexing). It is
+        retrained once the collection has doubled since; meanwhile the old one is used."""
+        collection = self.data[name]
+        if collection["quantizer"] is None or collection["quantizer"].is_stale(len(collection["ids"])):
+            self.schedule_indexing(name)
+        if collection["quantizer"] is None:
+            return None
+        return collection["quantizer"], collection["codes"].array
+
+    def exact_scores(self, name: str, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Cosine similarities of normalized queries against the raw matrix, (Q, N), without
+        a normalized copy of it: what quantized collections fall back to before training"""
+        embeddings = self.embeddings(name) if rows is None else self.embeddings(name)[rows]
+        norms = np.linalg.norm(embeddings, axis=1)
+        norms[norms == 0] = 1e-9
+        return (queries @ embeddings.T) / norms
+
+    def quantization_stats(self, name: str) -> dict:
+        collection = self.data[name]
+        stats = {"mode": self.quantization(name), "rows": len(collection["ids"]), "float32_bytes": collection["embeddings"].array.nbytes}
+        if collection["quantizer"] is not None:
+            stats.update(code_bytes=collection["codes"].nbytes, recall=collection["quantizer"].recall)
+        return stats
+
+    def row_vectors(self, name: str, rows: np.ndarray) -> np.ndarray:
+        """Exact normalized vectors of some rows; quantized collections read them from the raw matrix"""
+        if self.is_quantized(name):
+            return l2_normalize(self.embeddings(name)[rows])
+        return self.normalized(name)[rows]
+
+    def ann_index(self, name: str):
+        """Return the collection's IVF index, or None if the collection is small enough
+        for an exact scan or its index is not built yet. A missing or stale index is
+        (re)built off the event loop, see schedule_indexing; meanwhile queries scan."""
+        collection = self.data[name]
+        if len(collection["ids"]) < ANN_MIN_ROWS:
+            return None
+        if collection["ann"] is None or collection["ann"].is_stale():
+            self.schedule_indexing(name)
+        return collection["ann"]
+
+    def _indexing_job(self, name: str) -> Optional[Callable[[], Callable[[], None]]]:
+        """Work to bring the collection's search indexes up to date, or None if they are.
+        The returned `build` reads only a snapshot of the rows, so it can run in a thread;
+        it returns `install`, which must run on the event loop and drops the result if
+        the collection changed in the meantime."""
+        collection = self.data[name]
+        rows = len(collection["ids"])
+        mode = self.quantization(name)
+        need_ann = rows >= ANN_MIN_ROWS and (collection["ann"] is None or collection["ann"].is_stale())
+        need_quantizer = mode != "none" and rows > 0 and (collection["quantizer"] is None or collection["quantizer"].is_stale(rows))
+        if not (need_ann or need_quantizer):
+            return None
+        version = self.version(name)
+        embeddings = collection["embeddings"].array
+        normalized = collection["normalized"].array if collection["normalized"] is not None else None
+        rerank_factor = self.rerank_factor(name)
+
+        def build():
+            vectors = normalized if normalized is not None else l2_normalize(embeddings)
+            index = IVFIndex.build(vectors) if need_ann else None
+            quantizer = codes = None
+            if need_quantizer:
+                quantizer = ScalarQuantizer.train(vectors) if mode == "int8" else ProductQuantizer.train(vectors, PQ_SUB_DIM)
+                codes = quantizer.encode(vectors)
+                quantizer.recall = quantization_recall(quantizer, vectors, codes, rerank_factor=rerank_factor)
+                logger.info(
+                    f"Quantized collection {name} ({mode}): {codes.nbytes} bytes of codes for {vectors.nbytes} bytes of vectors, "
+                    f"recall@10 {quantizer.recall['adc']:.3f} ({quantizer.recall['reranked']:.3f} re-ranked)"
+                )
+
+            def install():
+                if self.data.peek(name) is not collection or self.version(name) != version:
+                    return
+                if index is not None:
+                    collection["ann"] = index
+                if quantizer is not None and self.quantization(name) == mode:
+                    collection["quantizer"], collection["codes"] = quantizer, RowMatrix(codes, dtype=np.uint8)
+                self.data.evict()
+            return install
+        return build
+
+    async def prepare(self, name: str):
+        """Build whatever search indexes the collection is missing, in a worker thread"""
+        build = self._indexing_job(name)
+        if build is not None:
+            install = await asyncio.to_thread(build)
+            install()
+
+    def schedule_indexing(self, name: str):
+        """Start prepare(name) in the background unless it is already running. Without a
+        running event loop (scripts, synchronous callers) there is nothing to block, so
+        the indexes are built in place."""
+        if name in self._indexing:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            build = self._indexing_job(name)
+            if build is not None:
+                build()()
+            return
+
+        async def run():
+            try:
+                await self.prepare(name)
+            except Exception as e:
+                logger.error(f"Building search indexes for {name} failed: {e}")
+            finally:
+                self._indexing.pop(name, None)
+        self._indexing[name] = loop.create_task(run())
+
+    def keyword_index(self, name: str) -> BM25Index:
+        """Return the collection's BM25 inverted index, building it if it is missing"""
+        collection = self.data[name]
+        if collection["bm25"] is None:
+            collection["bm25"] = BM25Index(collection["documents"])
+            self.data.evict()
+        return collection["bm25"]
+
+    def path_filter(self, name: str) -> PathFilterIndex:
+        """Return the collection's path masks for where= filters, building them if missing"""
+        collection = self.data[name]
+        if collection["filters"] is None:
+            collection["filters"] = PathFilterIndex([metadata.get("path", "") for metadata in collection["metadatas"]])
+        return collection["filters"]
+
+    def remove_rows(self, name: str, keep: np.ndarray):
+        """Drop every row whose entry in the boolean `keep` mask is False"""
+        collection = self.data[name]
+        if keep.all():
+            return
+        for key in ("ids", "documents", "metadatas"):
+            collection[key] = [item for item, kept in zip(collection[key], keep) if kept]
+        collection["embeddings"] = RowMatrix(np.ascontiguousarray(collection["embeddings"].array[keep]))
+        if collection["normalized"] is not None:
+            collection["normalized"] = RowMatrix(np.ascontiguousarray(collection["normalized"].array[keep]))
+        if collection["codes"] is not None:
+            collection["codes"] = RowMatrix(np.ascontiguousarray(collection["codes"].array[keep]), dtype=np.uint8)
+        collection["ann"] = None # row numbers shifted, rebuilt in the background on next query
+        collection["bm25"] = None
+        collection["filters"] = None
+        self.mark_dirty(name)
+
+    def reset_collection(self, name: str):
+        self.data[name] = _empty_collection(self.is_quantized(name))
+        self.mark_dirty(name)
 
     def get_or_create_collection(self, name: str):
+        self.refresh()
         if name not in self.data:
-            self.data[name] = {"embeddings": [], "documents": [], "metadatas": [], "ids": []}
+            self.data[name] = _empty_collection(self.is_quantized(name))
+            self.mark_dirty(name)
         return SimpleCollection(name, self)
 
     def get_collection(self, name: str):
+        self.refresh()
         if name not in self.data:
             raise KeyError(f"Collection {name} does not exist")
+        self.data[name] # Loads it now, so a broken collection surfaces as KeyError here
         return SimpleCollection(name, self)
     
     def list_collections(self):
+        """Names come from the catalog; no collection is loaded"""
+        self.refresh()
         class Col:
             def __init__(self, name): self.name = name
         return [Col(name) for name in self.data.keys()]
@@ -68,92 +844,477 @@ class SimpleCollection:
         self.db = db
 
     def add(self, ids, embeddings, metadatas, documents):
-        self.db.data[self.name]["ids"].extend(ids)
-        self.db.data[self.name]["embeddings"].extend(embeddings)
-        self.db.data[self.name]["metadatas"].extend(metadatas)
-        self.db.data[self.name]["documents"].extend(documents)
+        collection_data = self.db.data[self.name]
+        rows = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        start_row = len(collection_data["ids"])
+        collection_data["ids"].extend(ids)
+        collection_data["embeddings"].append(rows)
+        if any(collection_data[key] is not None for key in ("normalized", "codes", "ann")):
+            normalized_rows = l2_normalize(rows)
+            if collection_data["normalized"] is not None:
+                collection_data["normalized"].append(normalized_rows)
+            if collection_data["codes"] is not None:
+                collection_data["codes"].append(collection_data["quantizer"].encode(normalized_rows))
+            if collection_data["ann"] is not None:
+                collection_data["ann"].add(normalized_rows, start_row)
+        collection_data["metadatas"].extend(metadatas)
+        collection_data["documents"].extend(documents)
+        collection_data["bm25"] = None
+        collection_data["filters"] = None
+        self.db.mark_dirty(self.name)
 
-    def query(self, query_embeddings, n_results=5):
-        query_vec = np.array(query_embeddings[0])
+    def delete(self, ids: Iterable[str] = None, paths: Iterable[str] = None):
+        """Remove chunks by id and/or every chunk of the given file paths"""
         collection_data = self.db.data[self.name]
-        
-        if not collection_data["embeddings"]:
-            return {"documents": [[]]}
+        ids, paths = set(ids or ()), set(paths or ())
+        keep = np.array([
+            chunk_id not in ids and metadata.get("path") not in paths
+            for chunk_id, metadata in zip(collection_data["ids"], collection_data["metadatas"])
+        ], dtype=bool)
+        self.db.remove_rows(self.name, keep)
+        for path in paths:
+            collection_data["files"].pop(path, None)
+        self.db.mark_dirty(self.name)
 
-        # Compute cosine similarity
-        embeddings = np.array(collection_data["embeddings"])
-        
-        # Avoid division by zero
-        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
-        norms[norms == 0] = 1e-9
-        norm_embeddings = embeddings / norms
-        
-        query_norm = np.linalg.norm(query_vec)
-        if query_norm == 0: query_norm = 1e-9
-        norm_query = query_vec / query_norm
-        
-        similarities = np.dot(norm_embeddings, norm_query)
-        top_indices = np.argsort(similarities)[::-1][:n_results]
+    def ids_by_path(self, paths: Iterable[str]) -> Dict[str, set]:
+        paths = set(paths)
+        grouped = {}
+        collection_data = self.db.data[self.name]
+        for chunk_id, metadata in zip(collection_data["ids"], collection_data["metadatas"]):
+            if metadata.get("path") in paths:
+                grouped.setdefault(metadata["path"], set()).add(chunk_id)
+        return grouped
+
+    def update_metadatas(self, metadatas: Dict[str, dict]):
+        """Replace the metadata of existing chunks, {chunk_id: metadata}"""
+        collection_data = self.db.data[self.name]
+        for row, chunk_id in enumerate(collection_data["ids"]):
+            if chunk_id in metadatas:
+                collection_data["metadatas"][row] = metadatas[chunk_id]
+        collection_data["filters"] = None
+        self.db.mark_dirty(self.name)
+
+    def indexed_files(self) -> Dict[str, str]:
+        """{path: git blob sha} of the files currently in the collection"""
+        return dict(self.db.data[self.name]["files"])
+
+    def record_file(self, path: str, sha: str):
+        self.db.data[self.name]["files"][path] = sha
+        self.db.mark_dirty(self.name)
+
+    def has_term(self, term: str) -> bool:
+        """Whether the identifier appears anywhere in the collection"""
+        return term in self.db.keyword_index(self.name)
+
+    def count(self, where: Optional[dict] = None) -> int:
+        """Number of chunks, or of chunks matching a where= filter"""
+        if not where:
+            return len(self.db.data[self.name]["ids"])
+        return int(self.db.path_filter(self.name).mask(where).sum())
+
+    def top_level_dirs(self) -> set:
+        return set(self.db.path_filter(self.name).top_dirs)
+
+    def _filter_mask(self, where: Optional[dict]) -> Optional[np.ndarray]:
+        return self.db.path_filter(self.name).mask(where) if where else None
+
+    def keyword_query(self, query_texts, n_results=5, where=None):
+        """BM25-only search, no embeddings needed. "distances" are the BM25 scores
+        rescaled to [0, 1] per query, 0 being the best match."""
+        collection_data = self.db.data[self.name]
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if not collection_data["ids"]:
+            return {key: [[] for _ in query_texts] for key in results}
+        index = self.db.keyword_index(self.name)
+        mask = self._filter_mask(where)
+        for query_text in query_texts:
+            scores = index.scores(query_text)
+            if mask is not None:
+                scores[~mask] = 0
+            rows = top_k(scores[None, :], n_results)[0]
+            rows = rows[scores[rows] > 0]
+            best = scores[rows[0]] if len(rows) else 1.0
+            self._append_rows(results, rows, 1.0 - scores[rows] / best)
+        return results
+
+    def query(self, query_embeddings, n_results=5, n_probe=None, query_texts=None, where=None):
+        """Batched cosine search. Returns Chroma-style results with one inner list
+        per query vector in "ids", "documents", "metadatas" and "distances".
+        Large collections go through the IVF index, probing n_probe lists.
+        With `query_texts` (one per vector) the vector ranking is fused with the
+        BM25 ranking of the text; "distances" stay cosine distances.
+        `where` restricts the search to matching chunks, see PathFilterIndex,
+        e.g. {"language": "css"} or {"path_prefix": "backend/", "extension": ".py"}."""
+        query_matrix = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        collection_data = self.db.data[self.name]
+        mask = self._filter_mask(where) if collection_data["ids"] else None
         
-        return {
-            "documents": [[collection_data["documents"][i] for i in top_indices]]
-        }
+        if not collection_data["ids"] or (mask is not None and not mask.any()):
+            return {key: [[] for _ in range(len(query_matrix))] for key in ("ids", "documents", "metadatas", "distances")}
+
+        depth = n_results * HYBRID_CANDIDATES if query_texts is not None else n_results
+        norm_queries = l2_normalize(query_matrix)
+        quantized = self.db.is_quantized(self.name)
+        subset = np.flatnonzero(mask) if mask is not None else None
+        index = self.db.ann_index(self.name) if subset is None or len(subset) >= ANN_MIN_ROWS else None
+        quantization = self.db.quantized(self.name) if quantized else None
+        if quantized and quantization is None:
+            # Codebooks still training: scan the raw vectors exactly instead
+            quantized = False
+            similarities = self.db.exact_scores(self.name, norm_queries, subset)
+            top_positions = top_k(similarities, depth)
+            top_scores = np.take_along_axis(similarities, top_positions, axis=1)
+            top_indices = top_positions if subset is None else subset[top_positions]
+        elif quantized:
+            # Score against the codes, then re-rank the best candidates exactly below
+            quantizer, codes = quantization
+            candidates = max(depth * self.db.rerank_factor(self.name), RERANK_MIN_CANDIDATES)
+            if index is not None:
+                top_indices, top_scores = index.search(DecodedRows(quantizer, codes), norm_queries, candidates, n_probe or ANN_N_PROBE, mask)
+            else:
+                approx = quantizer.scores(codes if subset is None else codes[subset], norm_queries)
+                top_positions = top_k(approx, candidates)
+                top_scores = np.take_along_axis(approx, top_positions, axis=1)
+                top_indices = top_positions if subset is None else subset[top_positions]
+        elif index is not None:
+            normalized = self.db.normalized(self.name)
+            top_indices, top_scores = index.search(normalized, norm_queries, depth, n_probe or ANN_N_PROBE, mask)
+        elif subset is not None:
+            normalized = self.db.normalized(self.name)
+            # Only the rows that pass the filter are scanned
+            similarities = norm_queries @ normalized[subset].T
+            top_positions = top_k(similarities, depth)
+            top_scores = np.take_along_axis(similarities, top_positions, axis=1)
+            top_indices = subset[top_positions]
+        else:
+            # Q query vectors against the pre-normalized matrix: one matrix-matrix product
+            normalized = self.db.normalized(self.name)
+            similarities = norm_queries @ normalized.T
+            top_indices = top_k(similarities, depth)
+            top_scores = np.take_along_axis(similarities, top_indices, axis=1)
+
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for q, (row, scores) in enumerate(zip(top_indices, top_scores)):
+            found = row >= 0 # the IVF search pads short candidate lists with -1
+            row, scores = row[found], scores[found]
+            if quantized:
+                exact = self.db.row_vectors(self.name, row) @ norm_queries[q]
+                best = np.argsort(-exact)[:depth]
+                row, scores = row[best], exact[best]
+            if query_texts is not None:
+                keyword_scores = self.db.keyword_index(self.name).scores(query_texts[q])
+                if mask is not None:
+                    keyword_scores[~mask] = 0
+                keyword_rows = top_k(keyword_scores[None, :], depth)[0]
+                keyword_rows = keyword_rows[keyword_scores[keyword_rows] > 0]
+                fused = reciprocal_rank_fusion([row, keyword_rows])[:n_results]
+                row = np.array([i for i, _ in fused], dtype=np.int64)
+                scores = self.db.row_vectors(self.name, row) @ norm_queries[q]
+            self._append_rows(results, row, 1.0 - scores)
+        return results
+
+    def _append_rows(self, results: dict, rows: np.ndarray, distances: np.ndarray):
+        collection_data = self.db.data[self.name]
+        results["ids"].append([collection_data["ids"][i] for i in rows])
+        results["documents"].append([collection_data["documents"][i] for i in rows])
+        results["metadatas"].append([collection_data["metadatas"][i] for i in rows])
+        results["distances"].append(np.asarray(distances, dtype=np.float32).tolist())
+
+def git_blob_sha(content: str) -> str:
+    """The SHA git (and the GitHub tree API) assigns to a file with this content"""
+    data = content.encode("utf-8")
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def admit_path(path: str, size: Optional[int] = None) -> bool:
+    """Whether a repository file should be indexed: code/docs only, no vendored
+    trees, lockfiles, minified bundles or oversized files"""
+    parts = path.split("/")
+    filename = parts[-1]
+    if not filename.endswith(INDEXED_EXTENSIONS):
+        return False
+    if filename in LOCKFILES or filename.endswith((".min.js", ".min.css")):
+        return False
+    if any(part in VENDORED_DIRS for part in parts[:-1]):
+        return False
+    return size is None or size <= MAX_FILE_BYTES
+
+
+def decode_text(data: bytes) -> Optional[str]:
+    """Decode file contents, or None for binary data"""
+    if b"\0" in data[:8192]:
+        return None
+    return data.decode("utf-8", errors="ignore")
+
+
+def extract_archive(archive: bytes, wanted_paths: Iterable[str]) -> Dict[str, str]:
+    """Pull the wanted files out of a GitHub tarball in memory. GitHub prefixes every
+    member with a single "<owner>-<repo>-<sha>/" directory, which is stripped."""
+    wanted = set(wanted_paths)
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(archive), mode="r|gz") as tar:
+        for member in tar:
+            if not member.isfile() or member.size > MAX_FILE_BYTES:
+                continue
+            path = member.name.split("/", 1)[-1]
+            if path not in wanted:
+                continue
+            content = decode_text(tar.extractfile(member).read())
+            if content is not None:
+                files[path] = content
+    return files
+
+
+def collection_name_for(user_id: int, repo_full_name: str) -> str:
+    return f"user_{user_id}_{repo_full_name.replace('/', '_').replace('-', '_')}"
+
 
 class RepositoryRAG:
-    def __init__(self):
-        self.vector_db = SimpleVectorDB(DB_PATH)
+    def __init__(self, db_path: str = DB_PATH):
+        self.vector_db = SimpleVectorDB(db_path)
+        self.embedding_cache = EmbeddingCache(os.path.join(db_path, "embedding_cache.sqlite3"), EMBED_CACHE_MAX_ENTRIES)
+        # Shared by every indexing job so the total number of batches in flight stays bounded
+        self.embed_semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+        self.embedding_stats = {"chunks": 0, "seconds": 0.0, "last_chunks_per_sec": 0.0, "failed_batches": 0}
+        self.query_embedding_cache = TTLCache(QUERY_EMBED_CACHE_MAX_ENTRIES)
+        self.answer_cache = TTLCache(ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL_SECONDS)
         
-    async def get_embedding(self, text: str) -> List[float]:
-        if not client:
+    async def get_embedding(self, text: str, task_type: str = "RETRIEVAL_DOCUMENT") -> List[float]:
+        cache_key = EmbeddingCache.key(EMBEDDING_MODEL, task_type, text)
+        cached = self.embedding_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        if not gemini_utils.client:
             return [0.0] * 768 # Fallback
         
         try:
-            response = client.models.embed_content(
+            response = await gemini_utils.embed_content(
+                text,
                 model=EMBEDDING_MODEL,
-                contents=text,
-                config={"task_type": "RETRIEVAL_DOCUMENT"}
+                config={"task_type": task_type},
+                priority="interactive" # a question is waiting on it
             )
-            return response.embeddings[0].values
+            embedding = response.embeddings[0].values
+            self.embedding_cache.put(cache_key, embedding)
+            return embedding
         except Exception as e:
             logger.error(f"Embedding error: {e}")
             return [0.0] * 768
 
+    async def _embed_batch(self, batch: List[str], task_type: str) -> Optional[List[List[float]]]:
+        """Embed one batch (retried with backoff by the provider). Returns None if it failed
+        or the embedding endpoint's circuit breaker is open."""
+        async with self.embed_semaphore:
+            try:
+                response = await gemini_utils.embed_content(
+                    batch,
+                    model=EMBEDDING_MODEL,
+                    config={"task_type": task_type},
+                    priority="background", # indexing yields to chat, but is never dropped
+                    attempts=EMBED_MAX_ATTEMPTS
+                )
+                return [embedding.values for embedding in response.embeddings]
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(batch)} failed: {e}")
+                self.embedding_stats["failed_batches"] += 1
+                return None
+
+    async def embed_texts(self, texts: List[str], task_type: str = "RETRIEVAL_DOCUMENT", progress: Optional[ProgressCallback] = None) -> List[Optional[List[float]]]:
+        """Embed many chunks. Cached content is served from the embedding cache; the rest
+        goes out in batched requests, at most EMBED_CONCURRENCY batches in flight.
+        Chunks of a batch that failed come back as None. Without an API key every
+        chunk gets a zero vector. `progress` is awaited with chunks_total/chunks_embedded
+        as batches finish."""
+        if not texts:
+            return []
+
+        keys = [EmbeddingCache.key(EMBEDDING_MODEL, task_type, text) for text in texts]
+        embeddings = self.embedding_cache.get_many(keys)
+        # Identical chunks within this call are only sent once
+        missing = list({key: text for key, text in zip(keys, texts) if key not in embeddings}.items())
+        occurrences = Counter(keys)
+        embedded = sum(occurrences[key] for key in embeddings)
+        if progress:
+            await progress(chunks_total=len(texts), chunks_embedded=embedded)
+
+        if missing and gemini_utils.client:
+            started = time.perf_counter()
+            batches = [missing[i:i + EMBED_BATCH_SIZE] for i in range(0, len(missing), EMBED_BATCH_SIZE)]
+
+            async def embed_batch(batch):
+                nonlocal embedded
+                vectors = await self._embed_batch([text for _, text in batch], task_type)
+                embedded += sum(occurrences[key] for key, _ in batch)
+                if progress:
+                    await progress(chunks_embedded=embedded)
+                return vectors
+
+            results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+            elapsed = time.perf_counter() - started
+
+            fresh = {}
+            for batch, vectors in zip(batches, results):
+                if vectors is not None: # failed batches come back as None and are not cached
+                    fresh.update((key, vector) for (key, _), vector in zip(batch, vectors))
+            self.embedding_cache.put_many(fresh)
+            embeddings.update(fresh)
+
+            rate = len(missing) / elapsed if elapsed > 0 else float("inf")
+            self.embedding_stats["chunks"] += len(missing)
+            self.embedding_stats["seconds"] += elapsed
+            self.embedding_stats["last_chunks_per_sec"] = rate
+            logger.info(f"Embedded {len(missing)} chunks in {len(batches)} batches, {elapsed:.2f}s ({rate:.1f} chunks/sec); {len(texts) - len(missing)} from cache")
+
+        if progress:
+            await progress(chunks_embedded=len(texts))
+        if not gemini_utils.client:
+            return [embeddings.get(key, [0.0] * 768) for key in keys] # Fallback, nothing to retry later
+        return [embeddings.get(key) for key in keys]
+
     def chunk_text(self, text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
         chunks = []
         for i in range(0, len(text), chunk_size - overlap):
             chunks.append(text[i:i + chunk_size])
         return chunks
 
-    async def index_files(self, user_id: int, repo_full_name: str, files: Dict[str, str]):
-        """Index a batch of files into SimpleVectorDB"""
-        collection_name = f"user_{user_id}_{repo_full_name.replace('/', '_').replace('-', '_')}"
+    def chunk_document(self, path: str, text: str) -> List[dict]:
+        """Split a file per CHUNKING_MODE into [{"text", "start_line", "end_line"}]"""
+        if CHUNKING_MODE == "fixed":
+            chunks = []
+            for i, chunk in enumerate(self.chunk_text(text, chunk_size=1000, overlap=200)):
+                start_line = text.count("\n", 0, i * 800) + 1
+                chunks.append({"text": chunk, "start_line": start_line, "end_line": start_line + chunk.count("\n")})
+            return chunks
+        if CHUNKING_MODE == "cdc":
+            return [chunk._asdict() for chunk in chunk_content_defined(text)]
+        return [chunk._asdict() for chunk in chunk_file(path, text)]
+
+    def chunk_ids(self, path: str, chunks: List[dict]) -> List[str]:
+        """Positional ids, or in "cdc" mode ids derived from the chunk content so an
+        unchanged chunk keeps its id wherever it moves in the file"""
+        if CHUNKING_MODE != "cdc":
+            return [f"{path}_chunk_{i}" for i in range(len(chunks))]
+        ids, seen = [], {}
+        for chunk in chunks:
+            digest = hashlib.sha256(chunk["text"].encode("utf-8")).hexdigest()[:16]
+            seen[digest] = seen.get(digest, 0) + 1
+            ids.append(f"{path}#{digest}" if seen[digest] == 1 else f"{path}#{digest}-{seen[digest]}")
+        return ids
+
+    async def _index_documents(self, collection, files: Dict[str, str], shas: Optional[Dict[str, str]] = None, existing: Optional[Dict[str, set]] = None, progress: Optional[ProgressCallback] = None):
+        """Chunk every file, embed all chunks in batches and add them to the collection.
+        `existing` maps paths to chunk ids already in the collection: those are kept
+        (only their metadata is refreshed) and ids no longer produced are deleted.
+        File SHAs are recorded last, so a cancelled run leaves its files to be fetched again.
+        Returns the paths with chunks that could not be embedded. Those chunks are left
+        out and the file's SHA is not recorded, so the next sync fetches it again."""
+        ids, metadatas, documents = [], [], []
+        kept, stale = {}, set()
+        for path, content in files.items():
+            existing_ids = (existing or {}).get(path, set())
+            chunks = self.chunk_document(path, content) if content and len(content) >= 10 else []
+            chunk_ids = self.chunk_ids(path, chunks)
+            stale.update(existing_ids - set(chunk_ids))
+                
+            for i, (chunk_id, chunk) in enumerate(zip(chunk_ids, chunks)):
+                metadata = {"path": path, "chunk_index": i, "start_line": chunk["start_line"], "end_line": chunk["end_line"]}
+                if chunk_id in existing_ids:
+                    kept[chunk_id] = metadata
+                    continue
+                ids.append(chunk_id)
+                metadatas.append(metadata)
+                documents.append(chunk["text"])
+
+        if stale:
+            collection.delete(ids=stale)
+        if kept:
+            collection.update_metadatas(kept)
+        failed_paths = set()
+        if documents:
+            embeddings = await self.embed_texts(documents, progress=progress)
+            embedded = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+            failed_paths = {metadatas[i]["path"] for i, embedding in enumerate(embeddings) if embedding is None}
+            if embedded:
+                collection.add(
+                    ids=[ids[i] for i in embedded],
+                    embeddings=[embeddings[i] for i in embedded],
+                    metadatas=[metadatas[i] for i in embedded],
+                    documents=[documents[i] for i in embedded]
+                )
+        for path, content in files.items():
+            if path not in failed_paths:
+                collection.record_file(path, (shas or {}).get(path) or git_blob_sha(content))
+        if failed_paths:
+            logger.warning(f"{len(failed_paths)} files could not be embedded and will be retried on the next sync")
+        return failed_paths
+
+    async def index_files(self, user_id: int, repo_full_name: str, files: Dict[str, str], shas: Optional[Dict[str, str]] = None, progress: Optional[ProgressCallback] = None) -> bool:
+        """Index a batch of files into SimpleVectorDB, replacing whatever the collection held.
+        Returns False if some files could not be embedded."""
+        collection_name = collection_name_for(user_id, repo_full_name)
         logger.info(f"Indexing repository '{repo_full_name}' for user {user_id}")
         
         collection = self.vector_db.get_or_create_collection(name=collection_name)
         
         # Clear existing data for this collection before re-indexing (optional, but cleaner for sync)
-        self.vector_db.data[collection_name] = {"embeddings": [], "documents": [], "metadatas": [], "ids": []}
+        self.vector_db.reset_collection(collection_name)
 
-        for path, content in files.items():
-            if not content or len(content) < 10:
-                continue
-                
-            chunks = self.chunk_text(content)
-            for i, chunk in enumerate(chunks):
-                embedding = await self.get_embedding(chunk)
-                collection.add(
-                    ids=[f"{path}_chunk_{i}"],
-                    embeddings=[embedding],
-                    metadatas=[{"path": path, "chunk_index": i}],
-                    documents=[chunk]
-                )
+        if progress:
+            await progress(files_total=len(files), files_fetched=len(files))
+        failed_paths = await self._index_documents(collection, files, shas, progress=progress)
         
+        self.vector_db.keyword_index(collection_name) # built now so the first query doesn't pay for it
+        await self.vector_db.prepare(collection_name) # IVF index and quantizer are persisted with the segment
+        self.answer_cache.invalidate(lambda key: key[0] == collection_name)
         self.vector_db.persist()
-        logger.info(f"Successfully indexed and persisted repository for user {user_id}")
+        logger.info(f"Indexed and persisted repository for user {user_id}, {len(failed_paths)} files failed")
+        return not failed_paths
 
-    async def query(self, user_id: int, repo_full_name: str, query_text: str) -> str:
-        """Query the indexed repository and generate a response from a senior colleague"""
-        collection_name = f"user_{user_id}_{repo_full_name.replace('/', '_').replace('-', '_')}"
+    async def update_files(self, user_id: int, repo_full_name: str, files: Dict[str, str], removed_paths: Iterable[str] = (), shas: Optional[Dict[str, str]] = None, progress: Optional[ProgressCallback] = None) -> bool:
+        """Re-index only the given added/modified files and drop the chunks of removed paths.
+        Returns False if some files could not be embedded."""
+        collection_name = collection_name_for(user_id, repo_full_name)
+        collection = self.vector_db.get_or_create_collection(name=collection_name)
+        removed_paths = list(removed_paths)
+        
+        existing = None
+        if CHUNKING_MODE == "cdc":
+            # Diff chunk-hash sets per file instead of dropping whole files
+            collection.delete(paths=removed_paths)
+            existing = collection.ids_by_path(files.keys())
+        else:
+            collection.delete(paths=removed_paths + list(files.keys()))
+        failed_paths = await self._index_documents(collection, files, shas, existing, progress)
+        
+        self.vector_db.keyword_index(collection_name) # built now so the first query doesn't pay for it
+        await self.vector_db.prepare(collection_name) # IVF index and quantizer are persisted with the segment
+        self.answer_cache.invalidate(lambda key: key[0] == collection_name)
+        self.vector_db.persist()
+        logger.info(f"Re-indexed {len(files)} changed files for user {user_id}, removed {len(removed_paths)}, {len(failed_paths)} failed")
+        return not failed_paths
+
+    def cache_stats(self) -> dict:
+        return {
+            "answers": self.answer_cache.stats(),
+            "query_embeddings": self.query_embedding_cache.stats(),
+            "chunk_embeddings": self.embedding_cache.stats()
+        }
+
+    async def _query_embedding(self, query_text: str) -> List[float]:
+        """Embedding of the question as asked: casing and symbols (`getUserById`, `foo.bar()`) matter to retrieval"""
+        embedding = self.query_embedding_cache.get(query_text)
+        if embedding is None:
+            embedding = await self.get_embedding(query_text)
+            if any(embedding): # never cache the zero-vector fallback
+                self.query_embedding_cache.put(query_text, embedding)
+        return embedding
+
+    async def _prepare_answer(self, user_id: int, repo_full_name: str, query_text: str, index_version: Optional[str] = None):
+        """Retrieve context and build the Senior Colleague prompt.
+        Returns (answer, None, None) when no model call is needed (no index, cached answer),
+        otherwise (None, prompt, answer_key)."""
+        collection_name = collection_name_for(user_id, repo_full_name)
         project_name = repo_full_name.split('/')[-1].replace('-', ' ').title()
 
         # 1. Handle very short or ambiguous general queries without RAG if needed
@@ -167,17 +1328,34 @@ class RepositoryRAG:
             has_index = False
 
         if not has_index:
-            return f"Hey! I haven't indexed your repository ({project_name}) yet. Click the sync icon so I can take a look at your code!"
+            return f"Hey! I haven't indexed your repository ({project_name}) yet. Click the sync icon so I can take a look at your code!", None, None
 
-        query_embedding = await self.get_embedding(query_text)
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=5
-        )
+        normalized_query = normalize_query(query_text)
+        answer_key = (collection_name, index_version, self.vector_db.version(collection_name), normalized_query)
+        cached_answer = self.answer_cache.get(answer_key)
+        if cached_answer is not None:
+            return cached_answer, None, None
+
+        identifier = find_identifier(query_text)
+        if identifier and collection.has_term(identifier):
+            # A lookup of a known identifier is answered by the keyword index alone: no embedding call
+            results = collection.keyword_query([identifier], n_results=5)
+        else:
+            # "the CSS", "the backend routes"... narrow the search when the filter matches anything
+            where = infer_where(query_text, collection.top_level_dirs())
+            if where and not collection.count(where):
+                where = None
+            query_embedding = await self._query_embedding(query_text)
+            results = collection.query(
+                query_embeddings=[query_embedding],
+                n_results=5,
+                query_texts=[query_text] if HYBRID_SEARCH else None,
+                where=where or None
+            )
         
-        context = ""
-        if results['documents'][0]:
-            context = "\n---\n".join(results['documents'][0])
+        # Adjacent/overlapping chunks merged, near-duplicates dropped, within RAG_CONTEXT_TOKEN_BUDGET
+        context = pack_context(results['documents'][0], results['metadatas'][0])
+        logger.debug(f"Packed {len(results['documents'][0])} chunks into ~{estimate_tokens(context)} tokens of context")
         
         prompt = f"""
         You are a supportive, slightly informal Senior Developer ("Senior Colleague").
@@ -197,18 +1375,98 @@ class RepositoryRAG:
         
         RESPONSIBLE RESPONSE:
         """
+        return None, prompt, answer_key
+
+    async def query(self, user_id: int, repo_full_name: str, query_text: str, index_version: Optional[str] = None) -> str:
+        """Query the indexed repository and generate a response from a senior colleague.
+        `index_version` (the user's last_indexed_commit) is part of the answer cache key,
+        together with the collection's in-process version, so a re-index elsewhere is noticed too."""
+        answer, prompt, answer_key = await self._prepare_answer(user_id, repo_full_name, query_text, index_version)
+        if answer is not None:
+            return answer
         
-        if not client:
-            return "I'm sorry, my AI brain is a bit foggy right now. Try again in a second?"
+        if not gemini_utils.client:
+            return FOGGY_ANSWER
             
-        response = client.models.generate_content(
-            model=MODEL,
-            contents=prompt
-        )
-        return response.text
+        try:
+            answer = await gemini_utils.generate_text(prompt, priority="interactive")
+        except Exception as e:
+            logger.error(f"Answer generation failed: {e}")
+            return FOGGY_ANSWER
+        if answer:
+            self.answer_cache.put(answer_key, answer)
+        return answer
+
+    async def query_stream(self, user_id: int, repo_full_name: str, query_text: str, index_version: Optional[str] = None) -> AsyncIterator[str]:
+        """Same as query, but yields the answer piece by piece as the model streams it.
+        The complete text is cached like query's, unless the stream broke off."""
+        answer, prompt, answer_key = await self._prepare_answer(user_id, repo_full_name, query_text, index_version)
+        if answer is not None:
+            yield answer
+            return
 
-    async def sync_with_github(self, user_id: int, repo_full_name: str, access_token: str, db_session):
-        """Fetch changes from GitHub and update index"""
+        if not gemini_utils.client:
+            yield FOGGY_ANSWER
+            return
+
+        pieces = []
+        try:
+            async for chunk in gemini_utils.generate_content_stream(prompt, priority="interactive"):
+                if chunk.text:
+                    pieces.append(chunk.text)
+                    yield chunk.text
+        except Exception as e:
+            logger.error(f"Streaming answer failed after {len(pieces)} chunks: {e}")
+            if not pieces:
+                yield FOGGY_ANSWER
+            return
+        if pieces:
+            self.answer_cache.put(answer_key, "".join(pieces))
+
+    async def _fetch_archive(self, github_client, repo_full_name: str, sha: str, headers: dict, paths: List[str]) -> Optional[Dict[str, str]]:
+        """Stream the commit's tarball once and extract the given paths in memory.
+        Returns None if the archive could not be fetched, so the caller can fall back to blobs."""
+        archive_url = f"https://api.github.com/repos/{repo_full_name}/tarball/{sha}"
+        try:
+            buffer = io.BytesIO()
+            async with github_client.stream("GET", archive_url, headers=headers, follow_redirects=True) as resp:
+                if resp.status_code != 200:
+                    logger.warning(f"Tarball download for {repo_full_name} failed: HTTP {resp.status_code}")
+                    return None
+                async for data in resp.aiter_bytes():
+                    buffer.write(data)
+                    if buffer.tell() > MAX_ARCHIVE_BYTES:
+                        logger.warning(f"Tarball for {repo_full_name} exceeds {MAX_ARCHIVE_BYTES} bytes, falling back to blobs")
+                        return None
+            files = await asyncio.to_thread(extract_archive, buffer.getvalue(), paths)
+            logger.info(f"Extracted {len(files)} of {len(paths)} changed files from the {repo_full_name} tarball")
+            return files
+        except Exception as e:
+            logger.warning(f"Tarball fetch for {repo_full_name} failed: {e}")
+            return None
+
+    async def _fetch_blobs(self, github_client, items: List[dict], headers: dict, progress: Optional[ProgressCallback] = None) -> Dict[str, str]:
+        """Fetch tree blobs one request each, at most BLOB_FETCH_CONCURRENCY at a time"""
+        semaphore = asyncio.Semaphore(BLOB_FETCH_CONCURRENCY)
+        fetched = 0
+
+        async def fetch(item):
+            nonlocal fetched
+            async with semaphore:
+                file_resp = await call_with_retries("github.api", lambda: github_client.get(item["url"], headers=headers))
+            fetched += 1
+            if progress:
+                await progress(files_fetched=fetched)
+            if file_resp.status_code != 200:
+                return None
+            return decode_text(base64.b64decode(file_resp.json()["content"]))
+
+        contents = await asyncio.gather(*(fetch(item) for item in items))
+        return {item["path"]: content for item, content in zip(items, contents) if content is not None}
+
+    async def sync_with_github(self, user_id: int, repo_full_name: str, access_token: str, db_session, progress: Optional[ProgressCallback] = None):
+        """Fetch changes from GitHub and update index. `progress` is awaited with
+        files_total/files_fetched and then chunks_total/chunks_embedded counters."""
         from models import User
         from sqlalchemy.future import select
         
@@ -219,7 +1477,7 @@ class RepositoryRAG:
                 "Authorization": f"token {access_token}",
                 "Accept": "application/vnd.github.v3+json"
             }
-            resp = await github_client.get(commits_url, headers=headers)
+            resp = await call_with_retries("github.api", lambda: github_client.get(commits_url, headers=headers))
             if resp.status_code != 200:
                 return False
                 
@@ -234,36 +1492,65 @@ class RepositoryRAG:
             result = await db_session.execute(stmt)
             user = result.scalar_one_or_none()
             
-            if user.last_indexed_commit == latest_sha:
-                return True # Already up to date
+            collection_name = collection_name_for(user_id, repo_full_name)
+            indexed_files = {}
+            if collection_name in self.vector_db.data:
+                indexed_files = self.vector_db.get_collection(collection_name).indexed_files()
+                if user.last_indexed_commit == latest_sha:
+                    return True # Already up to date
                 
-            # 3. Fetch full repository tree (simplified for MVP: fetch files recursively)
+            # 3. Fetch full repository tree; blob SHAs tell us which files actually changed
             tree_url = f"https://api.github.com/repos/{repo_full_name}/git/trees/{latest_sha}?recursive=1"
-            resp = await github_client.get(tree_url, headers=headers)
+            resp = await call_with_retries("github.api", lambda: github_client.get(tree_url, headers=headers))
             if resp.status_code != 200:
                 return False
                 
             tree = resp.json().get("tree", [])
-            files_to_index = {}
+            tree_shas = {}
+            changed_items = []
             
             for item in tree:
                 if item["type"] == "blob":
                     path = item["path"]
-                    # Skip non-code files
-                    if any(path.endswith(ext) for ext in [".py", ".js", ".ts", ".tsx", ".html", ".css", ".md", ".json", ".java", ".cs"]):
-                        # Fetch file content
-                        file_resp = await github_client.get(item["url"], headers=headers)
-                        if file_resp.status_code == 200:
-                            content_data = file_resp.json()
-                            content = base64.b64decode(content_data["content"]).decode('utf-8', errors='ignore')
-                            files_to_index[path] = content
+                    # Skip non-code, vendored and oversized files
+                    if admit_path(path, item.get("size")):
+                        tree_shas[path] = item["sha"]
+                        if indexed_files.get(path) != item["sha"]:
+                            changed_items.append(item)
+
+            # 4. Fetch only what changed: one tarball for big syncs, single blobs otherwise
+            if progress:
+                await progress(files_total=len(changed_items), files_fetched=0)
+            files_to_index = None
+            if len(changed_items) >= ARCHIVE_MIN_FILES:
+                files_to_index = await self._fetch_archive(github_client, repo_full_name, latest_sha, headers, [item["path"] for item in changed_items])
+            if files_to_index is None:
+                files_to_index = await self._fetch_blobs(github_client, changed_items, headers, progress)
+            elif progress:
+                await progress(files_fetched=len(changed_items))
                             
-            if files_to_index:
-                await self.index_files(user_id, repo_full_name, files_to_index)
+            removed_paths = [path for path in indexed_files if path not in tree_shas]
+            if files_to_index or removed_paths:
+                if not await self.update_files(user_id, repo_full_name, files_to_index, removed_paths, tree_shas, progress):
+                    return False # the commit stays unindexed, so the next sync retries the failed files
                 
-            # 4. Update user metadata
+            # 5. Update user metadata
             user.last_indexed_commit = latest_sha
             await db_session.commit()
             return True
 
-rag_engine = RepositoryRAG()
+_rag_engine: Optional[RepositoryRAG] = None
+
+
+def __getattr__(name: str):
+    """`rag_engine` is built on first use, so importing this module (e.g. from
+    migrate_vector_db.py) does not open or migrate the default store"""
+    global _rag_engine
+    if name == "rag_engine":
+        if _rag_engine is None:
+            _rag_engine = RepositoryRAG()
+            # Only the shared engine writes out pending changes at exit; other
+            # SimpleVectorDB instances flush() themselves
+            atexit.register(_rag_engine.vector_db.flush, 30)
+        return _rag_engine
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
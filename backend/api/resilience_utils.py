@@ -0,0 +1,225 @@
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+import asyncio
+import logging
+import os
+import random
+import time
+import httpx
+from google.genai import errors as genai_errors
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "8"))
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+
+class SingleFlight:
+    """Coalesces identical in-flight calls: while a call for a key is running,
+    callers with the same key await its result instead of starting their own.
+
+    The call runs as its own task, so a caller that gives up (request cancelled,
+    client disconnected) does not cancel it for the others waiting on it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, make_call: Callable[[], Awaitable[T]]) -> T:
+        self.calls += 1
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(make_call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: Hashable, task: asyncio.Task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception() # retrieved here too, in case every caller already gave up
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced, # calls saved
+            "in_flight": len(self._in_flight)
+        }
+
+
+_single_flights: Dict[str, SingleFlight] = {}
+
+
+def single_flight(name: str) -> SingleFlight:
+    """The process-wide SingleFlight group for `name` (e.g. "gemini", "github")"""
+    if name not in _single_flights:
+        _single_flights[name] = SingleFlight(name)
+    return _single_flights[name]
+
+
+def single_flight_stats() -> dict:
+    return {name: group.stats() for name, group in _single_flights.items()}
+
+
+class CircuitOpen(Exception):
+    """The endpoint's circuit breaker is open; the call was not attempted"""
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"{endpoint} is unavailable, retrying in {retry_after:.0f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive retryable failures and then fails
+    fast. After `reset_seconds` one probe call is let through (half-open): success
+    closes the breaker, failure opens it for another `reset_seconds`."""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started: Optional[float] = None
+        self.rejected = 0
+        self.trips = 0
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.reset_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self.probe_started = None
+        if self.state == "half_open":
+            # One probe at a time; a probe that never reported back (cancelled) is replaced
+            if self.probe_started is None or now - self.probe_started >= self.reset_seconds:
+                self.probe_started = now
+                return True
+        if self.state == "closed":
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"Circuit breaker {self.name} closed")
+        self.state = "closed"
+        self.failures = 0
+        self.probe_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.trips += 1
+                logger.warning(f"Circuit breaker {self.name} opened after {self.failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+
+    def record_neutral(self):
+        """The call ended without telling us anything about the endpoint"""
+        self.probe_started = None
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "retry_after_seconds": round(self.retry_after(), 1) if self.state == "open" else 0.0,
+            "trips": self.trips,
+            "rejected": self.rejected
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def circuit_breaker(endpoint: str) -> CircuitBreaker:
+    if endpoint not in _breakers:
+        _breakers[endpoint] = CircuitBreaker(endpoint)
+    return _breakers[endpoint]
+
+
+def breaker_stats() -> dict:
+    return {name: breaker.stats() for name, breaker in _breakers.items()}
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    if isinstance(error, genai_errors.APIError):
+        return error.code
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Timeouts, connection failures and 408/429/5xx answers are worth another try"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    return error_status(error) in RETRYABLE_STATUSES
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, or the server's Retry-After when it sent one"""
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _retry_after(response) -> Optional[float]:
+    try:
+        return float(response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+async def call_with_retries(endpoint: str, make_call: Callable[[], Awaitable[T]], attempts: int = RETRY_MAX_ATTEMPTS) -> T:
+    """Make the call through the endpoint's circuit breaker, retrying retryable
+    failures with backoff. Exceptions that are not retryable are raised at once;
+    an HTTP response with a retryable status is retried and, if it is still bad on
+    the last attempt, returned for the caller to handle. Raises CircuitOpen while
+    the breaker is open, so callers fall back without waiting on a dead endpoint."""
+    breaker = circuit_breaker(endpoint)
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise CircuitOpen(endpoint, breaker.retry_after())
+        last = attempt == attempts - 1
+        try:
+            result = await make_call()
+        except Exception as e:
+            if is_retryable(e):
+                breaker.record_failure()
+            elif error_status(e) is not None:
+                breaker.record_success() # the endpoint answered, the request was at fault
+            else:
+                breaker.record_neutral()
+            if last or not is_retryable(e):
+                raise
+            logger.warning(f"{endpoint} call failed (attempt {attempt + 1}/{attempts}), retrying: {e}")
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+
+        status = getattr(result, "status_code", None)
+        if not isinstance(status, int) or status not in RETRYABLE_STATUSES:
+            breaker.record_success()
+            return result
+        breaker.record_failure()
+        if last:
+            return result
+        logger.warning(f"{endpoint} answered HTTP {status} (attempt {attempt + 1}/{attempts}), retrying")
+        await asyncio.sleep(backoff_delay(attempt, _retry_after(result)))
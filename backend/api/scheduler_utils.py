@@ -0,0 +1,176 @@
+from typing import List, Optional
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Lower number is served first
+PRIORITIES = {"interactive": 0, "normal": 1, "background": 2}
+
+
+class RequestDropped(Exception):
+    """A queued request waited past its deadline and was never sent"""
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute` units a minute, holding at most one minute's worth"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.per_minute <= 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` can be taken (requests larger than the bucket only wait for a full one)"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.per_minute)
+
+    def take(self, amount: float):
+        """Take `amount`; the level may go negative, which later requests pay off"""
+        if not self.unlimited:
+            self._refill()
+            self.level -= amount
+
+    def give_back(self, amount: float):
+        if not self.unlimited:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class _Waiter:
+    def __init__(self, priority: str, tokens: int, deadline: Optional[float]):
+        self.priority = priority
+        self.tokens = tokens
+        self.deadline = deadline
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class RequestScheduler:
+    """Admits requests under requests-per-minute and tokens-per-minute limits.
+
+    Requests wait in one queue ordered by priority class, then arrival. The
+    head of the queue is admitted as soon as both token buckets can cover it;
+    queued requests whose deadline passes are dropped with RequestDropped
+    instead of being sent late.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._queue: List = [] # heap of (priority rank, sequence, waiter)
+        self._sequence = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.admitted = {name: 0 for name in PRIORITIES}
+        self.dropped = {name: 0 for name in PRIORITIES}
+        self.wait_seconds = {name: 0.0 for name in PRIORITIES}
+
+    def _can_admit(self, tokens: int) -> bool:
+        return self.requests.wait_time(1) == 0 and self.tokens.wait_time(tokens) == 0
+
+    def _admit(self, priority: str, tokens: int, waited: float = 0.0):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.admitted[priority] += 1
+        self.wait_seconds[priority] += waited
+
+    async def acquire(self, priority: str = "normal", tokens: int = 0, max_wait: Optional[float] = None):
+        """Wait until the request may be sent. Raises RequestDropped if that takes longer than `max_wait` seconds."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        if not self._queue and self._can_admit(tokens):
+            self._admit(priority, tokens)
+            return
+
+        deadline = time.monotonic() + max_wait if max_wait is not None else None
+        waiter = _Waiter(priority, tokens, deadline)
+        heapq.heappush(self._queue, (PRIORITIES[priority], next(self._sequence), waiter))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        else:
+            self._wakeup.set()
+        await waiter.future
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Correct the token bucket once the real usage of an admitted request is known"""
+        if actual_tokens is None:
+            return
+        if actual_tokens > estimated_tokens:
+            self.tokens.take(actual_tokens - estimated_tokens)
+        else:
+            self.tokens.give_back(estimated_tokens - actual_tokens)
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        expired = [entry for entry in self._queue if entry[2].deadline is not None and entry[2].deadline <= now]
+        if not expired:
+            return
+        self._queue = [entry for entry in self._queue if entry not in expired]
+        heapq.heapify(self._queue)
+        for _, _, waiter in expired:
+            if not waiter.future.done():
+                self.dropped[waiter.priority] += 1
+                waiter.future.set_exception(RequestDropped(f"{waiter.priority} request waited {now - waiter.enqueued:.1f}s and was dropped"))
+                logger.info(f"Dropped a stale {waiter.priority} Gemini request after {now - waiter.enqueued:.1f}s in queue")
+
+    async def _dispatch(self):
+        while self._queue:
+            self._drop_expired()
+            while self._queue and self._queue[0][2].future.done(): # caller gave up
+                heapq.heappop(self._queue)
+            if not self._queue:
+                break
+
+            waiter = self._queue[0][2]
+            wait = max(self.requests.wait_time(1), self.tokens.wait_time(waiter.tokens))
+            if wait <= 0:
+                heapq.heappop(self._queue)
+                self._admit(waiter.priority, waiter.tokens, time.monotonic() - waiter.enqueued)
+                waiter.future.set_result(None)
+                continue
+
+            deadlines = [entry[2].deadline for entry in self._queue if entry[2].deadline is not None]
+            if deadlines:
+                wait = min(wait, max(0.0, min(deadlines) - time.monotonic()))
+            self._wakeup.clear()
+            try: # a new, possibly more urgent request wakes the dispatcher early
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        depth = {name: 0 for name in PRIORITIES}
+        for _, _, waiter in self._queue:
+            if not waiter.future.done():
+                depth[waiter.priority] += 1
+        return {
+            "queue_depth": depth,
+            "admitted": dict(self.admitted),
+            "dropped": dict(self.dropped),
+            "avg_wait_seconds": {
+                name: self.wait_seconds[name] / self.admitted[name] if self.admitted[name] else 0.0
+                for name in PRIORITIES
+            },
+            "requests_per_minute": self.requests.per_minute,
+            "tokens_per_minute": self.tokens.per_minute,
+            "requests_available": None if self.requests.unlimited else round(self.requests.level, 2),
+            "tokens_available": None if self.tokens.unlimited else round(self.tokens.level)
+        }
@@ -0,0 +1,216 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import fnmatch
+import math
+import os
+import re
+import numpy as np
+
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_CAMEL_PARTS = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+def split_identifier(identifier: str) -> List[str]:
+    """fetchWeatherData / fetch_weather_data -> ["fetch", "weather", "data"]"""
+    parts = []
+    for piece in identifier.split("_"):
+        parts.extend(part.lower() for part in _CAMEL_PARTS.findall(piece))
+    return parts
+
+
+def tokenize_code(text: str) -> List[str]:
+    """Lowercased identifiers plus their camelCase/snake_case parts, so both
+    `fetchWeather` and "fetch weather" match the same code"""
+    tokens = []
+    for identifier in _IDENTIFIER.findall(text):
+        whole = identifier.lower()
+        tokens.append(whole)
+        parts = split_identifier(identifier)
+        if len(parts) > 1 or (parts and parts[0] != whole):
+            tokens.extend(parts)
+    return tokens
+
+
+_BACKTICKED = re.compile(r"`([^`\s]+)`")
+_CALL = re.compile(r"(?<![\w.])([A-Za-z_][\w.]*)\(\)")
+# Lookup phrasings whose subject is taken as an identifier, if it looks like code
+_LOOKUP = re.compile(
+    r"^(?:where(?:'s| is| are)\s+([\w.]+)\s+(?:defined|declared|implemented)"
+    r"|what does\s+([\w.]+)\s+(?:do|return)"
+    r"|(?:show me |find )?(?:the )?definition of\s+([\w.]+))[\s?.!]*$",
+    re.IGNORECASE
+)
+# camelCase, snake_case, dotted.path or PascalCase with a second hump. Words like
+# "GitHub" also match, so this only applies to the subject of a _LOOKUP phrasing
+_CODE_LIKE = re.compile(r"^(?:[a-z]+[A-Z]\w*|[A-Za-z]\w*_\w+|[A-Za-z_]\w*(?:\.\w+)+|[A-Z][a-z]+[A-Z]\w*)$")
+
+
+def find_identifier(query: str, max_words: int = 8) -> Optional[str]:
+    """Return the identifier when the query is clearly a lookup of one: a single
+    backticked name, a single name() call, or "where is X defined" / "what does
+    X do" about a code-like X. Anything else gets hybrid search, so None."""
+    backticked = _BACKTICKED.findall(query)
+    if len(backticked) == 1:
+        return backticked[0].rstrip("()")
+    if len(query.split()) > max_words:
+        return None
+    calls = _CALL.findall(query)
+    if len(calls) == 1:
+        return calls[0].split(".")[-1]
+    lookup = _LOOKUP.match(query.strip())
+    if lookup:
+        name = next(group for group in lookup.groups() if group)
+        if _CODE_LIKE.match(name):
+            return name.split(".")[-1]
+    return None
+
+
+class BM25Index:
+    """Inverted index with Okapi BM25 scoring over a collection's documents"""
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(documents)
+        postings: Dict[str, Dict[int, int]] = {}
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, document in enumerate(documents):
+            tokens = tokenize_code(document)
+            lengths[doc_id] = len(tokens)
+            for token in tokens:
+                counts = postings.setdefault(token, {})
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+
+        self.doc_lengths = lengths
+        self.avg_length = float(lengths.mean()) if len(documents) else 0.0
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {
+            token: (np.fromiter(counts.keys(), dtype=np.int64), np.fromiter(counts.values(), dtype=np.float32))
+            for token, counts in postings.items()
+        }
+
+    def __contains__(self, term: str) -> bool:
+        return term.lower() in self.postings
+
+    def idf(self, term: str) -> float:
+        doc_freq = len(self.postings[term][0])
+        return math.log(1 + (self.size - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def scores(self, query: str, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """BM25 score of every document (or of `rows`) for the query"""
+        scores = np.zeros(self.size, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(self.avg_length, 1e-9))
+        for term in set(tokenize_code(query)):
+            if term not in self.postings:
+                continue
+            doc_ids, freqs = self.postings[term]
+            scores[doc_ids] += self.idf(term) * freqs * (self.k1 + 1) / (freqs + norm[doc_ids])
+        return scores if rows is None else scores[rows]
+
+
+def reciprocal_rank_fusion(rankings: List[Sequence[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """Fuse ranked row lists; rows ranked high by either retriever float to the top"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+# Language names accepted by `where={"language": ...}` and recognised in questions
+LANGUAGE_EXTENSIONS: Dict[str, Tuple[str, ...]] = {
+    "python": (".py",),
+    "javascript": (".js", ".jsx"),
+    "typescript": (".ts", ".tsx"),
+    "html": (".html",),
+    "css": (".css",),
+    "markdown": (".md",),
+    "json": (".json",),
+    "java": (".java",),
+    "csharp": (".cs",),
+}
+_LANGUAGE_WORDS = {
+    "python": "python", "py": "python",
+    "javascript": "javascript", "js": "javascript", "jsx": "javascript",
+    "typescript": "typescript", "ts": "typescript", "tsx": "typescript",
+    "html": "html", "markup": "html",
+    "css": "css", "styles": "css", "stylesheet": "css", "stylesheets": "css", "styling": "css",
+    "markdown": "markdown", "readme": "markdown",
+    "java": "java",
+    "c#": "csharp", "csharp": "csharp",
+}
+
+
+def _as_tuple(value) -> Tuple[str, ...]:
+    return (value,) if isinstance(value, str) else tuple(value)
+
+
+class PathFilterIndex:
+    """Row masks over a collection's chunk paths for `where=` filters.
+
+    Supported keys (all given keys must match, a list value matches any of its items):
+    "path_prefix", "glob", "extension" and "language". Extension masks are
+    precomputed; prefix and glob masks are computed once and memoized.
+    """
+
+    def __init__(self, paths: Sequence[str]):
+        self.paths = list(paths)
+        self.size = len(self.paths)
+        rows_by_extension: Dict[str, List[int]] = {}
+        for row, path in enumerate(self.paths):
+            rows_by_extension.setdefault(os.path.splitext(path)[1].lower(), []).append(row)
+        self.extension_masks: Dict[str, np.ndarray] = {}
+        for extension, rows in rows_by_extension.items():
+            mask = np.zeros(self.size, dtype=bool)
+            mask[rows] = True
+            self.extension_masks[extension] = mask
+        self.top_dirs = {path.split("/", 1)[0] for path in self.paths if "/" in path}
+        self._memo: Dict[Tuple[str, str], np.ndarray] = {}
+
+    def _extension_mask(self, extensions: Iterable[str]) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        for extension in extensions:
+            extension = extension.lower() if extension.startswith(".") else "." + extension.lower()
+            if extension in self.extension_masks:
+                mask |= self.extension_masks[extension]
+        return mask
+
+    def _matching(self, kind: str, values: Iterable[str], matches) -> np.ndarray:
+        """Rows whose path matches any value; memoized per (kind, value)"""
+        mask = np.zeros(self.size, dtype=bool)
+        for value in values:
+            if (kind, value) not in self._memo:
+                self._memo[(kind, value)] = np.fromiter((matches(path, value) for path in self.paths), dtype=bool, count=self.size)
+            mask |= self._memo[(kind, value)]
+        return mask
+
+    def mask(self, where: Dict) -> np.ndarray:
+        mask = np.ones(self.size, dtype=bool)
+        for key, value in where.items():
+            values = _as_tuple(value)
+            if key == "extension":
+                mask &= self._extension_mask(values)
+            elif key == "language":
+                unknown = [language for language in values if language.lower() not in LANGUAGE_EXTENSIONS]
+                if unknown:
+                    raise ValueError(f"Unknown language filter: {unknown[0]}")
+                mask &= self._extension_mask(ext for language in values for ext in LANGUAGE_EXTENSIONS[language.lower()])
+            elif key == "path_prefix":
+                mask &= self._matching(key, values, str.startswith)
+            elif key == "glob":
+                mask &= self._matching(key, values, fnmatch.fnmatchcase)
+            else:
+                raise ValueError(f"Unsupported where filter: {key}")
+        return mask
+
+
+def infer_where(query: str, top_dirs: Iterable[str] = ()) -> Dict:
+    """Guess a filter from the question: a language ("the CSS", "python code")
+    and/or a top-level directory of the repo ("the backend routes")"""
+    words = re.findall(r"[a-z#]+", query.lower())
+    where = {}
+    languages = sorted({_LANGUAGE_WORDS[word] for word in words if word in _LANGUAGE_WORDS})
+    if languages:
+        where["language"] = languages
+    dirs = sorted(d for d in top_dirs if d.lower() in words)
+    if dirs:
+        where["path_prefix"] = [d + "/" for d in dirs]
+    return where
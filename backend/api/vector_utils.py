@@ -0,0 +1,311 @@
+from typing import List, Tuple
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """k-means on L2-normalized vectors using cosine similarity. Returns normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+
+        # Re-seed empty clusters with random points so every list stays useful
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1e-9
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+class IVFIndex:
+    """IVF-flat index over a collection's normalized matrix.
+
+    Rows are bucketed by their nearest k-means centroid. A search scores the
+    query against the centroids, then does an exact scan over the rows of the
+    `n_probe` closest lists only. More probes means better recall and slower queries.
+    """
+
+    def __init__(self, centroids: np.ndarray):
+        self.centroids = centroids
+        self.lists: List[np.ndarray] = [np.zeros(0, dtype=np.int64) for _ in range(len(centroids))]
+        self.size = 0
+        self.built_size = 0
+
+    @classmethod
+    def build(cls, normalized: np.ndarray, n_lists: int = None, train_size: int = 64, iterations: int = 10) -> "IVFIndex":
+        n_lists = n_lists or max(1, int(np.sqrt(len(normalized))))
+        n_lists = min(n_lists, len(normalized))
+
+        # Train on a sample: centroids converge long before every row has been seen
+        rng = np.random.default_rng(0)
+        sample_size = min(len(normalized), n_lists * train_size)
+        sample = normalized[np.sort(rng.choice(len(normalized), size=sample_size, replace=False))]
+        index = cls(spherical_kmeans(np.asarray(sample, dtype=np.float32), n_lists, iterations))
+        index.add(normalized, 0)
+        index.built_size = len(normalized)
+        logger.info(f"Built IVF index with {n_lists} lists over {len(normalized)} rows")
+        return index
+
+    def add(self, normalized_rows: np.ndarray, start_row: int):
+        """Assign new rows (numbered from start_row) to their nearest list"""
+        if not len(normalized_rows):
+            return
+        assignments = np.argmax(normalized_rows @ self.centroids.T, axis=1)
+        row_ids = np.arange(start_row, start_row + len(normalized_rows))
+        for list_id in np.unique(assignments):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], row_ids[assignments == list_id]])
+        self.size = max(self.size, start_row + len(normalized_rows))
+
+    def is_stale(self, growth: float = 2.0) -> bool:
+        """Centroids trained on a much smaller collection no longer partition it well"""
+        return self.size > self.built_size * growth
+
+    def to_arrays(self) -> dict:
+        """Everything needed to rebuild the index, as arrays for np.savez"""
+        lengths = np.array([len(ids) for ids in self.lists], dtype=np.int64)
+        return {
+            "centroids": self.centroids,
+            "rows": np.concatenate(self.lists) if self.lists else np.zeros(0, dtype=np.int64),
+            "offsets": np.concatenate([[0], np.cumsum(lengths)]),
+            "sizes": np.array([self.size, self.built_size], dtype=np.int64)
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "IVFIndex":
+        index = cls(np.asarray(arrays["centroids"], dtype=np.float32))
+        rows, offsets = arrays["rows"], arrays["offsets"]
+        index.lists = [rows[offsets[i]:offsets[i + 1]] for i in range(len(index.centroids))]
+        index.size, index.built_size = (int(size) for size in arrays["sizes"])
+        return index
+
+    def search(self, normalized: np.ndarray, queries: np.ndarray, k: int, n_probe: int, mask: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (indices, similarities) of shape (Q, k); rows with fewer than k
+        candidates are padded with index -1 and similarity -inf.
+        With a boolean row `mask` only the rows it selects are scored."""
+        n_probe = min(max(1, n_probe), len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, probe in enumerate(probes):
+            candidates = np.concatenate([self.lists[list_id] for list_id in probe])
+            if mask is not None:
+                candidates = candidates[mask[candidates]]
+            if not len(candidates):
+                continue
+            candidate_scores = normalized[candidates] @ queries[q]
+            take = min(k, len(candidates))
+            best = np.argpartition(-candidate_scores, take - 1)[:take]
+            best = best[np.argsort(-candidate_scores[best])]
+            indices[q, :take] = candidates[best]
+            scores[q, :take] = candidate_scores[best]
+        return indices, scores
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """Plain (euclidean) k-means, used to train product-quantizer codebooks"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_clusters, replace=False)].copy()
+    squared_norms = (vectors ** 2).sum(axis=1)
+    for _ in range(iterations):
+        distances = squared_norms[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        assignments = np.argmin(distances, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+            counts[empty] = 1
+        centroids = (sums / counts[:, None]).astype(np.float32)
+    return centroids
+
+
+class ScalarQuantizer:
+    """int8 scalar quantization: each dimension is mapped linearly from its
+    [min, max] over the training rows onto 0..255. Codes are (N, d) uint8,
+    4x smaller than float32 (8x smaller than float64)."""
+
+    mode = "int8"
+
+    def __init__(self, low: np.ndarray, scale: np.ndarray, trained_size: int = 0):
+        self.low = low.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+        self.trained_size = trained_size
+
+    def to_arrays(self) -> dict:
+        return {"low": self.low, "scale": self.scale, "trained_size": np.array(self.trained_size)}
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "ScalarQuantizer":
+        return cls(arrays["low"], arrays["scale"], int(arrays["trained_size"]))
+
+    @classmethod
+    def train(cls, vectors: np.ndarray) -> "ScalarQuantizer":
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        scale = (high - low) / 255.0
+        scale[scale == 0] = 1.0
+        return cls(low, scale, len(vectors))
+
+    @property
+    def nbytes(self) -> int:
+        return self.low.nbytes + self.scale.nbytes
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((vectors - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale + self.low
+
+    def scores(self, codes: np.ndarray, queries: np.ndarray, block_rows: int = 16384) -> np.ndarray:
+        """Asymmetric dot products: float queries against the codes, (Q, N).
+        Decoded in blocks so the float copy never exceeds block_rows rows."""
+        scaled_queries = queries * self.scale
+        offsets = queries @ self.low
+        out = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), block_rows):
+            block = codes[start:start + block_rows].astype(np.float32)
+            out[:, start:start + len(block)] = scaled_queries @ block.T + offsets[:, None]
+        return out
+
+    def is_stale(self, size: int, growth: float = 2.0) -> bool:
+        return size > self.trained_size * growth
+
+
+class ProductQuantizer:
+    """Product quantization: vectors are cut into subvectors of `sub_dim` dims and
+    each subvector is replaced by the id of its nearest codebook centroid. Codes are
+    (N, d / sub_dim) uint8; with sub_dim=4 that is 16x smaller than float32."""
+
+    mode = "pq"
+
+    def __init__(self, codebooks: np.ndarray, dim: int, trained_size: int = 0):
+        self.codebooks = codebooks.astype(np.float32) # (m, n_centroids, sub_dim)
+        self.dim = dim
+        self.trained_size = trained_size
+
+    def to_arrays(self) -> dict:
+        return {"codebooks": self.codebooks, "dim": np.array(self.dim), "trained_size": np.array(self.trained_size)}
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "ProductQuantizer":
+        return cls(arrays["codebooks"], int(arrays["dim"]), int(arrays["trained_size"]))
+
+    @property
+    def n_subspaces(self) -> int:
+        return self.codebooks.shape[0]
+
+    @property
+    def sub_dim(self) -> int:
+        return self.codebooks.shape[2]
+
+    @property
+    def nbytes(self) -> int:
+        return self.codebooks.nbytes
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, sub_dim: int = 4, n_centroids: int = 256, train_size: int = 2048, iterations: int = 8, seed: int = 0) -> "ProductQuantizer":
+        n_centroids = min(n_centroids, len(vectors), 256)
+        rng = np.random.default_rng(seed)
+        sample = vectors[np.sort(rng.choice(len(vectors), size=min(train_size, len(vectors)), replace=False))]
+        sub_dim = min(sub_dim, vectors.shape[1])
+        n_subspaces = -(-vectors.shape[1] // sub_dim)
+        quantizer = cls(np.zeros((n_subspaces, n_centroids, sub_dim), dtype=np.float32), vectors.shape[1], len(vectors))
+        subvectors = quantizer._split(np.asarray(sample, dtype=np.float32))
+        for j in range(n_subspaces):
+            quantizer.codebooks[j] = kmeans(np.ascontiguousarray(subvectors[:, j]), n_centroids, iterations, seed + j)
+        return quantizer
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """(N, d) -> (N, m, sub_dim), zero-padding d up to m * sub_dim"""
+        padded = np.zeros((len(vectors), self.n_subspaces * self.sub_dim), dtype=np.float32)
+        padded[:, :self.dim] = vectors
+        return padded.reshape(len(vectors), self.n_subspaces, self.sub_dim)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        subvectors = self._split(vectors)
+        codes = np.empty((len(vectors), self.n_subspaces), dtype=np.uint8)
+        for j in range(self.n_subspaces):
+            codebook = self.codebooks[j]
+            distances = -2 * subvectors[:, j] @ codebook.T + (codebook ** 2).sum(axis=1)[None, :]
+            codes[:, j] = np.argmin(distances, axis=1)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        rows = self.codebooks[np.arange(self.n_subspaces), codes] # (N, m, sub_dim)
+        return rows.reshape(len(codes), -1)[:, :self.dim]
+
+    def scores(self, codes: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Asymmetric distance computation: one (m, n_centroids) table of subvector
+        dot products per query, then each row's score is m table lookups"""
+        tables = np.einsum("qms,mks->qmk", self._split(queries), self.codebooks)
+        out = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            out += tables[:, j, codes[:, j]]
+        return out
+
+    def is_stale(self, size: int, growth: float = 2.0) -> bool:
+        return size > self.trained_size * growth
+
+
+QUANTIZERS = {quantizer.mode: quantizer for quantizer in (ScalarQuantizer, ProductQuantizer)}
+
+
+def save_quantizer(quantizer, codes: np.ndarray) -> dict:
+    """A trained quantizer, its codes and measured recall as arrays for np.savez"""
+    arrays = {f"q_{key}": value for key, value in quantizer.to_arrays().items()}
+    recall = getattr(quantizer, "recall", None) or {"adc": np.nan, "reranked": np.nan}
+    return dict(arrays, mode=np.array(quantizer.mode), codes=codes, recall=np.array([recall["adc"], recall["reranked"]]))
+
+
+def load_quantizer(arrays) -> Tuple[object, np.ndarray]:
+    """Inverse of save_quantizer: (quantizer, codes)"""
+    quantizer = QUANTIZERS[str(arrays["mode"])].from_arrays({key[2:]: arrays[key] for key in arrays.files if key.startswith("q_")})
+    adc, reranked = (float(value) for value in arrays["recall"])
+    quantizer.recall = {"adc": adc, "reranked": reranked}
+    return quantizer, np.asarray(arrays["codes"], dtype=np.uint8)
+
+
+class DecodedRows:
+    """Row access to quantized codes, so IVFIndex.search can score its
+    candidates without a float copy of the whole matrix"""
+
+    def __init__(self, quantizer, codes: np.ndarray):
+        self.quantizer = quantizer
+        self.codes = codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows) -> np.ndarray:
+        return self.quantizer.decode(self.codes[rows])
+
+
+def quantization_recall(quantizer, normalized: np.ndarray, codes: np.ndarray, k: int = 10, n_queries: int = 64, rerank_factor: int = 4, seed: int = 0) -> dict:
+    """recall@k of quantized search against the exact scan, using stored rows as
+    queries: "adc" ranks by the quantized scores alone, "reranked" re-scores the
+    top k * rerank_factor candidates exactly (what queries do)"""
+    k = min(k, len(normalized))
+    rng = np.random.default_rng(seed)
+    queries = normalized[rng.choice(len(normalized), size=min(n_queries, len(normalized)), replace=False)]
+    exact = np.argsort(-(queries @ normalized.T), axis=1)[:, :k]
+    approx_scores = quantizer.scores(codes, queries)
+    candidates = np.argsort(-approx_scores, axis=1)[:, :k * rerank_factor]
+    adc_hits = reranked_hits = 0
+    for q in range(len(queries)):
+        truth = set(exact[q].tolist())
+        adc_hits += len(truth & set(candidates[q, :k].tolist()))
+        reranked = candidates[q][np.argsort(-(normalized[candidates[q]] @ queries[q]))[:k]]
+        reranked_hits += len(truth & set(reranked.tolist()))
+    total = k * len(queries)
+    return {"adc": adc_hits / total, "reranked": reranked_hits / total}
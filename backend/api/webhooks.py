@@ -8,6 +8,7 @@ from models import User
 from sqlalchemy.future import select
 from .gamification_utils import update_effort_and_collaboration, update_quality
 from .ai_utils import analyze_diff
+from .resilience_utils import CircuitOpen, call_with_retries
 from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter(prefix="/webhooks", tags=["webhooks"])
@@ -39,15 +40,22 @@ async def process_pr_review(payload: dict, access_token: str):
         return
 
     # 1. Fetch Diff
-    async with httpx.AsyncClient() as client:
-        # We need to send headers to get the diff format, but diff_url is a public-ish redirect URL usually.
-        # But for private repos or better reliability we use API.
-        # Let's use the diff_url provided by webhook but add auth if needed.
-        diff_res = await client.get(diff_url, headers={"Authorization": f"token {access_token}"}, follow_redirects=True)
-        if diff_res.status_code != 200:
-            print(f"Failed to fetch diff: {diff_res.status_code}")
-            return
-        diff_content = diff_res.text
+    try:
+        async with httpx.AsyncClient() as client:
+            # We need to send headers to get the diff format, but diff_url is a public-ish redirect URL usually.
+            # But for private repos or better reliability we use API.
+            # Let's use the diff_url provided by webhook but add auth if needed.
+            diff_res = await call_with_retries(
+                "github.web",
+                lambda: client.get(diff_url, headers={"Authorization": f"token {access_token}"}, follow_redirects=True)
+            )
+            if diff_res.status_code != 200:
+                print(f"Failed to fetch diff: {diff_res.status_code}")
+                return
+            diff_content = diff_res.text
+    except (CircuitOpen, httpx.HTTPError) as e:
+        print(f"Failed to fetch diff: {e}")
+        return
 
     # 2. Analyze Code
     review_data = await analyze_diff(diff_content, title)
@@ -75,18 +83,22 @@ async def process_pr_review(payload: dict, access_token: str):
             "body": f"💡 {comment['message']}"  
         })
 
-    async with httpx.AsyncClient() as client:
-        post_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}/reviews"
-        post_res = await client.post(
-            post_url,
-            headers={
-                "Authorization": f"token {access_token}",
-                "Accept": "application/vnd.github.v3+json"
-            },
-            json=review_body
-        )
-        if post_res.status_code not in [200, 201]:
-             print(f"Failed to post review: {post_res.text}")
+    try:
+        async with httpx.AsyncClient() as client:
+            post_url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pull_number}/reviews"
+            # Not retried: a review that timed out may still have been posted
+            post_res = await call_with_retries("github.api", lambda: client.post(
+                post_url,
+                headers={
+                    "Authorization": f"token {access_token}",
+                    "Accept": "application/vnd.github.v3+json"
+                },
+                json=review_body
+            ), attempts=1)
+            if post_res.status_code not in [200, 201]:
+                 print(f"Failed to post review: {post_res.text}")
+    except (CircuitOpen, httpx.HTTPError) as e:
+        print(f"Failed to post review: {e}")
 
 @router.post("/github")
 async def github_webhook(request: Request, background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
@@ -0,0 +1,11 @@
+import sys
+from api.rag_utils import DB_PATH, migrate_json_store
+
+# One-shot conversion of simple_vector_db.json into the binary simple_vector_db/ store.
+# Usage: python migrate_vector_db.py [legacy_json_path] [store_dir]
+
+if __name__ == "__main__":
+    json_path = sys.argv[1] if len(sys.argv) > 1 else f"{DB_PATH}.json"
+    store_dir = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+    count = migrate_json_store(json_path, store_dir)
+    print(f"Migrated {count} collections into {store_dir}")
@@ -0,0 +1,46 @@
+from api.chunk_utils import chunk_braces, chunk_file, chunk_markdown, chunk_python
+
+PYTHON_SOURCE = '''import os
+
+# Reads the config
+def load_config(path):
+    with open(path) as f:
+        return f.read()
+
+
+class Weather:
+    def __init__(self, city):
+        self.city = city
+
+    def fetch(self):
+        return {"city": self.city}
+'''
+
+def test_python_chunks_follow_definitions():
+    chunks = chunk_python(PYTHON_SOURCE, max_chars=120)
+    assert [(c.start_line, c.end_line) for c in chunks] == [(1, 8), (9, 12), (13, 14)]
+    assert chunks[1].text.startswith("class Weather:\n    def __init__")
+    assert "".join(c.text for c in chunks) == PYTHON_SOURCE
+
+def test_python_splits_large_class_at_methods():
+    chunks = chunk_python(PYTHON_SOURCE, max_chars=70)
+    assert any(c.text.lstrip().startswith("def fetch") for c in chunks)
+    assert all(len(c.text) <= 70 for c in chunks)
+
+def test_small_definitions_are_packed_together():
+    assert len(chunk_python(PYTHON_SOURCE, max_chars=1500)) == 1
+
+def test_brace_chunks_cut_at_closed_blocks():
+    source = "function a() {\n  return 1;\n}\nfunction b() {\n  if (x) {\n    return 2;\n  }\n}\n"
+    chunks = chunk_braces(source, max_chars=50)
+    assert [(c.start_line, c.end_line) for c in chunks] == [(1, 3), (4, 8)]
+
+def test_markdown_chunks_split_at_headings():
+    source = "# Title\nintro\n\n## Setup\nnpm install\n```\n# not a heading\n```\n## Run\nnpm start\n"
+    chunks = chunk_markdown(source, max_chars=45)
+    assert [c.text.splitlines()[0] for c in chunks] == ["# Title", "## Setup", "## Run"]
+
+def test_chunk_file_falls_back_for_unknown_extensions():
+    chunks = chunk_file("page.html", "<html>\n\n<body>hi</body>\n</html>\n", max_chars=1000)
+    assert len(chunks) == 1
+    assert (chunks[0].start_line, chunks[0].end_line) == (1, 4)
@@ -0,0 +1,37 @@
+from api.context_utils import pack_context
+
+def test_overlapping_fixed_windows_are_stitched():
+    text = "".join(f"line {i} of the handler\n" for i in range(100))
+    first, second = text[:1000], text[800:1800]
+    context = pack_context([second, first], [
+        {"path": "app.js", "chunk_index": 1, "start_line": 34, "end_line": 76},
+        {"path": "app.js", "chunk_index": 0, "start_line": 1, "end_line": 43},
+    ])
+    assert context == "# app.js (lines 1-76)\n" + text[:1800].rstrip()
+
+def test_adjacent_line_chunks_merge_and_files_are_ordered():
+    context = pack_context(
+        ["def b():\n    return 2\n", "def a():\n    return 1\n", "body { color: red; }\n"],
+        [
+            {"path": "src/util.py", "chunk_index": 1, "start_line": 3, "end_line": 4},
+            {"path": "src/util.py", "chunk_index": 0, "start_line": 1, "end_line": 2},
+            {"path": "src/app.css", "chunk_index": 0, "start_line": 1, "end_line": 1},
+        ]
+    )
+    sections = context.split("\n---\n")
+    assert sections[0] == "# src/app.css (lines 1-1)\nbody { color: red; }"
+    assert sections[1] == "# src/util.py (lines 1-4)\ndef a():\n    return 1\ndef b():\n    return 2"
+
+def test_near_duplicates_dropped_and_budget_respected():
+    body = "".join(f"    value_{i} = compute({i})\n" for i in range(40))
+    documents = ["def setup():\n" + body, "def setup():\n" + body + "    return None\n", "x = 1\n" * 2000]
+    metadatas = [
+        {"path": "a/config.py", "chunk_index": 0, "start_line": 1, "end_line": 41},
+        {"path": "b/config_copy.py", "chunk_index": 0, "start_line": 1, "end_line": 42},
+        {"path": "big.py", "chunk_index": 0, "start_line": 1, "end_line": 2000},
+    ]
+    context = pack_context(documents, metadatas, token_budget=500)
+    assert "config_copy.py" not in context
+    assert "# a/config.py" in context
+    assert len(context) <= 500 * 4 + 100
+    assert "# big.py (lines 1-" in context
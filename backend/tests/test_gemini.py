@@ -0,0 +1,95 @@
+import asyncio
+import pytest
+from unittest.mock import MagicMock, patch
+from api import gemini_utils
+from api.scheduler_utils import RequestScheduler
+
+@pytest.fixture
+def fake_client():
+    in_flight = {"now": 0, "max": 0}
+
+    async def generate_content(model, contents, config=None):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.01 if contents != "slow" else 1)
+        in_flight["now"] -= 1
+        return MagicMock(text=f"re: {contents}")
+
+    client = MagicMock()
+    client.aio.models.generate_content = generate_content
+    client.in_flight = in_flight
+    with patch("api.gemini_utils.client", client), patch("api.gemini_utils._semaphore", asyncio.Semaphore(2)), \
+            patch("api.gemini_utils.scheduler", RequestScheduler(0, 0)), patch("api.resilience_utils.RETRY_BASE_DELAY", 0), \
+            patch("api.resilience_utils._breakers", {}):
+        yield client
+
+async def test_calls_run_concurrently_up_to_the_cap(fake_client):
+    answers = await asyncio.gather(*(gemini_utils.generate_text(f"q{i}") for i in range(6)))
+    assert answers == [f"re: q{i}" for i in range(6)]
+    assert fake_client.in_flight["max"] == 2
+    assert gemini_utils.stats()["in_flight"] == 0
+
+async def test_timeouts_and_missing_key(fake_client):
+    timeouts = gemini_utils.stats()["timeouts"]
+    with pytest.raises(asyncio.TimeoutError):
+        await gemini_utils.generate_text("slow", timeout=0.05)
+    assert gemini_utils.stats()["timeouts"] == timeouts + 3 # retried with backoff
+
+    with patch("api.gemini_utils.client", None):
+        with pytest.raises(gemini_utils.GeminiUnavailable):
+            await gemini_utils.generate_text("hello")
+
+async def test_cached_call_sites_reuse_valid_replies(fake_client, tmp_path):
+    from api.ai_utils import analyze_diff
+    calls = []
+    async def generate_content(model, contents, config=None):
+        calls.append(contents)
+        return MagicMock(text='```json\n{"summary": "Looks good", "comments": []}\n```' if len(calls) > 1 else "not json")
+    fake_client.aio.models.generate_content = generate_content
+
+    with patch("api.gemini_utils.RESPONSE_CACHE_PATH", str(tmp_path / "responses.sqlite3")), \
+            patch("api.gemini_utils._response_cache", None), patch("api.ai_utils.GEMINI_API_KEY", "key"):
+        assert "snag" in (await analyze_diff("+x = 1", "PR"))["summary"] # unparseable, so not cached
+        for _ in range(3):
+            assert (await analyze_diff("+x = 1", "PR"))["summary"] == "Looks good"
+        assert len(calls) == 2
+        await analyze_diff("+x = 2", "PR")
+        assert len(calls) == 3
+
+        with patch("api.gemini_utils.RESPONSE_CACHE_DISABLED_SITES", {"pr_review"}):
+            await analyze_diff("+x = 1", "PR")
+        assert len(calls) == 4
+        cache = gemini_utils.stats()["response_cache"]
+        assert cache["sites"]["pr_review"] == {"hits": 2, "misses": 3}
+        assert cache["entries"] == 2
+
+def test_response_cache_expires_and_evicts(tmp_path):
+    from api.cache_utils import ResponseCache
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), max_entries=2)
+    key = ResponseCache.key("model", "prompt", {"temperature": 0})
+    assert key != ResponseCache.key("model", "prompt", {"temperature": 1})
+    cache.put(key, "stale", ttl_seconds=-1)
+    assert cache.get(key) is None
+    for i in range(3):
+        cache.put(f"k{i}", f"v{i}")
+    assert cache.get("k0") is None and cache.get("k2") == "v2"
+    assert cache.stats()["entries"] == 2
+
+def test_response_cache_hits_do_not_write(tmp_path):
+    from api.cache_utils import ResponseCache
+    cache = ResponseCache(str(tmp_path / "responses.sqlite3"), max_entries=2)
+    cache.put("old", "v0")
+    cache.put("new", "v1")
+    changes = cache._conn.total_changes
+    assert cache.get("old") == "v0"
+    assert cache._conn.total_changes == changes
+    cache.put("third", "v2") # the pending hit is written first, so "new" is evicted
+    assert cache.get("old") == "v0" and cache.get("new") is None
+
+async def test_identical_prompts_in_flight_share_one_request(fake_client):
+    from api.resilience_utils import single_flight
+    coalesced = single_flight("gemini").coalesced
+    answers = await asyncio.gather(*(gemini_utils.generate_text("same question") for _ in range(4)))
+    assert answers == ["re: same question"] * 4
+    assert fake_client.in_flight["max"] == 1
+    assert single_flight("gemini").coalesced == coalesced + 3
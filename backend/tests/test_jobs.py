@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, patch
+from api.job_utils import IndexingJobManager
+
+@pytest.fixture
+def emit():
+    with patch("api.job_utils.sio.emit", new_callable=AsyncMock) as emit:
+        yield emit
+
+async def test_job_reports_progress_and_completes(emit):
+    manager = IndexingJobManager()
+
+    async def work(job):
+        await manager.report(job, files_total=2, files_fetched=2)
+        await manager.report(job, chunks_total=5, chunks_embedded=5)
+
+    job = manager.submit(1, "owner/repo", "index", work)
+    await job.task
+    assert job.status == "completed"
+    assert job.progress == {"files_total": 2, "files_fetched": 2, "chunks_total": 5, "chunks_embedded": 5}
+    statuses = [call.args[1]["status"] for call in emit.call_args_list]
+    assert statuses[0] == "queued" and statuses[-1] == "completed"
+    assert all(call.args[0] == "indexing_progress" for call in emit.call_args_list)
+
+async def test_active_job_is_reused_per_user_and_repo(emit):
+    manager = IndexingJobManager()
+    release = asyncio.Event()
+
+    async def work(job):
+        await release.wait()
+
+    first = manager.submit(1, "owner/repo", "sync", work)
+    assert manager.submit(1, "owner/repo", "sync", work) is first
+    other = manager.submit(2, "owner/repo", "sync", work)
+    assert other is not first
+    release.set()
+    await asyncio.gather(first.task, other.task)
+    assert manager.submit(1, "owner/repo", "sync", work) is not first
+
+async def test_concurrency_cap_queues_jobs(emit):
+    manager = IndexingJobManager(max_concurrent=1)
+    release = asyncio.Event()
+
+    async def work(job):
+        await release.wait()
+
+    first = manager.submit(1, "owner/a", "sync", work)
+    second = manager.submit(2, "owner/b", "sync", work)
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert (first.status, second.status) == ("running", "queued")
+    release.set()
+    await asyncio.gather(first.task, second.task)
+    assert second.status == "completed"
+
+async def test_cancel_and_failures(emit):
+    manager = IndexingJobManager()
+
+    async def slow(job):
+        await asyncio.sleep(10)
+
+    async def broken(job):
+        raise RuntimeError("GitHub is down")
+
+    async def unsuccessful(job):
+        return False
+
+    job = manager.submit(1, "owner/repo", "sync", slow)
+    await asyncio.sleep(0)
+    assert manager.cancel(job.id)
+    await job.task
+    assert job.status == "cancelled"
+    assert not manager.cancel(job.id)
+
+    failed = manager.submit(1, "owner/repo", "sync", broken)
+    await failed.task
+    assert (failed.status, failed.error) == ("failed", "GitHub is down")
+    unsuccessful_job = manager.submit(1, "owner/repo", "sync", unsuccessful)
+    await unsuccessful_job.task
+    assert unsuccessful_job.status == "failed"
@@ -1,11 +1,22 @@
+import asyncio
+import base64
+import json
+import numpy as np
 import pytest
-from unittest.mock import MagicMock, patch
-from api.rag_utils import RepositoryRAG
+from unittest.mock import AsyncMock, MagicMock, patch
+from google.genai import errors as genai_errors
+import io
+import tarfile
+from api.rag_utils import RepositoryRAG, SimpleVectorDB, git_blob_sha, admit_path, extract_archive, resident_bytes
+from api.cache_utils import EmbeddingCache, TTLCache, normalize_query
+
+async def fake_embed_texts(texts, task_type="RETRIEVAL_DOCUMENT", progress=None):
+    return [[0.1] * 768 for _ in texts]
 
 @pytest.fixture
-def rag_engine_real():
+def rag_engine_real(tmp_path):
     # This uses the real RepositoryRAG which now includes the pydantic monkeypatch
-    return RepositoryRAG()
+    return RepositoryRAG(db_path=str(tmp_path / "simple_vector_db"))
 
 @pytest.mark.asyncio
 async def test_chunk_text(rag_engine_real):
@@ -17,7 +28,7 @@ async def test_chunk_text(rag_engine_real):
 @pytest.mark.asyncio
 async def test_get_embedding_fallback(rag_engine_real):
     # Test fallback when client is None
-    with patch('api.rag_utils.client', None):
+    with patch('api.gemini_utils.client', None):
         embedding = await rag_engine_real.get_embedding("test")
         assert len(embedding) == 768
         assert embedding[0] == 0.0
@@ -41,3 +52,599 @@ async def test_index_files_basic(rag_engine_real):
             args, kwargs = mock_collection.add.call_args
             assert kwargs['ids'][0] == "main.py_chunk_0"
             assert kwargs['metadatas'][0]['path'] == "main.py"
+
+def test_vector_db_persist_roundtrip(tmp_path):
+    store = str(tmp_path / "store")
+    db = SimpleVectorDB(store)
+    collection = db.get_or_create_collection("user_1_owner_repo")
+    collection.add(ids=["a_chunk_0"], embeddings=[[1.0, 0.0]], metadatas=[{"path": "a", "chunk_index": 0}], documents=["alpha"])
+    collection.add(ids=["b_chunk_0"], embeddings=[[0.0, 1.0]], metadatas=[{"path": "b", "chunk_index": 0}], documents=["beta"])
+    assert db.flush(timeout=10)
+
+    reloaded = SimpleVectorDB(store)
+    embeddings = reloaded.embeddings("user_1_owner_repo")
+    assert isinstance(embeddings, np.memmap)
+    assert embeddings.dtype == np.float32
+    results = reloaded.get_collection("user_1_owner_repo").query(query_embeddings=[[0.1, 0.9]], n_results=1)
+    assert results["documents"][0] == ["beta"]
+
+def test_vector_db_migrates_legacy_json(tmp_path):
+    store = tmp_path / "store"
+    legacy = {"user_1_owner_repo": {"embeddings": [[0.5, 0.5]], "documents": ["doc"], "metadatas": [{"path": "x", "chunk_index": 0}], "ids": ["x_chunk_0"]}}
+    (tmp_path / "store.json").write_text(json.dumps(legacy))
+
+    db = SimpleVectorDB(str(store))
+    assert len(list(store.glob("user_1_owner_repo@*.npy"))) == 2 # raw and normalized matrix
+    assert db.data["user_1_owner_repo"]["ids"] == ["x_chunk_0"]
+    assert db.embeddings("user_1_owner_repo").shape == (1, 2)
+
+def test_normalized_matrix_tracks_adds_and_reset(tmp_path):
+    db = SimpleVectorDB(str(tmp_path / "store"))
+    collection = db.get_or_create_collection("c")
+    collection.add(ids=["a"], embeddings=[[3.0, 4.0]], metadatas=[{"path": "a", "chunk_index": 0}], documents=["a"])
+    collection.add(ids=["b"], embeddings=[[0.0, 2.0]], metadatas=[{"path": "b", "chunk_index": 0}], documents=["b"])
+
+    normalized = db.normalized("c")
+    assert normalized.flags["C_CONTIGUOUS"]
+    np.testing.assert_allclose(normalized, [[0.6, 0.8], [0.0, 1.0]], rtol=1e-6)
+
+    db.reset_collection("c")
+    assert db.normalized("c").shape[0] == 0
+
+def test_batched_query_returns_per_query_results(tmp_path):
+    db = SimpleVectorDB(str(tmp_path / "store"))
+    collection = db.get_or_create_collection("c")
+    vectors = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0], [0.7, 0.7, 0.0]]
+    collection.add(
+        ids=[f"doc_{i}" for i in range(4)],
+        embeddings=vectors,
+        metadatas=[{"path": f"f{i}", "chunk_index": 0} for i in range(4)],
+        documents=[f"text {i}" for i in range(4)]
+    )
+
+    results = collection.query(query_embeddings=[[1.0, 0.1, 0.0], [0.0, 0.0, 2.0]], n_results=2)
+    assert results["ids"][0] == ["doc_0", "doc_3"]
+    assert results["documents"][1][0] == "text 2"
+    assert results["metadatas"][1][0] == {"path": "f2", "chunk_index": 0}
+    assert results["distances"][1][0] == pytest.approx(0.0, abs=1e-6)
+    assert results["distances"][0][0] <= results["distances"][0][1]
+
+def test_ivf_index_used_above_threshold(tmp_path):
+    rng = np.random.default_rng(42)
+    vectors = rng.normal(size=(600, 16)).astype(np.float32)
+    db = SimpleVectorDB(str(tmp_path / "store"))
+    collection = db.get_or_create_collection("c")
+    collection.add(
+        ids=[f"doc_{i}" for i in range(600)],
+        embeddings=vectors,
+        metadatas=[{"path": f"f{i}", "chunk_index": 0} for i in range(600)],
+        documents=[f"text {i}" for i in range(600)]
+    )
+
+    with patch("api.rag_utils.ANN_MIN_ROWS", 1000):
+        assert db.ann_index("c") is None
+    with patch("api.rag_utils.ANN_MIN_ROWS", 100):
+        exact = collection.query(query_embeddings=vectors[:20], n_results=1, n_probe=10**6)
+        assert db.ann_index("c") is not None
+        assert [ids[0] for ids in exact["ids"]] == [f"doc_{i}" for i in range(20)]
+        approx = collection.query(query_embeddings=vectors[:20], n_results=5, n_probe=4)
+        recall = np.mean([ids[0] == f"doc_{i}" for i, ids in enumerate(approx["ids"])])
+        assert recall >= 0.9
+
+@pytest.mark.asyncio
+async def test_ivf_index_is_built_off_the_event_loop_and_saved_with_the_segment(tmp_path):
+    rng = np.random.default_rng(7)
+    vectors = rng.normal(size=(300, 16)).astype(np.float32)
+    store = str(tmp_path / "store")
+    db = SimpleVectorDB(store)
+    collection = db.get_or_create_collection("c")
+    collection.add(ids=[f"doc_{i}" for i in range(300)], embeddings=vectors,
+                   metadatas=[{"path": f"f{i}"} for i in range(300)], documents=[f"text {i}" for i in range(300)])
+
+    with patch("api.rag_utils.ANN_MIN_ROWS", 100):
+        # The first query scans exactly while the index is built in a worker thread
+        assert collection.query(query_embeddings=vectors[:1], n_results=1)["ids"][0] == ["doc_0"]
+        assert db.data["c"]["ann"] is None
+        await db._indexing["c"]
+        assert db.data["c"]["ann"] is not None
+        assert db.flush(timeout=10)
+
+        reloaded = SimpleVectorDB(store)
+        with patch("api.rag_utils.IVFIndex.build", side_effect=AssertionError("rebuilt")):
+            assert reloaded.get_collection("c").query(query_embeddings=vectors[5:6], n_results=1)["ids"][0] == ["doc_5"]
+            assert reloaded.data["c"]["ann"].size == 300
+
+@pytest.mark.asyncio
+async def test_update_files_only_touches_changed_paths(rag_engine_real):
+    with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+        await rag_engine_real.index_files(1, "owner/repo", {"a.py": "print('alpha')", "b.py": "print('beta')", "c.py": "print('gamma')"})
+        collection = rag_engine_real.vector_db.get_collection("user_1_owner_repo")
+        assert collection.indexed_files()["a.py"] == git_blob_sha("print('alpha')")
+
+        await rag_engine_real.update_files(1, "owner/repo", {"b.py": "print('beta v2')"}, removed_paths=["c.py"])
+
+    data = rag_engine_real.vector_db.data["user_1_owner_repo"]
+    assert data["documents"] == ["print('alpha')", "print('beta v2')"]
+    assert data["metadatas"][1] == {"path": "b.py", "chunk_index": 0, "start_line": 1, "end_line": 1}
+    assert set(collection.indexed_files()) == {"a.py", "b.py"}
+    assert rag_engine_real.vector_db.normalized("user_1_owner_repo").shape == (2, 768)
+
+@pytest.mark.asyncio
+async def test_sync_with_github_fetches_only_changed_blobs(rag_engine_real):
+    with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+        await rag_engine_real.index_files(1, "owner/repo", {"a.py": "print('alpha')", "gone.py": "print('removed')"})
+
+    new_content = "print('alpha v2')"
+    tree = [
+        {"type": "blob", "path": "a.py", "sha": git_blob_sha(new_content), "url": "blob/a"},
+        {"type": "blob", "path": "b.py", "sha": git_blob_sha("print('beta')"), "url": "blob/b"},
+    ]
+    blobs = {"blob/a": new_content, "blob/b": "print('beta')"}
+    requested = []
+
+    async def fake_get(url, headers=None):
+        requested.append(url)
+        if url.endswith("/commits"):
+            return MagicMock(status_code=200, json=lambda: [{"sha": "new"}])
+        if "/git/trees/" in url:
+            return MagicMock(status_code=200, json=lambda: {"tree": tree})
+        return MagicMock(status_code=200, json=lambda: {"content": base64.b64encode(blobs[url].encode()).decode()})
+
+    github_client = MagicMock(get=fake_get)
+    github_client.__aenter__ = AsyncMock(return_value=github_client)
+    github_client.__aexit__ = AsyncMock(return_value=False)
+    user = MagicMock(last_indexed_commit="old")
+    db_session = MagicMock(execute=AsyncMock(return_value=MagicMock(scalar_one_or_none=lambda: user)), commit=AsyncMock())
+
+    with patch("api.rag_utils.httpx.AsyncClient", return_value=github_client):
+        with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts) as embed_texts:
+            assert await rag_engine_real.sync_with_github(1, "owner/repo", "token", db_session)
+
+    assert [url for url in requested if url.startswith("blob/")] == ["blob/a", "blob/b"]
+    assert embed_texts.call_args.args[0] == [new_content, "print('beta')"]
+    files = rag_engine_real.vector_db.get_collection("user_1_owner_repo").indexed_files()
+    assert set(files) == {"a.py", "b.py"}
+    assert user.last_indexed_commit == "new"
+
+    async def embed_nothing(texts, task_type="RETRIEVAL_DOCUMENT", progress=None):
+        return [None for _ in texts]
+    user.last_indexed_commit = "old"
+    tree[0]["sha"] = git_blob_sha("print('alpha v3')")
+    blobs["blob/a"] = "print('alpha v3')"
+    with patch("api.rag_utils.httpx.AsyncClient", return_value=github_client):
+        with patch.object(rag_engine_real, 'embed_texts', side_effect=embed_nothing):
+            assert not await rag_engine_real.sync_with_github(1, "owner/repo", "token", db_session)
+    assert user.last_indexed_commit == "old" # retried on the next sync
+
+@pytest.mark.asyncio
+async def test_embed_texts_batches_and_retries(rag_engine_real):
+    calls = []
+
+    async def embed_content(model, contents, config):
+        calls.append(list(contents))
+        if len(calls) == 1:
+            raise genai_errors.ServerError(503, {"error": {"code": 503, "message": "UNAVAILABLE", "status": "UNAVAILABLE"}})
+        return MagicMock(embeddings=[MagicMock(values=[float(len(text))]) for text in contents])
+
+    fake_client = MagicMock()
+    fake_client.aio.models.embed_content = embed_content
+    texts = ["x" * i for i in range(1, 6)]
+    with patch("api.gemini_utils.client", fake_client), patch("api.rag_utils.EMBED_BATCH_SIZE", 2), patch("api.resilience_utils.RETRY_BASE_DELAY", 0):
+        embeddings = await rag_engine_real.embed_texts(texts)
+
+    assert embeddings == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    assert len(calls) == 4 # three batches, one retried
+    assert rag_engine_real.embedding_stats["chunks"] == 5
+
+@pytest.mark.asyncio
+async def test_failed_embeddings_are_not_stored_or_recorded(rag_engine_real):
+    async def embed_content(model, contents, config):
+        if any("beta" in text for text in contents):
+            raise genai_errors.ServerError(503, {"error": {"code": 503, "message": "UNAVAILABLE", "status": "UNAVAILABLE"}})
+        return MagicMock(embeddings=[MagicMock(values=[0.5] * 768) for _ in contents])
+
+    fake_client = MagicMock()
+    fake_client.aio.models.embed_content = embed_content
+    files = {"a.py": "print('alpha')", "b.py": "print('beta')"}
+    with patch("api.gemini_utils.client", fake_client), patch("api.rag_utils.EMBED_BATCH_SIZE", 1), \
+            patch("api.resilience_utils.RETRY_BASE_DELAY", 0), patch("api.resilience_utils._breakers", {}):
+        assert not await rag_engine_real.index_files(1, "owner/repo", files)
+        collection = rag_engine_real.vector_db.get_collection("user_1_owner_repo")
+        assert set(collection.indexed_files()) == {"a.py"} # b.py is fetched again by the next sync
+        assert rag_engine_real.vector_db.data["user_1_owner_repo"]["documents"] == ["print('alpha')"]
+        assert rag_engine_real.vector_db.embeddings("user_1_owner_repo").any(axis=1).all() # no zero vectors
+
+        async def embed_all(model, contents, config):
+            return MagicMock(embeddings=[MagicMock(values=[0.5] * 768) for _ in contents])
+        fake_client.aio.models.embed_content = embed_all
+        assert await rag_engine_real.update_files(1, "owner/repo", {"b.py": files["b.py"]})
+    assert set(collection.indexed_files()) == {"a.py", "b.py"}
+
+def test_embedding_cache_lru_eviction(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    keys = [EmbeddingCache.key("model", "RETRIEVAL_DOCUMENT", text) for text in ("a", "b", "c")]
+    cache.put(keys[0], [1.0])
+    cache.put(keys[1], [2.0])
+    assert cache.get(keys[0]) == [1.0] # refreshes "a", so "b" is now least recently used
+    cache.put(keys[2], [3.0])
+
+    assert cache.get(keys[1]) is None
+    assert cache.get_many(keys) == {keys[0]: [1.0], keys[2]: [3.0]}
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 2
+
+def test_embedding_cache_hits_write_last_used_in_batches(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"))
+    key = EmbeddingCache.key("model", "RETRIEVAL_DOCUMENT", "a")
+    cache.put(key, [1.0])
+    changes = cache._conn.total_changes
+    for _ in range(5):
+        assert cache.get(key) == [1.0]
+    assert cache._conn.total_changes == changes # hits stay in memory
+    with patch("api.cache_utils.TOUCH_FLUSH_SECONDS", 0):
+        cache.get(key)
+    assert cache._conn.total_changes == changes + 1
+    assert cache._conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+@pytest.mark.asyncio
+async def test_embed_texts_serves_repeated_content_from_cache(rag_engine_real):
+    embed_content = AsyncMock(side_effect=lambda model, contents, config: MagicMock(embeddings=[MagicMock(values=[0.5]) for _ in contents]))
+    fake_client = MagicMock()
+    fake_client.aio.models.embed_content = embed_content
+    with patch("api.gemini_utils.client", fake_client):
+        await rag_engine_real.embed_texts(["# README", "# README", "body"])
+        assert await rag_engine_real.embed_texts(["body", "# README"]) == [[0.5], [0.5]]
+
+    assert embed_content.call_count == 1
+    assert embed_content.call_args.kwargs["contents"] == ["# README", "body"]
+
+@pytest.mark.asyncio
+async def test_indexing_reports_progress_and_cancellation_leaves_files_unrecorded(rag_engine_real):
+    embed_content = AsyncMock(side_effect=lambda model, contents, config: MagicMock(embeddings=[MagicMock(values=[0.5]) for _ in contents]))
+    fake_client = MagicMock()
+    fake_client.aio.models.embed_content = embed_content
+    reports = []
+    async def progress(**counters):
+        reports.append(counters)
+    with patch("api.gemini_utils.client", fake_client):
+        await rag_engine_real.embed_texts(["cached"])
+        await rag_engine_real.embed_texts(["cached", "a", "b"], progress=progress)
+    assert reports[0] == {"chunks_total": 3, "chunks_embedded": 1}
+    assert reports[-1] == {"chunks_embedded": 3}
+
+    async def cancelled(texts, task_type="RETRIEVAL_DOCUMENT", progress=None):
+        raise asyncio.CancelledError()
+    with patch.object(rag_engine_real, 'embed_texts', side_effect=cancelled):
+        with pytest.raises(asyncio.CancelledError):
+            await rag_engine_real.index_files(1, "owner/repo", {"a.py": "print('alpha')"})
+    # Nothing recorded as indexed, so the next sync fetches the file again
+    assert rag_engine_real.vector_db.get_collection("user_1_owner_repo").indexed_files() == {}
+
+def test_persist_writes_only_dirty_collections(tmp_path):
+    from api import rag_utils
+    db = SimpleVectorDB(str(tmp_path / "store"))
+    for name in ("user_1_a", "user_2_b"):
+        db.get_or_create_collection(name).add(ids=["x"], embeddings=[[1.0, 0.0]], metadatas=[{"path": "x", "chunk_index": 0}], documents=["x"])
+    assert db.flush(timeout=10)
+
+    with patch("api.rag_utils.write_collection", wraps=rag_utils.write_collection) as write_collection:
+        db.get_collection("user_2_b").add(ids=["y"], embeddings=[[0.0, 1.0]], metadatas=[{"path": "y", "chunk_index": 0}], documents=["y"])
+        assert db.flush(timeout=10)
+        assert db.flush(timeout=10)
+
+    assert [c.args[1] for c in write_collection.call_args_list] == ["user_2_b"]
+    assert SimpleVectorDB(str(tmp_path / "store")).data["user_2_b"]["ids"] == ["x", "y"]
+    assert not list((tmp_path / "store").glob("*.tmp"))
+
+def test_collections_load_lazily_and_evict_under_budget(tmp_path):
+    store = str(tmp_path / "store")
+    db = SimpleVectorDB(store)
+    for name in ("user_1_a", "user_2_b", "user_3_c"):
+        db.get_or_create_collection(name).add(ids=["x"], embeddings=np.ones((1, 256)), metadatas=[{"path": "x", "chunk_index": 0}], documents=["x" * 1000])
+    assert db.flush(timeout=10)
+
+    reopened = SimpleVectorDB(store, memory_budget_bytes=1500)
+    assert sorted(c.name for c in reopened.list_collections()) == ["user_1_a", "user_2_b", "user_3_c"]
+    assert reopened.data.loaded() == []
+
+    for name in ("user_1_a", "user_2_b", "user_3_c"):
+        reopened.get_collection(name).query(query_embeddings=[np.ones(256)], n_results=1)
+    # Matrices are shared memmaps; each collection's 1KB of documents is private, so only one fits the budget
+    assert reopened.data.loaded() == ["user_3_c"]
+    assert reopened.get_collection("user_1_a").query(query_embeddings=[np.ones(256)], n_results=1)["ids"] == [["x"]]
+
+def make_tarball(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for path, data in files.items():
+            info = tarfile.TarInfo(f"owner-repo-abc123/{path}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def test_admit_path_skips_vendored_and_lockfiles():
+    assert admit_path("src/app.js")
+    assert admit_path("README.md", size=1024)
+    assert not admit_path("node_modules/react/index.js")
+    assert not admit_path("package-lock.json")
+    assert not admit_path("static/app.min.js")
+    assert not admit_path("logo.png")
+    assert not admit_path("data/huge.json", size=10 * 1024 * 1024)
+
+def test_extract_archive_returns_only_wanted_text_files():
+    archive = make_tarball({"app.js": b"console.log(1)", "util.js": b"export {}", "bin.json": b"\x00\x01binary"})
+    assert extract_archive(archive, ["app.js", "bin.json"]) == {"app.js": "console.log(1)"}
+
+@pytest.mark.asyncio
+async def test_sync_with_github_uses_tarball_for_large_changes(rag_engine_real):
+    files = {"a.py": b"print('alpha')", "b.py": b"print('beta')"}
+    tree = [{"type": "blob", "path": path, "sha": git_blob_sha(data.decode()), "url": f"blob/{path}", "size": len(data)} for path, data in files.items()]
+    tree.append({"type": "blob", "path": "node_modules/x/index.js", "sha": "x", "url": "blob/x", "size": 10})
+    requested = []
+
+    async def fake_get(url, headers=None):
+        requested.append(url)
+        if url.endswith("/commits"):
+            return MagicMock(status_code=200, json=lambda: [{"sha": "abc123"}])
+        return MagicMock(status_code=200, json=lambda: {"tree": tree})
+
+    async def aiter_bytes():
+        yield make_tarball(files)
+
+    def fake_stream(method, url, headers=None, follow_redirects=False):
+        requested.append(url)
+        stream = MagicMock(status_code=200, aiter_bytes=aiter_bytes)
+        context = MagicMock()
+        context.__aenter__ = AsyncMock(return_value=stream)
+        context.__aexit__ = AsyncMock(return_value=False)
+        return context
+
+    github_client = MagicMock(get=fake_get, stream=fake_stream)
+    github_client.__aenter__ = AsyncMock(return_value=github_client)
+    github_client.__aexit__ = AsyncMock(return_value=False)
+    user = MagicMock(last_indexed_commit=None)
+    db_session = MagicMock(execute=AsyncMock(return_value=MagicMock(scalar_one_or_none=lambda: user)), commit=AsyncMock())
+
+    with patch("api.rag_utils.httpx.AsyncClient", return_value=github_client), patch("api.rag_utils.ARCHIVE_MIN_FILES", 2):
+        with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+            assert await rag_engine_real.sync_with_github(1, "owner/repo", "token", db_session)
+
+    assert requested[-1] == "https://api.github.com/repos/owner/repo/tarball/abc123"
+    assert not any(url.startswith("blob/") for url in requested)
+    assert set(rag_engine_real.vector_db.get_collection("user_1_owner_repo").indexed_files()) == {"a.py", "b.py"}
+
+@pytest.mark.asyncio
+async def test_cdc_update_reembeds_only_changed_chunks(rag_engine_real):
+    lines = [f"const value{i} = compute({i}, 'some padding text to make lines longer');\n" for i in range(200)]
+    original = "".join(lines)
+    edited = "".join(lines[:100] + ["// a new comment\n"] + lines[100:])
+
+    with patch("api.rag_utils.CHUNKING_MODE", "cdc"):
+        with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+            await rag_engine_real.index_files(1, "owner/repo", {"app.js": original})
+        data = rag_engine_real.vector_db.data["user_1_owner_repo"]
+        chunk_count = len(data["ids"])
+        assert chunk_count > 4
+        assert all(chunk_id.startswith("app.js#") for chunk_id in data["ids"])
+
+        with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts) as embed_texts:
+            await rag_engine_real.update_files(1, "owner/repo", {"app.js": edited})
+
+    embedded = embed_texts.call_args.args[0]
+    assert 1 <= len(embedded) <= 2
+    assert any("// a new comment" in text for text in embedded)
+    data = rag_engine_real.vector_db.data["user_1_owner_repo"]
+    rebuilt = "".join(document for _, document in sorted(zip([m["start_line"] for m in data["metadatas"]], data["documents"])))
+    assert rebuilt == edited
+
+@pytest.mark.asyncio
+async def test_query_identifier_lookup_skips_embedding(rag_engine_real):
+    files = {
+        "weather.py": "def fetch_weather(city):\n    return requests.get(f'/weather/{city}')\n",
+        "config.py": "def load_config(path):\n    with open(path) as f:\n        return f.read()\n",
+    }
+    with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+        await rag_engine_real.index_files(1, "owner/repo", files)
+
+    collection = rag_engine_real.vector_db.get_collection("user_1_owner_repo")
+    results = collection.keyword_query(["fetch_weather"], n_results=5)
+    assert results["metadatas"][0][0]["path"] == "weather.py"
+
+    with patch.object(rag_engine_real, 'get_embedding', new_callable=AsyncMock, return_value=[0.1] * 768) as get_embedding, \
+            patch('api.gemini_utils.client', None):
+        await rag_engine_real.query(1, "owner/repo", "where is `fetch_weather` defined?")
+        assert not get_embedding.called
+        await rag_engine_real.query(1, "owner/repo", "how are settings read from disk?")
+        assert get_embedding.called
+
+def test_hybrid_query_fuses_keyword_matches(tmp_path):
+    db = SimpleVectorDB(str(tmp_path / "store"))
+    collection = db.get_or_create_collection("c")
+    documents = [f"def helper_{i}(): pass" for i in range(9)] + ["def parse_invoice(data): return data"]
+    embeddings = [[1.0, 0.0]] * 9 + [[0.0, 1.0]]
+    collection.add(ids=[f"id{i}" for i in range(10)], embeddings=embeddings,
+                   metadatas=[{"path": f"f{i}.py"} for i in range(10)], documents=documents)
+
+    vector_only = collection.query(query_embeddings=[[1.0, 0.0]], n_results=3)
+    assert "id9" not in vector_only["ids"][0]
+    hybrid = collection.query(query_embeddings=[[1.0, 0.0]], n_results=3, query_texts=["parse invoice"])
+    assert "id9" in hybrid["ids"][0]
+    assert hybrid["distances"][0][hybrid["ids"][0].index("id9")] > 0.9
+
+    collection.add(ids=["id10"], embeddings=[[1.0, 0.0]], metadatas=[{"path": "g.py"}], documents=["def render_invoice(): pass"])
+    assert db.data["c"]["bm25"] is None # invalidated, rebuilt on the next keyword query
+    assert collection.keyword_query(["render_invoice"])["ids"][0][0] == "id10"
+
+def test_query_where_filters_scan_only_matching_rows(tmp_path):
+    rng = np.random.default_rng(7)
+    vectors = rng.normal(size=(300, 8)).astype(np.float32)
+    paths = [("backend/api/r%d.py" if i % 3 == 0 else "frontend/src/s%d.css") % i for i in range(300)]
+    db = SimpleVectorDB(str(tmp_path / "store"))
+    collection = db.get_or_create_collection("c")
+    collection.add(ids=[f"doc_{i}" for i in range(300)], embeddings=vectors,
+                   metadatas=[{"path": path, "chunk_index": 0} for path in paths], documents=[f"text {i}" for i in range(300)])
+
+    assert collection.count({"language": "css"}) == 200
+    for min_rows in (10**6, 50): # exact scan over the subset, then through the IVF index
+        with patch("api.rag_utils.ANN_MIN_ROWS", min_rows):
+            results = collection.query(query_embeddings=vectors[:6], n_results=3, n_probe=10**6, where={"path_prefix": "backend/"})
+        assert all(meta["path"].startswith("backend/") for metas in results["metadatas"] for meta in metas)
+        assert [ids[0] for ids in results["ids"]][::3] == ["doc_0", "doc_3"]
+    empty = collection.query(query_embeddings=vectors[:1], where={"extension": ".java"})
+    assert empty["ids"] == [[]]
+
+    collection.delete(paths=["backend/api/r0.py"])
+    assert collection.count({"path_prefix": "backend/"}) == 99
+
+def test_ttl_cache_expires_and_evicts_lru():
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3) # "b" is the least recently used
+    assert cache.get("b") is None
+    with patch("api.cache_utils.time.monotonic", return_value=10**9):
+        assert cache.get("a") is None
+    assert cache.invalidate(lambda key: key == "c") == 1
+    assert cache.stats()["hits"] == 1
+    assert normalize_query("  How do I RUN this?? ") == "how do i run this"
+
+@pytest.mark.asyncio
+async def test_query_answers_and_embeddings_are_cached_per_collection_version(rag_engine_real):
+    with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+        await rag_engine_real.index_files(1, "owner/repo", {"app.js": "function start() { return serve(8080); }\n"})
+
+    mock_client = MagicMock()
+    mock_client.aio.models.generate_content = AsyncMock(return_value=MagicMock(text="Run npm start."))
+    with patch('api.gemini_utils.client', mock_client), \
+            patch.object(rag_engine_real, 'get_embedding', new_callable=AsyncMock, return_value=[0.1] * 768) as get_embedding:
+        assert await rag_engine_real.query(1, "owner/repo", "How do I run this?") == "Run npm start."
+        assert await rag_engine_real.query(1, "owner/repo", "how do i run this") == "Run npm start."
+        assert mock_client.aio.models.generate_content.call_count == 1
+        assert get_embedding.call_count == 1
+        assert get_embedding.call_args.args[0] == "How do I run this?" # embedded as asked, not normalized
+
+        with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+            await rag_engine_real.update_files(1, "owner/repo", {"app.js": "function start() { return serve(3000); }\n"})
+        assert len(rag_engine_real.answer_cache) == 0
+        await rag_engine_real.query(1, "owner/repo", "How do I run this?")
+        assert mock_client.aio.models.generate_content.call_count == 2
+        assert get_embedding.call_count == 1 # the question's embedding does not depend on the index
+
+        await rag_engine_real.query(1, "owner/repo", "How do I run this?", index_version="abc123")
+        assert mock_client.aio.models.generate_content.call_count == 3
+
+    stats = rag_engine_real.cache_stats()
+    assert stats["answers"]["hits"] == 1
+    assert stats["query_embeddings"]["hits"] == 2
+
+@pytest.mark.parametrize("mode, max_code_ratio", [("int8", 0.25), ("pq", 0.125)])
+@patch("api.rag_utils.PQ_SUB_DIM", 2) # 32 toy dimensions need finer subspaces than 768 real ones
+def test_quantized_collections_rerank_to_exact_results(tmp_path, mode, max_code_ratio):
+    rng = np.random.default_rng(3)
+    centers = rng.normal(size=(20, 32)).astype(np.float32)
+    vectors = (centers[rng.integers(0, 20, size=800)] + 0.3 * rng.normal(size=(800, 32))).astype(np.float32)
+    store = str(tmp_path / "store")
+    db = SimpleVectorDB(store)
+    collection = db.get_or_create_collection("c")
+    db.set_quantization("c", mode)
+    collection.add(ids=[f"doc_{i}" for i in range(700)], embeddings=vectors[:700],
+                   metadatas=[{"path": f"f{i}.py"} for i in range(700)], documents=[f"text {i}" for i in range(700)])
+
+    results = collection.query(query_embeddings=vectors[:20], n_results=5)
+    assert [ids[0] for ids in results["ids"]] == [f"doc_{i}" for i in range(20)]
+    assert db.data["c"]["normalized"] is None
+    stats = db.quantization_stats("c")
+    assert stats["code_bytes"] <= stats["float32_bytes"] * max_code_ratio
+    assert stats["recall"]["reranked"] >= 0.9
+
+    # New rows are encoded with the trained codebooks
+    collection.add(ids=[f"doc_{i}" for i in range(700, 800)], embeddings=vectors[700:],
+                   metadatas=[{"path": f"f{i}.py"} for i in range(700, 800)], documents=[f"text {i}" for i in range(700, 800)])
+    assert len(db.data["c"]["codes"]) == 800
+    assert collection.query(query_embeddings=vectors[750:751], n_results=1)["ids"][0] == ["doc_750"]
+
+    resident, raw_bytes = resident_bytes(db.data["c"]), db.data["c"]["embeddings"].nbytes
+    assert raw_bytes >= stats["float32_bytes"]
+    assert db.flush(timeout=10)
+    # Once published, the raw vectors are served from the segment's memmap; only the codes stay in RAM
+    assert db.data["c"]["embeddings"].nbytes == 0
+    assert resident_bytes(db.data["c"]) == resident - raw_bytes
+    assert collection.query(query_embeddings=vectors[750:751], n_results=1)["ids"][0] == ["doc_750"]
+
+    reloaded = SimpleVectorDB(store)
+    assert reloaded.quantization("c") == mode
+    # Codebooks and codes come back with the segment instead of being retrained
+    with patch("api.rag_utils.ScalarQuantizer.train", side_effect=AssertionError("retrained")), \
+            patch("api.rag_utils.ProductQuantizer.train", side_effect=AssertionError("retrained")):
+        assert reloaded.get_collection("c").query(query_embeddings=vectors[:1], n_results=1)["ids"][0] == ["doc_0"]
+    assert reloaded.quantization_stats("c")["recall"] == stats["recall"]
+    with pytest.raises(ValueError):
+        db.set_quantization("c", "float16")
+
+@pytest.mark.asyncio
+async def test_quantizer_is_trained_off_the_event_loop(tmp_path):
+    rng = np.random.default_rng(5)
+    vectors = rng.normal(size=(200, 16)).astype(np.float32)
+    db = SimpleVectorDB(str(tmp_path / "store"))
+    collection = db.get_or_create_collection("c")
+    db.set_quantization("c", "pq")
+    collection.add(ids=[f"doc_{i}" for i in range(200)], embeddings=vectors,
+                   metadatas=[{"path": f"f{i}.py"} for i in range(200)], documents=[f"text {i}" for i in range(200)])
+
+    # Until the codebooks are ready, queries scan the raw vectors exactly
+    assert collection.query(query_embeddings=vectors[3:4], n_results=1)["ids"][0] == ["doc_3"]
+    assert db.data["c"]["quantizer"] is None
+    await db._indexing["c"]
+    assert db.quantization_stats("c")["code_bytes"] == 200 * 16 // 4
+    assert collection.query(query_embeddings=vectors[3:4], n_results=1)["ids"][0] == ["doc_3"]
+
+@pytest.mark.asyncio
+async def test_query_stream_yields_pieces_and_caches_the_full_answer(rag_engine_real):
+    with patch.object(rag_engine_real, 'embed_texts', side_effect=fake_embed_texts):
+        await rag_engine_real.index_files(1, "owner/repo", {"app.js": "function start() { return serve(8080); }\n"})
+
+    async def stream():
+        for piece in ["Hey, ", "run ", "npm start."]:
+            yield MagicMock(text=piece)
+
+    mock_client = MagicMock()
+    mock_client.aio.models.generate_content_stream = AsyncMock(return_value=stream())
+    with patch('api.gemini_utils.client', mock_client), \
+            patch.object(rag_engine_real, 'get_embedding', new_callable=AsyncMock, return_value=[0.1] * 768):
+        pieces = [piece async for piece in rag_engine_real.query_stream(1, "owner/repo", "How do I run this?")]
+        assert pieces == ["Hey, ", "run ", "npm start."]
+        assert await rag_engine_real.query(1, "owner/repo", "how do I run this") == "Hey, run npm start."
+        assert not mock_client.aio.models.generate_content.called
+
+        mock_client.aio.models.generate_content_stream = AsyncMock(side_effect=RuntimeError("quota"))
+        pieces = [piece async for piece in rag_engine_real.query_stream(1, "owner/repo", "What is serve?")]
+        assert pieces == ["I'm sorry, my AI brain is a bit foggy right now. Try again in a second?"]
+
+@patch("api.rag_utils.REFRESH_INTERVAL_SECONDS", 0)
+def test_workers_share_segments_and_pick_up_new_ones(tmp_path):
+    store = tmp_path / "store"
+    writer = SimpleVectorDB(str(store))
+    collection = writer.get_or_create_collection("user_1_owner_repo")
+    collection.add(ids=["a"], embeddings=[[1.0, 0.0]], metadatas=[{"path": "a.py", "chunk_index": 0}], documents=["alpha"])
+    assert writer.flush(timeout=10)
+
+    reader = SimpleVectorDB(str(store))
+    assert reader.get_collection("user_1_owner_repo").query(query_embeddings=[[1.0, 0.0]], n_results=1)["documents"] == [["alpha"]]
+    assert isinstance(reader.normalized("user_1_owner_repo"), np.memmap) # shared, not a private copy
+    version = reader.version("user_1_owner_repo")
+
+    for i, document in enumerate(["beta", "gamma", "delta"]):
+        collection.add(ids=[document], embeddings=[[0.0, 1.0 + i]], metadatas=[{"path": "b.py", "chunk_index": 0}], documents=[document])
+        assert writer.flush(timeout=10)
+    assert len(list(store.glob("user_1_owner_repo@*.meta.json"))) == 2 # current and previous segment only
+
+    results = reader.get_collection("user_1_owner_repo").query(query_embeddings=[[0.0, 1.0]], n_results=4)
+    assert sorted(results["documents"][0]) == ["alpha", "beta", "delta", "gamma"]
+    assert reader.version("user_1_owner_repo") > version # cached answers for the old index go stale
+
+    other = SimpleVectorDB(str(store))
+    other.get_or_create_collection("user_2_owner_other").add(ids=["x"], embeddings=[[1.0, 1.0]], metadatas=[{"path": "x"}], documents=["x"])
+    assert other.flush(timeout=10)
+    assert sorted(c.name for c in reader.list_collections()) == ["user_1_owner_repo", "user_2_owner_other"]
+    assert sorted(json.loads((store / "catalog.json").read_text())) == ["user_1_owner_repo", "user_2_owner_other"]
@@ -0,0 +1,107 @@
+import asyncio
+import time
+import pytest
+from unittest.mock import MagicMock, patch
+from google.genai import errors as genai_errors
+from api.resilience_utils import CircuitOpen, SingleFlight, breaker_stats, call_with_retries, circuit_breaker
+
+async def test_single_flight_shares_one_call_between_concurrent_callers():
+    group = SingleFlight("test")
+    started = []
+
+    async def call():
+        started.append(1)
+        await asyncio.sleep(0.01)
+        return "diff"
+
+    results = await asyncio.gather(*(group.do("pr/1", call) for _ in range(5)), group.do("pr/2", call))
+    assert results == ["diff"] * 6
+    assert len(started) == 2
+    assert group.stats() == {"calls": 6, "coalesced": 4, "in_flight": 0}
+
+    # Finished calls are not reused
+    await group.do("pr/1", call)
+    assert len(started) == 3
+
+async def test_single_flight_fans_out_errors_and_survives_a_cancelled_caller():
+    group = SingleFlight("test")
+    release = asyncio.Event()
+
+    async def failing():
+        await asyncio.sleep(0)
+        raise RuntimeError("HTTP 502")
+
+    outcomes = await asyncio.gather(group.do("k", failing), group.do("k", failing), return_exceptions=True)
+    assert [str(outcome) for outcome in outcomes] == ["HTTP 502", "HTTP 502"]
+
+    async def slow():
+        await release.wait()
+        return "done"
+
+    first = asyncio.ensure_future(group.do("slow", slow))
+    second = asyncio.ensure_future(group.do("slow", slow))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+    assert await second == "done"
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+@pytest.fixture
+def no_backoff():
+    with patch("api.resilience_utils.RETRY_BASE_DELAY", 0), patch("api.resilience_utils._breakers", {}):
+        yield
+
+async def test_retries_retryable_statuses_and_raises_other_errors_at_once(no_backoff):
+    responses = iter([FakeResponse(503), FakeResponse(429, {"Retry-After": "0"}), FakeResponse(200)])
+    result = await call_with_retries("github.api", lambda: asyncio.sleep(0, next(responses)))
+    assert result.status_code == 200
+
+    still_down = await call_with_retries("github.api", lambda: asyncio.sleep(0, FakeResponse(502)), attempts=2)
+    assert still_down.status_code == 502 # handed back to the caller's own error handling
+
+    calls = []
+    async def bad_request():
+        calls.append(1)
+        raise genai_errors.ClientError(400, {"error": {"code": 400, "message": "bad prompt", "status": "INVALID_ARGUMENT"}})
+    with pytest.raises(genai_errors.ClientError):
+        await call_with_retries("gemini.generate", bad_request)
+    assert len(calls) == 1
+    assert circuit_breaker("gemini.generate").state == "closed"
+
+async def test_breaker_opens_fails_fast_and_probes_half_open(no_backoff):
+    breaker = circuit_breaker("gemini.generate")
+    breaker.failure_threshold, breaker.reset_seconds = 3, 0.05
+
+    async def unavailable():
+        raise asyncio.TimeoutError()
+    with pytest.raises(asyncio.TimeoutError):
+        await call_with_retries("gemini.generate", unavailable) # three attempts trip the breaker
+    assert breaker_stats()["gemini.generate"]["state"] == "open"
+    with pytest.raises(CircuitOpen):
+        await call_with_retries("gemini.generate", unavailable)
+
+    await asyncio.sleep(0.06)
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow() # only one probe at a time
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    await asyncio.sleep(0.06)
+    assert await call_with_retries("gemini.generate", lambda: asyncio.sleep(0, "ok")) == "ok"
+    assert breaker_stats()["gemini.generate"] == {"state": "closed", "consecutive_failures": 0, "retry_after_seconds": 0.0, "trips": 2, "rejected": 2}
+
+async def test_open_breaker_falls_back_to_existing_replies(no_backoff, tmp_path):
+    from api.ai_utils import analyze_diff
+    from api.cache_utils import ResponseCache
+    breaker = circuit_breaker("gemini.generate")
+    breaker.state, breaker.opened_at = "open", time.monotonic()
+    with patch("api.gemini_utils.client", MagicMock()), patch("api.ai_utils.GEMINI_API_KEY", "key"), \
+            patch("api.gemini_utils._response_cache", ResponseCache(str(tmp_path / "responses.sqlite3"))):
+        review = await analyze_diff("+x = 1", "PR")
+    assert "snag" in review["summary"] and review["comments"] == []
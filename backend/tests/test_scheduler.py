@@ -0,0 +1,47 @@
+import asyncio
+import pytest
+from api.scheduler_utils import RequestDropped, RequestScheduler, TokenBucket
+
+async def test_queued_requests_are_admitted_by_priority_then_arrival():
+    scheduler = RequestScheduler(requests_per_minute=1200, tokens_per_minute=0) # one request per 50ms
+    scheduler.requests.level = 0
+    order = []
+
+    async def request(name, priority):
+        await scheduler.acquire(priority)
+        order.append(name)
+
+    tasks = [asyncio.ensure_future(request(name, priority)) for name, priority in
+             [("proactive-1", "background"), ("standup", "normal"), ("chat-1", "interactive"), ("chat-2", "interactive")]]
+    await asyncio.sleep(0.01)
+    assert scheduler.stats()["queue_depth"] == {"interactive": 2, "normal": 1, "background": 1}
+    await asyncio.gather(*tasks)
+    assert order == ["chat-1", "chat-2", "standup", "proactive-1"]
+    assert scheduler.stats()["admitted"] == {"interactive": 2, "normal": 1, "background": 1}
+
+async def test_stale_background_work_is_dropped():
+    scheduler = RequestScheduler(requests_per_minute=60, tokens_per_minute=0)
+    scheduler.requests.level = 0
+    with pytest.raises(RequestDropped):
+        await scheduler.acquire("background", max_wait=0.05)
+    assert scheduler.stats()["dropped"]["background"] == 1
+    assert scheduler.stats()["queue_depth"]["background"] == 0
+    with pytest.raises(ValueError):
+        await scheduler.acquire("urgent")
+
+async def test_token_budget_limits_large_prompts():
+    scheduler = RequestScheduler(requests_per_minute=0, tokens_per_minute=60000) # 1000 tokens a second
+    await scheduler.acquire("normal", tokens=59900)
+    waited = asyncio.get_running_loop().time()
+    await scheduler.acquire("normal", tokens=200)
+    assert asyncio.get_running_loop().time() - waited >= 0.09
+
+    scheduler.settle(estimated_tokens=200, actual_tokens=50)
+    assert scheduler.tokens.level == pytest.approx(150, abs=20)
+
+def test_token_bucket_refills_up_to_a_minute_of_quota():
+    bucket = TokenBucket(per_minute=60)
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+    assert bucket.wait_time(600) == pytest.approx(60.0, abs=0.5) # never more than a full bucket
+    assert TokenBucket(per_minute=0).wait_time(10 ** 9) == 0
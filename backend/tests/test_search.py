@@ -0,0 +1,54 @@
+import pytest
+from api.search_utils import BM25Index, PathFilterIndex, find_identifier, infer_where, reciprocal_rank_fusion, split_identifier, tokenize_code
+
+def test_identifiers_are_split_on_camel_and_snake_case():
+    assert split_identifier("fetchWeatherData") == ["fetch", "weather", "data"]
+    assert split_identifier("load_config") == ["load", "config"]
+    assert split_identifier("HTTPServer") == ["http", "server"]
+    assert tokenize_code("x = fetchWeather()") == ["x", "fetchweather", "fetch", "weather"]
+
+def test_find_identifier_only_for_lookups():
+    assert find_identifier("where is `fetchWeather` defined?") == "fetchWeather"
+    assert find_identifier("what does load_config() do") == "load_config"
+    assert find_identifier("how does the app handle errors?") is None
+    assert find_identifier("compare fetchWeather and load_config") is None
+    assert find_identifier("what does fetchWeather do?") == "fetchWeather"
+    assert find_identifier("Where is UserService defined") == "UserService"
+    assert find_identifier("where is config.load_settings declared?") == "load_settings"
+    # Ordinary words and prose that merely mention a name get hybrid search
+    assert find_identifier("How do I push my changes to GitHub?") is None
+    assert find_identifier("Is this written in TypeScript or JavaScript?") is None
+    assert find_identifier("what does GitHub Actions run") is None
+    assert find_identifier("why is fetchWeather slow") is None
+    assert find_identifier("where is the settings file defined?") is None
+
+def test_bm25_prefers_rare_exact_terms():
+    index = BM25Index([
+        "def load_config(path): return open(path).read()",
+        "def fetch_weather(city): return requests.get(city)",
+        "def main(): config = load_config('a'); print(config)",
+    ])
+    assert "load_config" in index
+    scores = index.scores("fetchWeather")
+    assert scores.argmax() == 1
+    assert index.scores("nonexistent").max() == 0
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    fused = reciprocal_rank_fusion([[3, 1, 2], [1, 4]])
+    assert fused[0][0] == 1
+    assert {row for row, _ in fused} == {1, 2, 3, 4}
+
+def test_path_filter_masks():
+    index = PathFilterIndex(["backend/api/routes.py", "frontend/src/App.css", "frontend/src/App.tsx", "README.md"])
+    assert index.mask({"extension": ".css"}).tolist() == [False, True, False, False]
+    assert index.mask({"language": ["python", "markdown"]}).tolist() == [True, False, False, True]
+    assert index.mask({"path_prefix": "frontend/", "extension": "tsx"}).tolist() == [False, False, True, False]
+    assert index.mask({"glob": "*/src/*"}).tolist() == [False, True, True, False]
+    assert index.top_dirs == {"backend", "frontend"}
+    with pytest.raises(ValueError):
+        index.mask({"author": "me"})
+
+def test_infer_where_from_question():
+    assert infer_where("why is the CSS broken on mobile?") == {"language": ["css"]}
+    assert infer_where("list the backend routes", {"backend", "frontend"}) == {"path_prefix": ["backend/"]}
+    assert infer_where("how does login work?", {"backend"}) == {}
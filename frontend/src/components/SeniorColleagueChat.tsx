@@ -1,6 +1,7 @@
 import { useState, useEffect, useRef } from 'react';
 import { MessageSquare, Send, X, Bot, Loader2, RefreshCw } from 'lucide-react';
 import api from '../api/client';
+import socket from '../api/socket';
 
 export default function SeniorColleagueChat() {
     const [isOpen, setIsOpen] = useState(false);
@@ -31,14 +32,48 @@ export default function SeniorColleagueChat() {
         setMessages(prev => [...prev, { role: 'user', text: userMsg }]);
         setIsLoading(true);
 
+        let replyStarted = false;
         try {
             const userJson = localStorage.getItem('user');
             const userData = userJson ? JSON.parse(userJson) : { id: 1 };
-            const res = await api.post(`/features/senior-colleague/chat?user_id=${userData.id}`, { message: userMsg });
-            setMessages(prev => [...prev, { role: 'bot', text: res.data.response }]);
+            const token = localStorage.getItem('token');
+            // Server-sent events: the answer is shown as soon as its first words arrive
+            const res = await fetch(`${api.defaults.baseURL}/features/senior-colleague/chat/stream?user_id=${userData.id}`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json', ...(token ? { Authorization: `Bearer ${token}` } : {}) },
+                body: JSON.stringify({ message: userMsg })
+            });
+            if (!res.ok || !res.body) throw new Error(`Chat stream failed with ${res.status}`);
+
+            setMessages(prev => [...prev, { role: 'bot', text: '' }]);
+            replyStarted = true;
+            setIsLoading(false);
+            const appendToReply = (delta: string) => setMessages(prev => {
+                const last = prev[prev.length - 1];
+                return [...prev.slice(0, -1), { ...last, text: last.text + delta }];
+            });
+
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                const events = buffer.split('\n\n');
+                buffer = events.pop() || '';
+                for (const event of events) {
+                    const data = event.split('\n').find(line => line.startsWith('data: '));
+                    if (data && !event.startsWith('event: done')) {
+                        appendToReply(JSON.parse(data.slice(6)).delta);
+                    }
+                }
+            }
         } catch (error) {
             console.error("Chat failed:", error);
-            setMessages(prev => [...prev, { role: 'bot', text: "Sorry, I'm having a bit of a brain fog right now. Can you try again?" }]);
+            const fog = { role: 'bot' as const, text: "Sorry, I'm having a bit of a brain fog right now. Can you try again?" };
+            // A stream that broke off mid-answer: replace its empty or partial bubble
+            setMessages(prev => replyStarted ? [...prev.slice(0, -1), fog] : [...prev, fog]);
         } finally {
             setIsLoading(false);
         }
@@ -50,11 +85,27 @@ export default function SeniorColleagueChat() {
         try {
             const userJson = localStorage.getItem('user');
             const userData = userJson ? JSON.parse(userJson) : { id: 1 };
-            await api.post(`/features/senior-colleague/sync?user_id=${userData.id}`);
-            setMessages(prev => [...prev, { role: 'bot', text: "Just finished re-reading your latest changes! I'm all up to date now." }]);
+            const res = await api.post(`/features/senior-colleague/sync?user_id=${userData.id}`);
+            if (!res.data.job_id) {
+                setIsSyncing(false);
+                return;
+            }
+            // The sync runs as a background job; its progress arrives over the socket
+            let finished = false;
+            const onProgress = (job: { job_id: string, status: string }) => {
+                if (finished || job.job_id !== res.data.job_id || job.status === 'queued' || job.status === 'running') return;
+                finished = true;
+                socket.off('indexing_progress', onProgress);
+                setIsSyncing(false);
+                if (job.status === 'completed') {
+                    setMessages(prev => [...prev, { role: 'bot', text: "Just finished re-reading your latest changes! I'm all up to date now." }]);
+                }
+            };
+            socket.on('indexing_progress', onProgress);
+            // Short syncs can finish before the listener is attached
+            onProgress((await api.get(`/features/senior-colleague/jobs/${res.data.job_id}`)).data);
         } catch (error) {
             console.error("Sync failed:", error);
-        } finally {
             setIsSyncing(false);
         }
     };